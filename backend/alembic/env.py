@@ -20,7 +20,7 @@ def get_db_url(settings: Settings) -> str:
     return (
         f"postgresql+psycopg://"
         f"{settings.db_user}:{settings.db_password.get_secret_value()}"
-        f"@{settings.db_host}/{settings.db_name}"
+        f"@{settings.db_host}:{settings.db_port}/{settings.db_name}"
     )
 
 
@@ -0,0 +1,63 @@
+"""Add indexes for the reverse lookups and name lookups
+
+Revision ID: 3b9d52e8a1c4
+Revises: 7c4a1e9b3f52
+Create Date: 2026-10-18 13:20:05.118734
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = '3b9d52e8a1c4'
+down_revision: Union[str, None] = '7c4a1e9b3f52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (index name, table, columns). The primary key of category_text only covers
+# the lookups by cat_id, i.e. the lookups of the categories of a text (and
+# the foreign key checks when deleting texts) need their own index.
+INDEXES = (
+    ("ix_category_text_text_id", "category_text", ["text_id"]),
+    ("ix_item_name", "item", ["name"]),
+    ("ix_category_name", "category", ["name"]),
+)
+
+
+def upgrade() -> None:
+    # The indexes are built concurrently, i.e. without blocking writes to
+    # the tables, which cannot be done in a transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            # A failed concurrent build leaves an invalid index behind, which
+            # must be dropped before the index can be built again
+            invalid = op.get_bind().execute(
+                sa.text(
+                    "SELECT NOT indisvalid FROM pg_index "
+                    "WHERE indexrelid = to_regclass(:name)"
+                ),
+                {"name": name},
+            ).scalar()
+            if invalid:
+                op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+            op.create_index(
+                name,
+                table,
+                columns,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _ in INDEXES:
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
@@ -0,0 +1,147 @@
+"""Add full-text search on the texts and trigram search on the item names
+
+Revision ID: 5f1c8d2a7b93
+Revises: 3b9d52e8a1c4
+Create Date: 2026-10-18 14:02:47.530118
+
+"""
+import logging
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+# revision identifiers, used by Alembic.
+revision: str = '5f1c8d2a7b93'
+down_revision: Union[str, None] = '3b9d52e8a1c4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger("alembic.runtime.migration")
+
+# Must match backend.queries.TEXT_SEARCH_CONFIG. The "simple" configuration
+# does no stemming and has no stop words, i.e. it works for texts in any
+# language.
+TEXT_SEARCH_CONFIG = "simple"
+
+# Number of rows of the text table updated per transaction when filling in
+# the new column
+BACKFILL_BATCH_SIZE = 10_000
+
+
+def _create_index_concurrently(name: str, table: str, *args, **kwargs) -> None:
+    # A failed concurrent build leaves an invalid index behind, which must be
+    # dropped before the index can be built again
+    invalid = op.get_bind().execute(
+        sa.text(
+            "SELECT NOT indisvalid FROM pg_index "
+            "WHERE indexrelid = to_regclass(:name)"
+        ),
+        {"name": name},
+    ).scalar()
+    if invalid:
+        op.drop_index(name, table_name=table, postgresql_concurrently=True)
+
+    op.create_index(
+        name,
+        table,
+        *args,
+        postgresql_concurrently=True,
+        if_not_exists=True,
+        **kwargs,
+    )
+
+
+def upgrade() -> None:
+    # The column is nullable and has no default, i.e. adding it does not
+    # rewrite the table (unlike a stored generated column), and it is kept in
+    # sync with the text by a trigger (the writes since the column was added
+    # included). Note that the COPYs into the table fire the trigger too.
+    op.add_column("text", sa.Column("txt_tsv", TSVECTOR, nullable=True))
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION text_txt_tsv_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.txt_tsv := to_tsvector('{TEXT_SEARCH_CONFIG}', NEW.txt);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+    op.execute(
+        """
+        CREATE TRIGGER text_txt_tsv_update
+        BEFORE INSERT OR UPDATE OF txt ON text
+        FOR EACH ROW EXECUTE FUNCTION text_txt_tsv_update()
+        """
+    )
+
+    trigram = op.get_bind().execute(
+        sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+    ).scalar()
+    if trigram:
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    else:
+        # The name search still works, but scans the item table
+        logger.warning("The pg_trgm extension is not available")
+
+    with op.get_context().autocommit_block():
+        _backfill_txt_tsv()
+        _create_index_concurrently(
+            "ix_text_txt_tsv", "text", ["txt_tsv"], postgresql_using="gin"
+        )
+        if trigram:
+            # Used for the (case-insensitive) prefix searches on the names
+            _create_index_concurrently(
+                "ix_item_name_trgm",
+                "item",
+                ["name"],
+                postgresql_using="gin",
+                postgresql_ops={"name": "gin_trgm_ops"},
+            )
+
+
+def _backfill_txt_tsv() -> None:
+    # The existing rows are filled in batches (in ID order), each in a
+    # transaction of its own, i.e. only the rows of a batch are locked at a
+    # time. The rows written since the trigger was created are skipped.
+    connection = op.get_bind()
+    after = 0
+    while True:
+        last = connection.execute(
+            sa.text(
+                "SELECT max(id) FROM ("
+                "SELECT id FROM text WHERE id > :after ORDER BY id LIMIT :size"
+                ") AS batch"
+            ),
+            {"after": after, "size": BACKFILL_BATCH_SIZE},
+        ).scalar()
+        if last is None:
+            break
+        connection.execute(
+            sa.text(
+                f"UPDATE text SET txt_tsv = to_tsvector('{TEXT_SEARCH_CONFIG}', txt) "
+                "WHERE id > :after AND id <= :last AND txt_tsv IS NULL"
+            ),
+            {"after": after, "last": last},
+        )
+        logger.info("Backfilled text.txt_tsv up to ID %s", last)
+        after = last
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table in (
+            ("ix_item_name_trgm", "item"),
+            ("ix_text_txt_tsv", "text"),
+        ):
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
+    op.execute("DROP TRIGGER IF EXISTS text_txt_tsv_update ON text")
+    op.execute("DROP FUNCTION IF EXISTS text_txt_tsv_update()")
+    op.drop_column("text", "txt_tsv")
@@ -0,0 +1,51 @@
+"""Add data change notify triggers
+
+Revision ID: 7c4a1e9b3f52
+Revises: 2eea22cf5de1
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '7c4a1e9b3f52'
+down_revision: Union[str, None] = '2eea22cf5de1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Must match backend.cache.DATA_CHANGE_CHANNEL
+CHANNEL = "data_change"
+
+TABLES = ("category", "item", "text", "category_text")
+
+
+def upgrade() -> None:
+    # Send the name of the changed table on the channel, once per statement
+    # (the notifications are delivered when the transaction commits)
+    op.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION notify_data_change() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """
+    )
+
+    for table in TABLES:
+        op.execute(
+            f"""
+            CREATE TRIGGER {table}_notify_data_change
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_data_change()
+            """
+        )
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_notify_data_change ON {table}")
+    op.execute("DROP FUNCTION IF EXISTS notify_data_change()")
@@ -1,14 +1,46 @@
-from typing import Any
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import time
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from typing import Any, Callable
+from urllib.error import URLError
+
+from cryptography.hazmat.primitives import serialization
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from jwt import PyJWKClient, decode, InvalidTokenError
+from jwt import PyJWK, PyJWKSet, decode, get_unverified_header, InvalidTokenError
+from jwt.exceptions import (
+    DecodeError,
+    ExpiredSignatureError,
+    ImmatureSignatureError,
+    InvalidAlgorithmError,
+    InvalidIssuerError,
+    PyJWKClientConnectionError,
+    PyJWKClientError,
+)
 from pydantic import ValidationError
-from starlette.status import HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 from structlog import get_logger
 
+from backend.config import VerificationMode
+from backend.metrics import Registry
+
 logger = get_logger()
 
+# Number of seconds of leeway allowed when validating the time claims
+# ("exp", "nbf" and "iat") of a token
+LEEWAY = 5
+
+# Max size (in bytes) of an encoded token
+MAX_TOKEN_SIZE = 8192
+
 
 class AuthenticationError(Exception):
     """
@@ -39,6 +71,507 @@ class AuthenticationError(Exception):
         return False
 
 
+@dataclass
+class JWKSStats:
+    # Number of lookups of a kid which was not in the key set
+    unknown_kid_lookups: int = 0
+    # Number of lookups rejected by the negative cache of unknown kids
+    negative_cache_hits: int = 0
+    # Number of unknown kid lookups not allowed to trigger a refetch
+    refetches_rate_limited: int = 0
+    # Number of fetches of the key set from Keycloak
+    fetches: int = 0
+    # Number of failed fetches of the key set from Keycloak
+    fetch_errors: int = 0
+
+
+class JWKSKeyStore:
+    """
+    Asyncio-native in-memory store of the Keycloak JSON Web Key Set (JWKS).
+
+    The key set is fetched when the store is started (during the app lifespan)
+    and refreshed by a background task before it expires, so looking up a
+    signing key by its "kid" never does any network I/O on the request path.
+    If a refresh fails, the previously fetched keys are kept and the refresh
+    is retried.
+
+    A lookup of an unknown kid (e.g. right after Keycloak has rotated its
+    keys) may trigger a refetch, but only once per min_refetch_interval, and
+    concurrent refetches share a single fetch. Kids which are still unknown
+    after a refetch are kept in a negative cache, so random kids sent by a
+    client cannot make every request hit Keycloak.
+    """
+
+    def __init__(
+        self,
+        uri: str,
+        lifespan: float = 300,
+        refresh_ahead: float = 60,
+        retry_interval: float = 5,
+        timeout: float = 5,
+        min_refetch_interval: float = 10,
+        negative_cache_ttl: float = 300,
+        negative_cache_size: int = 1024,
+    ):
+        """
+        :param uri: the JWKS URI of the Keycloak realm
+        :param lifespan: number of seconds a fetched key set is valid
+        :param refresh_ahead: number of seconds before the key set expires
+            that it is refreshed
+        :param retry_interval: number of seconds to wait before retrying a
+            failed fetch
+        :param timeout: timeout in seconds for the HTTP request to Keycloak
+        :param min_refetch_interval: min number of seconds between refetches
+            triggered by unknown kids
+        :param negative_cache_ttl: number of seconds a kid is remembered as
+            unknown
+        :param negative_cache_size: max number of kids remembered as unknown
+        """
+        self.uri = uri
+        self.lifespan = lifespan
+        self.refresh_ahead = refresh_ahead
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.min_refetch_interval = min_refetch_interval
+        self.negative_cache_ttl = negative_cache_ttl
+        self.negative_cache_size = negative_cache_size
+        self.stats = JWKSStats()
+
+        self._keys: dict[str, PyJWK] = {}
+        self._refresh_task: asyncio.Task | None = None
+        self._rotation_listeners: list[Callable[[], None]] = []
+
+        # The in-flight fetch shared by concurrent refreshes
+        self._fetch_future: asyncio.Future | None = None
+        self._last_fetch_started = float("-inf")
+        # Unknown kids and when they expire from the negative cache
+        self._unknown_kids: OrderedDict[str, float] = OrderedDict()
+
+    @property
+    def keys(self) -> dict[str, PyJWK]:
+        return self._keys
+
+    def add_rotation_listener(self, listener: Callable[[], None]) -> None:
+        """
+        Register a callable to be called whenever the key set changes, e.g.
+        when Keycloak rotates its keys.
+        """
+        self._rotation_listeners.append(listener)
+
+    def set_keys(self, jwk_set: PyJWKSet) -> None:
+        keys = {
+            jwk.key_id: jwk
+            for jwk in jwk_set.keys
+            if jwk.key_id is not None and jwk.public_key_use in ("sig", None)
+        }
+        rotated = keys.keys() != self._keys.keys()
+        self._keys = keys
+
+        if rotated:
+            self._unknown_kids.clear()
+            for listener in self._rotation_listeners:
+                listener()
+
+    def fetch(self) -> PyJWKSet:
+        """
+        Fetch the JWKS from Keycloak. This is a blocking call, which is only
+        run in a worker thread (see refresh below).
+        """
+        try:
+            request = urllib.request.Request(self.uri)
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return PyJWKSet.from_dict(json.load(response))
+        except (URLError, TimeoutError) as err:
+            raise PyJWKClientConnectionError(
+                f'Fail to fetch data from the url, err: "{err}"'
+            )
+
+    async def _fetch_and_set_keys(self) -> None:
+        self._last_fetch_started = time.monotonic()
+        self.stats.fetches += 1
+        try:
+            jwk_set = await asyncio.to_thread(self.fetch)
+        except Exception:
+            self.stats.fetch_errors += 1
+            raise
+        self.set_keys(jwk_set)
+        logger.debug("JWKS refreshed", kids=list(self._keys))
+
+    async def refresh(self) -> None:
+        """
+        Fetch the key set. Concurrent calls share a single fetch.
+        """
+        if self._fetch_future is None:
+            self._fetch_future = asyncio.ensure_future(self._fetch_and_set_keys())
+
+            def done(future: asyncio.Future) -> None:
+                self._fetch_future = None
+                # Avoid "exception was never retrieved" if all waiters are gone
+                if not future.cancelled():
+                    future.exception()
+
+            self._fetch_future.add_done_callback(done)
+
+        # Shielded, so a cancelled request does not cancel the shared fetch
+        await asyncio.shield(self._fetch_future)
+
+    async def _refresh_periodically(self) -> None:
+        delay = (
+            max(self.lifespan - self.refresh_ahead, 0)
+            if self._keys
+            else self.retry_interval
+        )
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+                delay = max(self.lifespan - self.refresh_ahead, 0)
+            except Exception as err:
+                logger.warning("Could not refresh JWKS", uri=self.uri, error=str(err))
+                delay = self.retry_interval
+
+    async def start(self) -> None:
+        """
+        Prime the store (unless the keys have been preloaded with set_keys)
+        and start refreshing it in the background. A failing initial fetch
+        (e.g. if Keycloak is not up yet) does not prevent the app from
+        starting, since the fetch is retried in the background.
+        """
+        if not self._keys:
+            try:
+                await self.refresh()
+            except Exception as err:
+                logger.warning("Could not prime JWKS", uri=self.uri, error=str(err))
+        self._refresh_task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self) -> None:
+        if self._refresh_task is None:
+            return
+        self._refresh_task.cancel()
+        try:
+            await self._refresh_task
+        except asyncio.CancelledError:
+            pass
+        self._refresh_task = None
+
+    def _is_known_unknown(self, kid: str) -> bool:
+        expires_at = self._unknown_kids.get(kid)
+        if expires_at is None:
+            return False
+        if time.monotonic() > expires_at:
+            del self._unknown_kids[kid]
+            return False
+        return True
+
+    def _remember_unknown(self, kid: str) -> None:
+        self._unknown_kids[kid] = time.monotonic() + self.negative_cache_ttl
+        self._unknown_kids.move_to_end(kid)
+        while len(self._unknown_kids) > self.negative_cache_size:
+            self._unknown_kids.popitem(last=False)
+
+    async def get_signing_key(self, kid: str) -> PyJWK:
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        self.stats.unknown_kid_lookups += 1
+        error = PyJWKClientError(
+            f'Unable to find a signing key that matches: "{kid}"'
+        )
+
+        if self._is_known_unknown(kid):
+            self.stats.negative_cache_hits += 1
+            raise error
+
+        # Join an in-flight fetch or start a new one, unless we have fetched
+        # too recently
+        since_last_fetch = time.monotonic() - self._last_fetch_started
+        if (
+            self._fetch_future is None
+            and since_last_fetch < self.min_refetch_interval
+        ):
+            self.stats.refetches_rate_limited += 1
+            raise error
+
+        try:
+            await self.refresh()
+        except Exception as err:
+            logger.warning("Could not refetch JWKS", uri=self.uri, error=str(err))
+            raise error
+
+        key = self._keys.get(kid)
+        if key is None:
+            self._remember_unknown(kid)
+            raise error
+        return key
+
+    async def get_signing_key_from_jwt(self, token: str) -> PyJWK:
+        header = get_unverified_header(token)
+        return await self.get_signing_key(header.get("kid"))
+
+
+class ClaimsCache:
+    """
+    Bounded LRU cache of the claims of already verified tokens, which allows
+    us to skip the (expensive) signature verification of tokens that are
+    reused for many requests. The cache is keyed by a digest of the token
+    (so the tokens themselves are not kept in memory) and an entry is
+    evicted when the token expires.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        leeway: float = LEEWAY,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param maxsize: maximum number of cached tokens
+        :param leeway: number of seconds a token is still accepted after its
+            "exp" claim
+        :param clock: function returning the current (epoch) time
+        """
+        self.maxsize = maxsize
+        self.leeway = leeway
+        self.clock = clock
+
+        self._entries: OrderedDict[bytes, tuple[float, dict[str, Any]]] = OrderedDict()
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, token: str) -> dict[str, Any] | None:
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+
+        expires_at, claims = entry
+        if self.clock() > expires_at:
+            del self._entries[digest]
+            return None
+
+        self._entries.move_to_end(digest)
+        # Return a copy, so the caller cannot alter the cached claims
+        return dict(claims)
+
+    def put(self, token: str, claims: dict[str, Any]) -> None:
+        exp = claims.get("exp")
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            # Tokens without an expiry are not cached, since we would not
+            # know when to evict them
+            return
+
+        digest = self._digest(token)
+        self._entries[digest] = (exp + self.leeway, dict(claims))
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+@dataclass
+class VerifierStats:
+    # Number of verifications currently running
+    in_flight: int = 0
+    # Number of verifications currently waiting for a free slot
+    queued: int = 0
+    # Highest number of verifications waiting for a free slot at once
+    max_queued: int = 0
+    # Total number of verifications run
+    completed: int = 0
+
+
+def _serialize_key(key: Any) -> Any:
+    """
+    Serialize a signing key, so it can be sent to a worker process.
+    """
+    if hasattr(key, "public_bytes"):
+        return key.public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+    return key
+
+
+@lru_cache(maxsize=32)
+def _load_public_key(pem: bytes) -> Any:
+    return serialization.load_pem_public_key(pem)
+
+
+def _decode_serialized(token: str, key: Any, **kwargs) -> dict[str, Any]:
+    """
+    Decode a token in a worker process (see TokenVerifier).
+    """
+    if isinstance(key, bytes) and key.startswith(b"-----BEGIN PUBLIC KEY-----"):
+        key = _load_public_key(key)
+    return decode(token, key, **kwargs)
+
+
+class TokenVerifier:
+    """
+    Verifies the signature of tokens (and decodes them) either inline or in
+    a thread/process pool, so a burst of fresh tokens does not starve the
+    event loop. At most max_concurrency verifications are run at once in the
+    pools; the remaining wait for a free slot (see the stats).
+    """
+
+    def __init__(
+        self,
+        mode: VerificationMode = VerificationMode.INLINE,
+        max_concurrency: int = 4,
+    ):
+        self.mode = VerificationMode(mode)
+        self.max_concurrency = max_concurrency
+        self.stats = VerifierStats()
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor: Executor | None = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == VerificationMode.THREAD:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    thread_name_prefix="token-verifier",
+                )
+            else:
+                # Do not fork the process running the event loop
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_concurrency,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+        return self._executor
+
+    async def verify(self, token: str, key: Any, **kwargs) -> dict[str, Any]:
+        """
+        Verify and decode the token.
+
+        :param token: the encoded token
+        :param key: the key to verify the signature with
+        :param kwargs: keyword arguments for jwt.decode
+        :return: the decoded token
+        """
+        if self.mode == VerificationMode.INLINE:
+            self.stats.completed += 1
+            return decode(token, key, **kwargs)
+
+        if self.mode == VerificationMode.THREAD:
+            func = partial(decode, token, key, **kwargs)
+        else:
+            func = partial(_decode_serialized, token, _serialize_key(key), **kwargs)
+
+        self.stats.queued += 1
+        self.stats.max_queued = max(self.stats.max_queued, self.stats.queued)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.stats.queued -= 1
+
+        self.stats.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func)
+        finally:
+            self.stats.in_flight -= 1
+            self.stats.completed += 1
+            self._semaphore.release()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def precheck_token(
+    token: str,
+    algorithms: list[str],
+    issuer: str | list[str] | None = None,
+    realm: str | None = None,
+    leeway: float = LEEWAY,
+    max_size: int = MAX_TOKEN_SIZE,
+    now: float | None = None,
+) -> dict[str, Any]:
+    """
+    Cheap validation of the unverified token, which rejects tokens that can
+    never be valid before we pay for the signature verification. The stages
+    are (in order):
+
+    1. The size of the token.
+    2. The token structure and the algorithm in the header.
+    3. The time claims ("exp" and "nbf") of the payload.
+    4. The issuer of the payload.
+
+    :param token: the encoded token
+    :param algorithms: the allowed signing algorithms
+    :param issuer: the allowed issuer(s). If not set, the issuer must just
+        belong to the given realm (the host part of the issuer URL depends on
+        how the client reached Keycloak, e.g. through a proxy)
+    :param realm: the Keycloak realm the issuer must belong to
+    :param leeway: number of seconds of leeway for the time claims
+    :param max_size: max size of the encoded token
+    :param now: the current (epoch) time
+    :return: the unverified header
+    :raises InvalidTokenError: if the token is invalid
+    """
+    if len(token) > max_size:
+        raise DecodeError(f"Token is larger than {max_size} bytes")
+
+    header = get_unverified_header(token)
+    if header.get("alg") not in algorithms:
+        raise InvalidAlgorithmError("The specified alg value is not allowed")
+
+    payload = decode(token, options={"verify_signature": False})
+    now = time.time() if now is None else now
+
+    exp = payload.get("exp")
+    if exp is not None:
+        if not isinstance(exp, (int, float)):
+            raise DecodeError("Expiration Time claim (exp) must be a number")
+        if exp <= now - leeway:
+            raise ExpiredSignatureError("Signature has expired")
+
+    nbf = payload.get("nbf")
+    if nbf is not None:
+        if not isinstance(nbf, (int, float)):
+            raise DecodeError("Not Before claim (nbf) must be a number")
+        if nbf > now + leeway:
+            raise ImmatureSignatureError("The token is not yet valid (nbf)")
+
+    iss = payload.get("iss")
+    if issuer is not None:
+        issuers = [issuer] if isinstance(issuer, str) else issuer
+        if iss not in issuers:
+            raise InvalidIssuerError("Invalid issuer")
+    elif realm is not None:
+        if not isinstance(iss, str) or not iss.endswith(f"/realms/{realm}"):
+            raise InvalidIssuerError("Invalid issuer")
+
+    return header
+
+
+def get_keycloak_realm_url(host: str, port: int, realm: str, http_schema: str) -> str:
+    return f"{http_schema}://{host}:{port}/auth/realms/{realm}"
+
+
+def get_jwks_key_store(
+    host: str,
+    port: int,
+    realm: str,
+    http_schema: str,
+    **kwargs,
+) -> JWKSKeyStore:
+    # URI for obtaining JSON Web Key Set (JWKS), i.e. the public Keycloak key
+    realm_url = get_keycloak_realm_url(host, port, realm, http_schema)
+    return JWKSKeyStore(realm_url + "/protocol/openid-connect/certs", **kwargs)
+
+
 def get_auth_dependency(
     host: str,
     port: int,
@@ -47,15 +580,67 @@ def get_auth_dependency(
     alg: str = "RS256",
     verify_audience: bool = True,
     audience: str | list[str] | None = None,
+    jwks: JWKSKeyStore | None = None,
+    claims_cache_size: int = 1024,
+    verifier: TokenVerifier | None = None,
+    issuer: str | list[str] | None = None,
+    max_token_size: int = MAX_TOKEN_SIZE,
+    metrics: Registry | None = None,
 ):
-    keycloak_base_url = f"{http_schema}://{host}:{port}/auth"
+    realm_url = get_keycloak_realm_url(host, port, realm, http_schema)
+    token_url_path = realm_url + "/protocol/openid-connect/token"
 
-    # URI for obtaining JSON Web Key Set (JWKS), i.e. the public Keycloak key
-    jwks_uri = keycloak_base_url + f"/realms/{realm}/protocol/openid-connect/certs"
-    token_url_path = keycloak_base_url + f"/realms/{realm}/protocol/openid-connect/token"
+    # Key store for the JWKS. The store must be started (see the app lifespan)
+    # before the keys are available.
+    if jwks is None:
+        jwks = get_jwks_key_store(host, port, realm, http_schema)
+
+    # Claims of the already verified tokens. Tokens signed with a key which is
+    # no longer in the key set must be verified again, so the cache is cleared
+    # whenever the keys are rotated.
+    claims_cache = ClaimsCache(maxsize=claims_cache_size)
+    jwks.add_rotation_listener(claims_cache.clear)
+
+    if verifier is None:
+        verifier = TokenVerifier()
 
-    # JWKS client for fetching and caching JWKS
-    jwks_client = PyJWKClient(jwks_uri)
+    # Separate timing of the key lookup and the signature verification, so a
+    # slow auth can be attributed to the JWKS (e.g. refetches) or the CPU
+    if metrics is None:
+        metrics = Registry()
+    jwks_duration = metrics.histogram(
+        "auth_jwks_lookup_duration_seconds",
+        "Time spent getting the signing key of a token from the JWKS",
+    )
+    verify_duration = metrics.histogram(
+        "auth_verify_duration_seconds",
+        "Time spent verifying a token (including waiting for a free verifier)",
+    )
+    metrics.counter(
+        "auth_jwks_fetches_total",
+        "Number of JWKS fetches from Keycloak",
+        lambda: jwks.stats.fetches,
+    )
+    metrics.counter(
+        "auth_jwks_fetch_errors_total",
+        "Number of failed JWKS fetches from Keycloak",
+        lambda: jwks.stats.fetch_errors,
+    )
+    metrics.counter(
+        "auth_jwks_unknown_kid_lookups_total",
+        "Number of lookups of kids not in the JWKS",
+        lambda: jwks.stats.unknown_kid_lookups,
+    )
+    metrics.gauge(
+        "auth_verifications_in_flight",
+        "Number of token verifications in progress",
+        lambda: verifier.stats.in_flight,
+    )
+    metrics.gauge(
+        "auth_verifications_queued",
+        "Number of token verifications waiting for a free verifier",
+        lambda: verifier.stats.queued,
+    )
 
     # For getting and parsing the Authorization header
     oauth2_scheme = OAuth2PasswordBearer(tokenUrl=token_url_path)
@@ -101,11 +686,32 @@ def get_auth_dependency(
         """
 
         try:
-            # Get the public signing key from Keycloak. The JWKS client uses an
-            # lru_cache, so it will not make an HTTP request to Keycloak each time
-            # get_signing_key_from_jwt() is called.
+            # Reject tokens which are too large before even hashing them
+            if len(token) > max_token_size:
+                raise DecodeError(f"Token is larger than {max_token_size} bytes")
+
+            cached_claims = claims_cache.get(token)
+            if cached_claims is not None:
+                return cached_claims
+
+            # Reject malformed, expired or foreign tokens before paying for
+            # the key lookup and the signature verification
+            precheck_token(
+                token,
+                algorithms=[alg],
+                issuer=issuer,
+                realm=realm,
+                max_size=max_token_size,
+            )
+
+            # Get the public signing key from the key store. The keys are kept
+            # in memory and refreshed in the background, so this will only
+            # make an HTTP request to Keycloak for an unknown kid (rate
+            # limited, see JWKSKeyStore).
 
-            signing = jwks_client.get_signing_key_from_jwt(token)
+            start = time.perf_counter()
+            signing = await jwks.get_signing_key_from_jwt(token)
+            jwks_duration.observe(time.perf_counter() - start)
 
             # The jwt.decode() method raises an exception (e.g.
             # InvalidSignatureError, ExpiredSignatureError,...) in case the OIDC
@@ -116,18 +722,40 @@ def get_auth_dependency(
             # claim in the token) when all services in the stack trust
             # each other
             # (see https://www.keycloak.org/docs/latest/server_admin/index.html#_audience)
-            decoded_token: dict[str, Any] = decode(
+            start = time.perf_counter()
+            decoded_token: dict[str, Any] = await verifier.verify(
                 token,
                 signing.key,
                 algorithms=[alg],
                 audience=audience,
+                issuer=issuer,
                 options={"verify_aud": verify_audience},
-                leeway=5,
+                leeway=LEEWAY,
             )
+            verify_duration.observe(time.perf_counter() - start)
 
+            claims_cache.put(token, decoded_token)
             return decoded_token
 
         except Exception as err:
             raise AuthenticationError(err)
 
     return keycloak_auth
+
+
+def get_role_dependency(auth: Callable, role: str):
+    """
+    Get a dependency ensuring the caller has the given Keycloak realm role.
+
+    :param auth: the auth dependency (see get_auth_dependency)
+    :param role: the required realm role
+    """
+
+    async def require_role(token: dict[str, Any] = Depends(auth)) -> dict[str, Any]:
+        if role not in token.get("realm_access", {}).get("roles", []):
+            raise HTTPException(
+                status_code=HTTP_403_FORBIDDEN, detail=f"The {role} role is required"
+            )
+        return token
+
+    return require_role
@@ -0,0 +1,341 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+import psycopg
+from fastapi import Request, Response
+from starlette.status import HTTP_304_NOT_MODIFIED
+from structlog import get_logger
+
+from backend.compression import Compressor, weak_etag
+
+logger = get_logger()
+
+# The Postgres channel on which the data change triggers (see the Alembic
+# migrations) send the name of the changed table
+DATA_CHANGE_CHANNEL = "data_change"
+
+# Number of seconds to wait for the listener to stop before cancelling it again
+STOP_RETRY_INTERVAL = 0.1
+
+
+def make_etag(body: bytes) -> str:
+    """
+    Get a strong ETag for the response body.
+    """
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Return True if the If-None-Match header of the request matches the ETag
+    (using the weak comparison required for If-None-Match) and False
+    otherwise.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in if_none_match.split(",")
+    )
+
+
+@dataclass
+class CachedResponse:
+    body: bytes
+    etag: str
+    tags: frozenset[str]
+    expires_at: float
+    media_type: str = "application/json"
+    headers: dict[str, str] = field(default_factory=dict)
+    # Compresses the body for the clients accepting it (None disables
+    # compression). The compressed bodies are kept by content coding, so
+    # each is only compressed once.
+    compressor: Compressor | None = field(default=None, repr=False)
+    variants: dict[str, bytes] = field(default_factory=dict, repr=False)
+    # Called with the size of each new compressed body (see ResponseCache.put)
+    on_variant: Callable[[int], None] | None = field(default=None, repr=False)
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.variants.values())
+
+    def variant(self, encoding: str) -> bytes:
+        """
+        Get the body compressed with the content coding.
+        """
+        body = self.variants.get(encoding)
+        if body is None:
+            body = self.variants[encoding] = self.compressor.compress(
+                self.body, encoding
+            )
+            if self.on_variant is not None:
+                self.on_variant(len(body))
+        return body
+
+    def to_response(self, request: Request) -> Response:
+        """
+        Get the response for the request, i.e. an empty 304 response if the
+        client already has this version of the response, and the compressed
+        body if the client accepts it.
+        """
+        headers = {
+            **self.headers,
+            "ETag": self.etag,
+            # Authenticated data must not be stored by shared caches, and the
+            # client must revalidate (cheap, thanks to the ETag)
+            "Cache-Control": "private, no-cache",
+        }
+        encoding = None
+        if self.compressor is not None and self.compressor.should_compress(
+            len(self.body), self.media_type
+        ):
+            headers["Vary"] = "Accept-Encoding"
+            encoding = self.compressor.negotiate(
+                request.headers.get("accept-encoding")
+            )
+            if encoding is not None:
+                headers["ETag"] = weak_etag(self.etag)
+
+        if etag_matches(request, self.etag):
+            return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+        if encoding is None:
+            return Response(self.body, media_type=self.media_type, headers=headers)
+        headers["Content-Encoding"] = encoding
+        return Response(
+            self.variant(encoding), media_type=self.media_type, headers=headers
+        )
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of response bodies. Each entry is tagged with the
+    names of the DB tables it was built from, so the entries can be
+    invalidated when a table changes (see CacheInvalidationListener). The
+    entries also expire after the TTL, which bounds how stale they can get
+    if a change notification is missed.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        settle_time: float = 0,
+        compressor: Compressor | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        :param ttl: number of seconds an entry is cached (0 disables caching)
+        :param max_entries: max number of cached entries
+        :param max_bytes: max total size of the cached bodies
+        :param settle_time: number of seconds after an invalidation during
+            which bodies built from the invalidated tables are not cached,
+            since they may have been read from a replica which has not
+            replayed the change yet
+        :param compressor: compresses the cached bodies for the clients
+            accepting it (the compressed bodies are cached too and count
+            towards max_bytes)
+        :param clock: function returning the current (monotonic) time
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.settle_time = settle_time
+        self.compressor = compressor
+        self.clock = clock
+
+        # When the tables (or all of them, see clear) were last invalidated
+        self._invalidated_at: dict[str, float] = {}
+        self._cleared_at = float("-inf")
+
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._size = 0
+        # Incremented on every invalidation (see put)
+        self.version = 0
+        # Nothing is cached while inactive, e.g. while the invalidation
+        # listener is not connected
+        self.active = True
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(request: Request) -> str:
+        return request.url.path + "?" + str(request.query_params)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _add_variant(self, key: str, entry: CachedResponse, size: int) -> None:
+        # Unless the entry has been removed in the meantime
+        if self._entries.get(key) is entry:
+            self._size += size
+            self._evict()
+
+    def get(self, key: str) -> CachedResponse | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.clock() > entry.expires_at:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(
+        self,
+        key: str,
+        body: bytes,
+        tags: Iterable[str],
+        version: int | None = None,
+        media_type: str = "application/json",
+        headers: dict[str, str] | None = None,
+    ) -> CachedResponse:
+        """
+        Cache a response body.
+
+        :param key: the cache key (see key above)
+        :param body: the response body
+        :param tags: the names of the tables the body was built from
+        :param version: the cache version read before querying the DB. If
+            the cache has been invalidated since then, the body may be stale
+            and it is not cached.
+        :param media_type: the media type of the body
+        :param headers: extra headers to send with the body
+        :return: the entry (which is also returned if it is not cached)
+        """
+        entry = CachedResponse(
+            body=body,
+            etag=make_etag(body),
+            tags=frozenset(tags),
+            expires_at=self.clock() + self.ttl,
+            media_type=media_type,
+            headers=headers or {},
+            compressor=self.compressor,
+        )
+
+        if (
+            not self.active
+            or self.ttl <= 0
+            or len(body) > self.max_bytes
+            or (version is not None and version != self.version)
+            or self._settling(entry.tags)
+        ):
+            return entry
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._size += len(body)
+        entry.on_variant = lambda size: self._add_variant(key, entry, size)
+        self._evict()
+
+        return entry
+
+    def _settling(self, tags: Iterable[str]) -> bool:
+        if self.settle_time <= 0:
+            return False
+        since = self.clock() - self.settle_time
+        return self._cleared_at > since or any(
+            self._invalidated_at.get(tag, float("-inf")) > since for tag in tags
+        )
+
+    def invalidate(self, tag: str) -> None:
+        """
+        Remove all entries built from the given table.
+        """
+        self.version += 1
+        if self.settle_time > 0:
+            self._invalidated_at[tag] = self.clock()
+        for key in [key for key, entry in self._entries.items() if tag in entry.tags]:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self.version += 1
+        if self.settle_time > 0:
+            self._cleared_at = self.clock()
+            self._invalidated_at.clear()
+        self._entries.clear()
+        self._size = 0
+
+
+class CacheInvalidationListener:
+    """
+    Listens for data change notifications from Postgres (LISTEN/NOTIFY) and
+    invalidates the cache entries built from the changed tables. Since every
+    worker process has its own listener, all workers drop their stale entries
+    right after a write is committed.
+    """
+
+    def __init__(
+        self,
+        conninfo: str,
+        cache: ResponseCache,
+        channel: str = DATA_CHANGE_CHANNEL,
+        retry_interval: float = 5,
+    ):
+        """
+        :param conninfo: the libpq connection string of the DB
+        :param cache: the cache to invalidate
+        :param channel: the notification channel
+        :param retry_interval: number of seconds to wait before reconnecting
+        """
+        self.conninfo = conninfo
+        self.cache = cache
+        self.channel = channel
+        self.retry_interval = retry_interval
+
+        self._task: asyncio.Task | None = None
+
+    async def _listen(self) -> None:
+        async with await psycopg.AsyncConnection.connect(
+            self.conninfo, autocommit=True
+        ) as connection:
+            await connection.execute(f'LISTEN "{self.channel}"')
+            # Notifications may have been missed while not listening
+            self.cache.clear()
+            self.cache.active = True
+            logger.info("Listening for data changes", channel=self.channel)
+
+            async for notify in connection.notifies():
+                self.cache.invalidate(notify.payload)
+
+    async def _listen_forever(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except Exception as err:
+                logger.warning(
+                    "Data change listener failed", channel=self.channel, error=str(err)
+                )
+            # Entries may get stale while we are not listening
+            self.cache.active = False
+            self.cache.clear()
+            await asyncio.sleep(self.retry_interval)
+
+    def start(self) -> None:
+        self.cache.active = False
+        self._task = asyncio.create_task(self._listen_forever())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        # The cancellation is swallowed if it coincides with a wait of
+        # psycopg (in asyncio.wait_for before Python 3.12) ending, e.g. while
+        # connecting, i.e. the task is cancelled until it is done
+        while not self._task.done():
+            self._task.cancel()
+            await asyncio.wait([self._task], timeout=STOP_RETRY_INTERVAL)
+        self._task = None
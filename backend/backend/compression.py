@@ -0,0 +1,307 @@
+"""
+Compression of the responses with the best content coding the client
+accepts (see the Accept-Encoding header), i.e. zstd, Brotli or gzip.
+
+gzip is always available, while zstd and Brotli need the optional zstandard
+and brotli packages. Bodies smaller than the min size are sent uncompressed,
+since compressing them saves less than it costs. Streamed responses are
+compressed chunk by chunk, and each chunk is flushed, so the client gets
+the data as soon as it is sent.
+
+The response cache keeps the compressed bodies of its entries (see
+backend.cache.CachedResponse), so a cached response is only compressed once
+per content coding. The compressed responses are sent by the endpoints
+(with the Content-Encoding set), so CompressionMiddleware leaves them alone.
+"""
+import gzip
+import zlib
+from functools import lru_cache
+from typing import Iterable, Sequence
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The supported content codings in the order of preference (zstd and
+# Brotli compress JSON better than gzip, and zstd is much faster)
+ENCODINGS = ("zstd", "br", "gzip")
+
+# The compressible media types besides text/* and the +json and +xml types
+# (e.g. images and archives are compressed already)
+COMPRESSIBLE_MEDIA_TYPES = (
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+)
+
+
+def available_encodings() -> list[str]:
+    """
+    Get the supported content codings whose packages are installed.
+    """
+    modules = {"zstd": zstandard, "br": brotli, "gzip": gzip}
+    return [encoding for encoding in ENCODINGS if modules[encoding] is not None]
+
+
+def is_compressible(media_type: str | None) -> bool:
+    if not media_type:
+        return False
+    media_type = media_type.partition(";")[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type.endswith(("+json", "+xml"))
+        or media_type in COMPRESSIBLE_MEDIA_TYPES
+    )
+
+
+@lru_cache(maxsize=128)
+def parse_accept_encoding(accept_encoding: str) -> dict[str, float]:
+    """
+    Get the quality values of the content codings in the Accept-Encoding
+    header (the clients send only a few distinct headers, i.e. the parsed
+    headers are cached).
+    """
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def weak_etag(etag: str) -> str:
+    """
+    Get the weak version of the ETag. A compressed body is not byte for byte
+    the same as the uncompressed one, so its ETag is weak (which still
+    matches in If-None-Match, see backend.cache.etag_matches).
+    """
+    return etag if etag.startswith("W/") else "W/" + etag
+
+
+class StreamCompressor:
+    """
+    Compresses a stream of chunks with a content coding. Each chunk is
+    flushed, i.e. the compressed chunk can be decompressed by the client
+    without waiting for the following ones.
+    """
+
+    def __init__(self, encoding: str, level: int):
+        """
+        :param encoding: the content coding (see ENCODINGS)
+        :param level: the compression level (quality for Brotli)
+        """
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            # A gzip (instead of a zlib) header and trailer
+            self._compressor = zlib.compressobj(
+                level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+
+    def compress(self, chunk: bytes) -> bytes:
+        if self.encoding == "zstd":
+            return self._compressor.compress(chunk) + self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self, chunk: bytes = b"") -> bytes:
+        """
+        Compress the last chunk and end the stream.
+        """
+        if self.encoding == "zstd":
+            return self._compressor.compress(chunk) + self._compressor.flush()
+        if self.encoding == "br":
+            return self._compressor.process(chunk) + self._compressor.finish()
+        return self._compressor.compress(chunk) + self._compressor.flush()
+
+
+class Compressor:
+    """
+    Negotiates the content coding of the responses and compresses them.
+    """
+
+    def __init__(
+        self,
+        encodings: Iterable[str] = ENCODINGS,
+        min_size: int = 1024,
+        zstd_level: int = 10,
+        brotli_quality: int = 6,
+        gzip_level: int = 9,
+    ):
+        """
+        :param encodings: the content codings to use if the client accepts
+            them, in the order of preference (the ones whose packages are not
+            installed are skipped, and none disables compression)
+        :param min_size: min size (in bytes) of the bodies to compress
+        :param zstd_level: the zstd compression level (1-22)
+        :param brotli_quality: the Brotli quality (0-11)
+        :param gzip_level: the gzip compression level (1-9)
+        """
+        available = available_encodings()
+        self.encodings: Sequence[str] = [
+            encoding for encoding in encodings if encoding in available
+        ]
+        self.min_size = min_size
+        self.levels = {"zstd": zstd_level, "br": brotli_quality, "gzip": gzip_level}
+
+    def should_compress(self, size: int, media_type: str | None) -> bool:
+        """
+        Return True if a body of the given size and media type is compressed
+        (if the client accepts any of the content codings) and False
+        otherwise.
+        """
+        return (
+            bool(self.encodings)
+            and size >= self.min_size
+            and is_compressible(media_type)
+        )
+
+    def negotiate(self, accept_encoding: str | None) -> str | None:
+        """
+        Get the preferred content coding among those the client accepts with
+        the highest quality, or None if the body is sent uncompressed.
+        """
+        if not accept_encoding or not self.encodings:
+            return None
+        qualities = parse_accept_encoding(accept_encoding)
+        wildcard = qualities.get("*", 0.0)
+        best, best_quality = None, 0.0
+        for encoding in self.encodings:
+            quality = qualities.get(encoding, wildcard)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        level = self.levels[encoding]
+        if encoding == "zstd":
+            return zstandard.ZstdCompressor(level=level).compress(body)
+        if encoding == "br":
+            return brotli.compress(body, quality=level)
+        # Without the modification time, i.e. the same body is always
+        # compressed to the same bytes
+        return gzip.compress(body, compresslevel=level, mtime=0)
+
+    def stream(self, encoding: str) -> StreamCompressor:
+        return StreamCompressor(encoding, self.levels[encoding])
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing the response bodies with the content coding
+    negotiated by the Compressor. Responses which already have a
+    Content-Encoding (e.g. the precompressed cached responses) are sent as
+    they are.
+    """
+
+    def __init__(self, app: ASGIApp, compressor: Compressor):
+        self.app = app
+        self.compressor = compressor
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.compressor.encodings:
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self.compressor.negotiate(
+            Headers(scope=scope).get("accept-encoding")
+        )
+        # The start message is held back until the first body chunk shows
+        # whether the body is compressed (None once it has been sent)
+        start: Message | None = None
+        stream: StreamCompressor | None = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start, stream
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(raw=message["headers"])
+                content_length = headers.get("content-length")
+                if (
+                    "content-encoding" in headers
+                    or message["status"] in (204, 304)
+                    or not is_compressible(headers.get("content-type"))
+                ):
+                    await send(message)
+                    return
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+                if encoding is None or (
+                    content_length is not None
+                    and int(content_length) < self.compressor.min_size
+                ):
+                    await send(message)
+                    return
+                start = message
+                return
+
+            if message["type"] != "http.response.body" or (
+                start is None and stream is None
+            ):
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start is not None:
+                headers = MutableHeaders(raw=start["headers"])
+                if not more_body and len(body) < self.compressor.min_size:
+                    await send(start)
+                    start = None
+                    await send(message)
+                    return
+
+                headers["Content-Encoding"] = encoding
+                if "etag" in headers:
+                    headers["ETag"] = weak_etag(headers["etag"])
+                if more_body:
+                    # The length of the compressed stream is not known
+                    del headers["Content-Length"]
+                    stream = self.compressor.stream(encoding)
+                    body = stream.compress(body)
+                else:
+                    body = self.compressor.compress(body, encoding)
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+                start = None
+            elif more_body:
+                if not body:
+                    return
+                body = stream.compress(body)
+            else:
+                body = stream.finish(body)
+                stream = None
+
+            await send(
+                {"type": "http.response.body", "body": body, "more_body": more_body}
+            )
+
+        await self.app(scope, receive, send_compressed)
@@ -1,19 +1,146 @@
-from pydantic import PositiveInt, SecretStr, AnyHttpUrl
+from enum import Enum
+from pathlib import Path
+from typing import Literal
+
+from pydantic import Field, NonNegativeInt, PositiveFloat, PositiveInt, SecretStr, AnyHttpUrl
 from pydantic_settings import BaseSettings
 
 
+class VerificationMode(str, Enum):
+    """
+    Where the (CPU-bound) token signature verification is run.
+    """
+
+    # Directly on the event loop
+    INLINE = "inline"
+    # In a thread pool
+    THREAD = "thread"
+    # In a process pool
+    PROCESS = "process"
+
+
 class Settings(BaseSettings):
     db_host: str
     db_port: PositiveInt
     db_name: str
     db_user: str
     db_password: SecretStr
+    # Connection pool (per worker process). The connections of all workers
+    # (db_pool_size + db_max_overflow each) must fit within max_connections
+    # of Postgres.
+    db_pool_size: NonNegativeInt = 5
+    db_max_overflow: int = 10
+    # Max number of connections of all the worker processes of the
+    # multi-process server (see backend.server) together to each DB server
+    # (the primary and each replica), i.e. including the cache invalidation
+    # listener of each worker (on the primary). If set, it is split evenly
+    # between the workers and overrides db_pool_size and db_max_overflow of
+    # the pools of the primary and the replicas alike.
+    db_connection_budget: PositiveInt | None = None
+    # Seconds to wait for a connection from the pool
+    db_pool_timeout: PositiveFloat = 30
+    # Seconds after which a connection is recycled (-1 means never)
+    db_pool_recycle: int = -1
+    # Test connections for liveness on checkout
+    db_pool_pre_ping: bool = False
+    # Seconds to wait for a new connection to Postgres
+    db_connect_timeout: PositiveInt = 10
+    # Read replicas ("host" or "host:port", given as a JSON list in the
+    # environment, e.g. DB_REPLICA_HOSTS='["replica1", "replica2:5433"]') for
+    # the read-only endpoints, with the same credentials and pool settings as
+    # the primary. Replicas are ejected (i.e. not used) while they cannot be
+    # connected to or lag more than db_replica_max_lag seconds behind, and
+    # are health checked every db_replica_check_interval seconds. A replica
+    # failing a request is ejected for db_replica_eject_interval seconds
+    # (unless a health check passes before). The reads of a client go to the
+    # primary for db_read_your_writes_window seconds after it has written.
+    db_replica_hosts: list[str] = []
+    db_replica_max_lag: PositiveFloat = 10
+    db_replica_check_interval: PositiveFloat = 5
+    db_replica_eject_interval: PositiveFloat = 30
+    db_read_your_writes_window: NonNegativeInt = 10
+    # The async DB driver
+    db_driver: Literal["psycopg", "asyncpg"] = "psycopg"
+    # Max number of prepared statements cached per connection
+    db_statement_cache_size: NonNegativeInt = 100
+    # Number of executions of a query before psycopg prepares it (None means
+    # never)
+    db_prepare_threshold: NonNegativeInt | None = 5
+    # Set if connecting through PgBouncer in transaction pooling mode, in
+    # which case prepared statements are not reused
+    db_pgbouncer: bool = False
+    # Let Postgres build the JSON documents of the read endpoints (json_agg)
+    # instead of fetching rows and encoding them in Python
+    db_json_aggregation: bool = False
+    # Directory for snapshots of the reflected DB schema (keyed by the Alembic
+    # revision), which allows the app to start without reflecting the schema.
+    # The snapshots are pickles, so the directory must only be writable by
+    # the app.
+    db_metadata_snapshot_dir: Path | None = None
+    # Slow query log (disabled unless a threshold in seconds is set). A sample
+    # of the slow SELECTs are executed again with EXPLAIN (ANALYZE, BUFFERS)
+    # to capture their plans. The latest records are kept in memory (see the
+    # /backend/admin/slow-queries endpoint) and appended to the log file (as
+    # JSON lines) if set.
+    db_slow_query_threshold: PositiveFloat | None = None
+    db_slow_query_explain_sample_rate: float = Field(0.1, ge=0, le=1)
+    db_slow_query_max_records: PositiveInt = 100
+    db_slow_query_log_file: Path | None = None
+
+    # In-process response cache of the read endpoints. The entries are
+    # invalidated via Postgres LISTEN/NOTIFY (using an extra DB connection per
+    # worker) and expire after the TTL in seconds (0 disables the cache).
+    response_cache_ttl: NonNegativeInt = 60
+    response_cache_max_entries: PositiveInt = 1024
+    response_cache_max_bytes: PositiveInt = 64 * 1024 * 1024
+    # Compression of the responses (see backend.compression) with the
+    # content codings the client accepts, in the order of preference (given
+    # as a JSON list in the environment, an empty list disables compression).
+    # zstd and Brotli are only used if the zstandard and brotli packages are
+    # installed. Bodies smaller than compression_min_size bytes are sent
+    # uncompressed. The levels favour smaller responses over CPU time, since
+    # the cached responses are only compressed once.
+    compression_encodings: list[Literal["zstd", "br", "gzip"]] = ["zstd", "br", "gzip"]
+    compression_min_size: NonNegativeInt = 1024
+    compression_zstd_level: int = Field(10, ge=1, le=22)
+    compression_brotli_quality: int = Field(6, ge=0, le=11)
+    compression_gzip_level: int = Field(9, ge=1, le=9)
+
+    # The multi-process server (see backend.server). The number of worker
+    # processes defaults to the number of CPUs available to the process.
+    server_host: str = "0.0.0.0"
+    server_port: PositiveInt = 8000
+    server_workers: PositiveInt | None = None
+    # The workers share the listening socket, so worker i (0, 1, ...) serves
+    # its metrics (labelled worker="i") on GET /metrics on port
+    # server_metrics_port + i instead, i.e. each worker is a scrape target
+    server_metrics_port: PositiveInt = 9100
 
     auth_host: str
     auth_port: PositiveInt
     auth_http_schema: str = "https"
     auth_realm: str
     auth_client_id: str
+    # Number of seconds the JWKS fetched from Keycloak is valid before it is
+    # refreshed (in the background)
+    auth_jwks_lifespan: PositiveInt = 300
+    # Min number of seconds between JWKS refetches triggered by tokens with
+    # an unknown key ID
+    auth_jwks_min_refetch_interval: PositiveInt = 10
+    # Max number of verified tokens to cache the claims of (0 disables the cache)
+    auth_claims_cache_size: NonNegativeInt = 1024
+    # Run the token signature verification inline (on the event loop), in a
+    # thread pool or in a process pool with at most the given number of
+    # verifications running at once
+    auth_verification_mode: VerificationMode = VerificationMode.INLINE
+    auth_verification_concurrency: PositiveInt = 4
+    # The allowed token issuer. If not set, any issuer URL of the realm is
+    # allowed (the host part depends on how the client reached Keycloak)
+    auth_issuer: str | None = None
+    # Tokens larger than this (in bytes) are rejected without being decoded
+    auth_max_token_size: PositiveInt = 8192
+    # The Keycloak realm role required by the admin endpoints
+    auth_admin_role: str = "admin"
 
 
 def get_settings(*args, **kwargs) -> Settings:
@@ -1,55 +1,523 @@
-from functools import cache
-from typing import Callable
+import os
+import pickle
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable
 
-from sqlalchemy import create_engine, Table, MetaData
-from sqlalchemy import Engine
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from fastapi import Request
+from psycopg.conninfo import make_conninfo
+from sqlalchemy import create_engine, event, text, Table, MetaData, URL
+from sqlalchemy import Connection, Engine, Executable, Result
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.util import FacadeDict
+from structlog import get_logger
 
 from backend.config import Settings
+from backend.metrics import Registry
 
 
+logger = get_logger()
+
 Base = declarative_base()
 
 
-def get_db_url(settings: Settings) -> str:
-    return (
-        f"postgresql+psycopg://"
-        f"{settings.db_user}:{settings.db_password.get_secret_value()}"
-        f"@{settings.db_host}/{settings.db_name}"
+@dataclass
+class PoolWaitStats:
+    # Number of connection checkouts
+    checkouts: int = 0
+    # Total and max number of seconds spent waiting for a connection
+    wait_time_total: float = 0.0
+    wait_time_max: float = 0.0
+    # Functions called with each wait time (e.g. to update a histogram)
+    observers: list[Callable[[float], None]] = field(default_factory=list, repr=False)
+
+    def record(self, wait_time: float) -> None:
+        self.checkouts += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+        for observer in self.observers:
+            observer(wait_time)
+
+
+class _PoolWaitMixin:
+    """
+    Records the time spent waiting for a connection on checkout (which is
+    where a too small pool shows up).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.wait_stats.record(time.perf_counter() - start)
+
+    def recreate(self):
+        # Keep the stats when the engine is disposed (which recreates the
+        # pool), so they stay cumulative
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+
+class InstrumentedQueuePool(_PoolWaitMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_PoolWaitMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+@dataclass
+class PoolStats:
+    # The configured number of pooled connections
+    size: int
+    # Number of connections currently in use
+    checked_out: int
+    # Number of idle connections in the pool
+    checked_in: int
+    # Number of connections currently opened beyond the pool size
+    overflow: int
+    wait: PoolWaitStats
+
+
+def get_pool_stats(engine: Engine | AsyncEngine) -> PoolStats:
+    pool: Pool = engine.pool
+    return PoolStats(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        checked_in=pool.checkedin(),
+        overflow=pool.overflow(),
+        wait=getattr(pool, "wait_stats", PoolWaitStats()),
     )
 
 
+# Execution option naming a statement in the query metrics (see
+# instrument_engine), e.g. select(...).execution_options(query_name="...")
+QUERY_NAME_OPTION = "query_name"
+
+
+def _query_name(statement: str, context: Any) -> str:
+    if context is not None:
+        name = context.execution_options.get(QUERY_NAME_OPTION)
+        if name is not None:
+            return name
+    # Unnamed statements are labelled by their SQL verb, which keeps the
+    # number of series bounded
+    words = statement.lstrip(" \n\t(").split(None, 1)
+    return words[0].lower() if words else "unknown"
+
+
+def instrument_engine(
+    engine: Engine | AsyncEngine, metrics: Registry, server: str = "primary"
+) -> None:
+    """
+    Record the duration of the statements executed by the engine (per query
+    name, see QUERY_NAME_OPTION) and the connection pool checkout waits and
+    usage in the metrics registry.
+
+    Args:
+        engine: the engine to instrument
+        metrics: the metrics registry
+        server: the DB server of the engine (the label of its metrics, e.g.
+            "primary" or the host of a read replica)
+    """
+    sync_engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+
+    query_duration = metrics.histogram(
+        "db_query_duration_seconds",
+        "Time spent executing DB statements (until the first rows are ready)",
+        ("server", "query"),
+    )
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("query_start", None)
+        if start is not None:
+            query_duration.observe(
+                time.perf_counter() - start, server, _query_name(statement, context)
+            )
+
+    wait_stats = getattr(engine.pool, "wait_stats", None)
+    if wait_stats is not None:
+        pool_wait_duration = metrics.histogram(
+            "db_pool_wait_duration_seconds",
+            "Time spent waiting for a connection from the pool",
+            ("server",),
+        )
+        wait_stats.observers.append(
+            lambda seconds: pool_wait_duration.observe(seconds, server)
+        )
+
+    metrics.gauge(
+        "db_pool_size",
+        "The configured number of pooled connections",
+        lambda: get_pool_stats(engine).size,
+        {"server": server},
+    )
+    metrics.gauge(
+        "db_pool_checked_out",
+        "Number of connections currently in use",
+        lambda: get_pool_stats(engine).checked_out,
+        {"server": server},
+    )
+    metrics.gauge(
+        "db_pool_overflow",
+        "Number of connections currently opened beyond the pool size",
+        # SQLAlchemy counts down from -pool_size while the pool is not full
+        lambda: max(get_pool_stats(engine).overflow, 0),
+        {"server": server},
+    )
+
+
+def get_db_url(settings: Settings, driver: str = "psycopg") -> URL:
+    query = {}
+    if driver == "asyncpg":
+        # SQLAlchemy keeps its own cache of asyncpg prepared statements
+        query["prepared_statement_cache_size"] = str(
+            0 if settings.db_pgbouncer else settings.db_statement_cache_size
+        )
+
+    return URL.create(
+        f"postgresql+{driver}",
+        username=settings.db_user,
+        password=settings.db_password.get_secret_value(),
+        host=settings.db_host,
+        port=settings.db_port,
+        database=settings.db_name,
+        query=query,
+    )
+
+
+def get_conninfo(settings: Settings) -> str:
+    """
+    Get the libpq connection string for connecting with psycopg directly
+    (i.e. not through SQLAlchemy).
+    """
+    return make_conninfo(
+        host=settings.db_host,
+        port=settings.db_port,
+        dbname=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password.get_secret_value(),
+        connect_timeout=settings.db_connect_timeout,
+    )
+
+
+def _unique_statement_name() -> str:
+    return f"__asyncpg_{uuid.uuid4()}__"
+
+
+def get_connect_args(settings: Settings, driver: str = "psycopg") -> dict[str, Any]:
+    """
+    Get the driver specific connection arguments. With PgBouncer (in
+    transaction pooling mode) a server connection may change between
+    statements, so prepared statements are not reused across statements.
+    """
+    if driver == "asyncpg":
+        connect_args: dict[str, Any] = {
+            "timeout": settings.db_connect_timeout,
+            "statement_cache_size": (
+                0 if settings.db_pgbouncer else settings.db_statement_cache_size
+            ),
+        }
+        if settings.db_pgbouncer:
+            connect_args["prepared_statement_name_func"] = _unique_statement_name
+        return connect_args
+
+    return {
+        "connect_timeout": settings.db_connect_timeout,
+        # Number of executions of a query before it is prepared (None means
+        # never)
+        "prepare_threshold": (
+            None if settings.db_pgbouncer else settings.db_prepare_threshold
+        ),
+    }
+
+
+def get_engine_kwargs(settings: Settings, driver: str = "psycopg") -> dict[str, Any]:
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "connect_args": get_connect_args(settings, driver),
+    }
+
+
+def _set_psycopg_prepared_max(engine: Engine, prepared_max: int) -> None:
+    # The size of the prepared statement cache of psycopg can only be set
+    # on the connection
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        driver_connection = getattr(
+            dbapi_connection, "driver_connection", dbapi_connection
+        )
+        driver_connection.prepared_max = prepared_max
+
+
 def get_engine(settings: Settings) -> Engine:
-    return create_engine(get_db_url(settings))
+    engine = create_engine(
+        get_db_url(settings),
+        poolclass=InstrumentedQueuePool,
+        **get_engine_kwargs(settings),
+    )
+    _set_psycopg_prepared_max(engine, settings.db_statement_cache_size)
+    return engine
 
 
 def get_async_engine(settings: Settings) -> AsyncEngine:
-    return create_async_engine(get_db_url(settings))
+    driver = settings.db_driver
+    engine = create_async_engine(
+        get_db_url(settings, driver),
+        poolclass=InstrumentedAsyncAdaptedQueuePool,
+        **get_engine_kwargs(settings, driver),
+    )
+    if driver == "psycopg":
+        _set_psycopg_prepared_max(engine.sync_engine, settings.db_statement_cache_size)
+    return engine
+
+
+def get_alembic_revision(connection: Connection) -> str | None:
+    """
+    Get the Alembic revision of the DB schema.
+
+    Args:
+        connection: the DB connection to use
+
+    Returns:
+        The revision or None if the DB is not managed by Alembic.
+    """
+    try:
+        with connection.begin_nested():
+            return connection.execute(
+                text("SELECT version_num FROM alembic_version")
+            ).scalar_one_or_none()
+    except ProgrammingError:
+        return None
 
 
-@cache
-def get_tables(engine: Engine) -> FacadeDict[str, Table]:
+def load_metadata_snapshot(path: Path) -> MetaData | None:
     """
-    Get the DB tables.
+    Load a pickled MetaData snapshot.
+
+    Args:
+        path: the path of the snapshot
+
+    Returns:
+        The MetaData or None if the snapshot does not exist or cannot be read.
+    """
+    try:
+        with path.open("rb") as fp:
+            return pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    except Exception as err:
+        logger.warning("Could not load metadata snapshot", path=str(path), error=str(err))
+        return None
+
+
+def save_metadata_snapshot(metadata: MetaData, path: Path) -> None:
+    """
+    Pickle the MetaData to a snapshot file. The file is written atomically,
+    so workers starting concurrently never see a partial snapshot.
+
+    Args:
+        metadata: the MetaData to save
+        path: the path of the snapshot
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(metadata, fp)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def reflect_metadata(
+    connection: Connection, snapshot_dir: Path | None = None
+) -> MetaData:
+    """
+    Reflect the DB schema. If a snapshot dir is given, the reflected
+    MetaData is saved there keyed by the Alembic revision of the schema, and
+    later calls load the snapshot instead of querying the DB catalog.
+
+    Args:
+        connection: the DB connection to use
+        snapshot_dir: the directory for the metadata snapshots
+
+    Returns:
+        The reflected MetaData.
+    """
+    snapshot = None
+    if snapshot_dir is not None:
+        revision = get_alembic_revision(connection)
+        if revision is not None:
+            snapshot = snapshot_dir / f"metadata-{revision}.pickle"
+            metadata = load_metadata_snapshot(snapshot)
+            if metadata is not None:
+                logger.info("Loaded metadata snapshot", path=str(snapshot))
+                return metadata
+
+    metadata = MetaData()
+    metadata.reflect(bind=connection)
+
+    if snapshot is not None:
+        try:
+            save_metadata_snapshot(metadata, snapshot)
+            logger.info("Saved metadata snapshot", path=str(snapshot))
+        except OSError as err:
+            logger.warning(
+                "Could not save metadata snapshot", path=str(snapshot), error=str(err)
+            )
+
+    return metadata
+
+
+async def get_tables(
+    engine: AsyncEngine, snapshot_dir: Path | None = None
+) -> FacadeDict[str, Table]:
+    """
+    Get the DB tables. This is called once in the app lifespan.
 
     Args:
         engine: the SQLAlchemy engine to use
+        snapshot_dir: the directory for the metadata snapshots (see
+            reflect_metadata)
 
     Returns:
          A dictionary-like object containing the DB tables.
     """
-    metadata_obj = MetaData()
-    metadata_obj.reflect(bind=engine)
-    return metadata_obj.tables
+    async with engine.connect() as connection:
+        metadata = await connection.run_sync(reflect_metadata, snapshot_dir)
+    return metadata.tables
+
+
+class LazySession:
+    """
+    Request-scoped wrapper of an AsyncSession, which is only created (i.e. a
+    connection is only checked out of the pool) when the first statement is
+    executed, and which returns the connection as soon as the DB work of
+    the handler is done. Requests which never reach the DB (e.g. cache hits
+    or failed auth) thus never hold a connection.
+
+    With autorelease, the connection is released after every statement
+    (i.e. each statement runs in its own transaction), which suits the
+    read-only handlers: the results are buffered, so the rows can still be
+    used while the response is built. Otherwise, the connection is released
+    when the transaction is committed or rolled back, and at the latest when
+    the request is done.
+    """
+
+    def __init__(
+        self,
+        session_factory: async_sessionmaker[AsyncSession],
+        get_bind: Callable[[], AsyncEngine] | None = None,
+        autorelease: bool = False,
+        fallback: Callable[[AsyncEngine, BaseException], AsyncEngine | None]
+        | None = None,
+    ):
+        """
+        Args:
+            session_factory: the factory of the wrapped session
+            get_bind: function returning the engine to bind the session to
+                (called when the session is created, e.g. to pick a read
+                replica). The engine of the factory is used if not given.
+            autorelease: release the connection after every statement
+            fallback: function called with the engine and the error if a
+                statement fails, returning the engine to execute the
+                statement again on (once, in a new session) or None to raise
+                the error. Only used with autorelease, i.e. when a statement
+                never runs in the transaction of an earlier one.
+        """
+        self.session_factory = session_factory
+        self.get_bind = get_bind
+        self.autorelease = autorelease
+        self.fallback = fallback
+        # The engine of the current session (None if there is none)
+        self.bind: AsyncEngine | None = None
+        self._session: AsyncSession | None = None
+
+    @property
+    def session(self) -> AsyncSession:
+        if self._session is None:
+            if self.get_bind is None:
+                self._session = self.session_factory()
+            else:
+                self.bind = self.get_bind()
+                self._session = self.session_factory(bind=self.bind)
+            if self.bind is None:
+                self.bind = self._session.bind
+        return self._session
+
+    async def execute(self, statement: Executable, *args, **kwargs) -> Result:
+        try:
+            result = await self.session.execute(statement, *args, **kwargs)
+        except Exception as err:
+            if self.fallback is None or not self.autorelease:
+                raise
+            bind = self.fallback(self.bind, err)
+            if bind is None:
+                raise
+            await self.release()
+            self.bind = bind
+            self._session = self.session_factory(bind=bind)
+            result = await self._session.execute(statement, *args, **kwargs)
+        if self.autorelease:
+            # AsyncSession.execute buffers all the rows
+            await self.release()
+        return result
+
+    async def connection(self) -> AsyncConnection:
+        return await self.session.connection()
+
+    async def commit(self) -> None:
+        await self.session.commit()
+        await self.release()
+
+    async def rollback(self) -> None:
+        if self._session is not None:
+            await self._session.rollback()
+        await self.release()
 
+    async def release(self) -> None:
+        """
+        Close the session (rolling back an uncommitted transaction), i.e.
+        return its connection to the pool. A later statement starts a new
+        session.
+        """
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
 
-def get_tables_dependency(settings: Settings) -> Callable[[], FacadeDict[str, Table]]:
-    engine = get_engine(settings)
 
-    @cache
-    def tables() -> FacadeDict[str, Table]:
-        return get_tables(engine)
+def get_tables_dependency() -> Callable[[Request], FacadeDict[str, Table]]:
+    def tables(request: Request) -> FacadeDict[str, Table]:
+        # Reflected in the app lifespan
+        return request.app.extra["tables"]
 
     return tables
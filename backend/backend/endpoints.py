@@ -1,15 +1,77 @@
-from typing import Any
+from contextlib import AbstractAsyncContextManager
+from dataclasses import asdict
+from typing import Any, AsyncIterator, Callable
 
-from fastapi import APIRouter, Depends
-from sqlalchemy import Table, select
-from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Table
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.util import FacadeDict
+from starlette.status import (
+    HTTP_404_NOT_FOUND,
+    HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+)
+
+from backend.auth import get_role_dependency
+from backend.cache import ResponseCache
+from backend.db import LazySession
+from backend.ingest import FORMATS, IngestError, ingest
+from backend.queries import (
+    categories_page,
+    categories_page_json,
+    category_detail,
+    category_detail_json,
+    search_items,
+)
+from backend.replicas import ReplicaRouter
+from backend.serialization import (
+    encode_categories,
+    encode_categories_chunk,
+    encode_category_detail,
+    encode_search_results,
+)
+from backend.slow_queries import SlowQueryRecorder
+
+# Default and max page size of the paginated endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Max offset of the search results (deep pages of ranked results are
+# expensive, since all the results before them must be ranked too)
+MAX_SEARCH_OFFSET = 10_000
+
+# Number of rows fetched at a time from the server-side cursor when streaming
+STREAM_BATCH_SIZE = 1000
+
+# The tables the responses of the read endpoints are built from (used for
+# invalidating the cached responses)
+CATEGORIES_TABLES = ("category",)
+CATEGORY_TABLES = ("category", "category_text", "text", "item")
+SEARCH_TABLES = ("category_text", "text", "item")
 
 
 def get_router(**kwargs) -> APIRouter:
     auth = kwargs["auth"]
     async_db_session = kwargs["async_db_session"]
+    async_session: async_sessionmaker[AsyncSession] = kwargs["async_session"]
+    # Sessions for the read-only endpoints, which may use the read replicas
+    # (see backend.replicas)
+    async_read_db_session = kwargs.get("async_read_db_session", async_db_session)
+    async_read_session: Callable[
+        [Request], AbstractAsyncContextManager[AsyncSession]
+    ] = kwargs.get("async_read_session", lambda request: async_session())
+    replica_router: ReplicaRouter | None = kwargs.get("replica_router")
     tables = kwargs["tables"]
+    response_cache: ResponseCache = kwargs["response_cache"]
+    # Let the DB build the JSON documents of the read endpoints instead of
+    # encoding the rows in Python (see backend.queries)
+    db_json_aggregation: bool = kwargs.get("db_json_aggregation", False)
+    # The slow query log (None if disabled) and the role required to view it
+    slow_query_recorder: SlowQueryRecorder | None = kwargs.get("slow_query_recorder")
+    admin_role: str = kwargs.get("admin_role", "admin")
+
+    require_admin = get_role_dependency(auth, admin_role)
 
     router = APIRouter()
 
@@ -19,29 +81,226 @@ def get_router(**kwargs) -> APIRouter:
         # since we need the token (as an example)
         return token
 
+    async def stream_categories(
+        request: Request, db_tables: FacadeDict[str, Table], after: int | None
+    ) -> AsyncIterator[bytes]:
+        # The session of the request is closed before the response is sent, so
+        # the streamed response needs its own session
+        stmt = categories_page(db_tables, after, limit=None)
+
+        async with async_read_session(request) as session:
+            result = await session.stream(
+                stmt.execution_options(yield_per=STREAM_BATCH_SIZE)
+            )
+            yield b"["
+            first = True
+            async for partition in result.partitions():
+                chunk = encode_categories_chunk(partition, first)
+                if chunk:
+                    yield chunk
+                    first = False
+            yield b"]"
+
     @router.get("/categories")
     async def categories(
-        db_session: AsyncSession = Depends(async_db_session),
+        request: Request,
+        after: int | None = Query(
+            None, description="Only return categories with an ID greater than this"
+        ),
+        limit: int | None = Query(
+            None,
+            ge=1,
+            le=MAX_PAGE_SIZE,
+            description=f"Page size (default {DEFAULT_PAGE_SIZE})",
+        ),
+        stream: bool = Query(
+            False,
+            description=(
+                "Stream all categories (after the given ID) using a server-side "
+                "cursor instead of returning a single page (cannot be combined "
+                "with limit)"
+            ),
+        ),
+        db_session: LazySession = Depends(async_read_db_session),
         db_tables: FacadeDict[str, Table] = Depends(tables),
     ) -> list[dict[str, str | int]]:
-        stmt = select(db_tables["category"])
-        result = await db_session.execute(stmt)
-
-        return [
-            {
-                "id": id_,
-                "name": name,
-                "description": desc,
-            }
-            for id_, name, desc in result
-        ]
+        if stream:
+            # The stream is never cut short, i.e. a limit would be ignored
+            if limit is not None:
+                raise HTTPException(
+                    status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="limit cannot be combined with stream",
+                )
+            return StreamingResponse(
+                stream_categories(request, db_tables, after),
+                media_type="application/json",
+            )
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+
+        cache_key = response_cache.key(request)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached.to_response(request)
+        cache_version = response_cache.version
+
+        # Keyset pagination on the ID, i.e. the cost of fetching a page does not
+        # depend on how far into the table it is
+        if db_json_aggregation:
+            result = await db_session.execute(
+                categories_page_json(db_tables, after, limit)
+            )
+            body_text, last_id, has_more = result.one()
+            body = body_text.encode()
+            next_cursor = last_id if has_more else None
+        else:
+            # One extra row is fetched to know if there is a next page
+            result = await db_session.execute(
+                categories_page(db_tables, after, limit + 1)
+            )
+            rows = result.all()
+            next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+            body = encode_categories(rows[:limit])
+
+        headers = {}
+        if next_cursor is not None:
+            headers["X-Next-Cursor"] = str(next_cursor)
+            next_url = request.url.include_query_params(after=next_cursor, limit=limit)
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        return response_cache.put(
+            cache_key, body, CATEGORIES_TABLES, cache_version, headers=headers
+        ).to_response(request)
 
     @router.get("/category/{cat_id}")
     async def category(
+            request: Request,
             cat_id: int,
-            db_session: AsyncSession = Depends(async_db_session),
+            db_session: LazySession = Depends(async_read_db_session),
             db_tables: FacadeDict[str, Table] = Depends(tables),
-    ) -> list[dict]:
-        return []
+    ) -> dict[str, Any]:
+        cache_key = response_cache.key(request)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached.to_response(request)
+        cache_version = response_cache.version
+
+        # The category, its texts and their items in a single round trip
+        if db_json_aggregation:
+            result = await db_session.execute(
+                category_detail_json(db_tables), {"cat_id": cat_id}
+            )
+            body_text = result.scalar_one_or_none()
+            if body_text is None:
+                raise HTTPException(status_code=HTTP_404_NOT_FOUND)
+            body = body_text.encode()
+        else:
+            result = await db_session.execute(
+                category_detail(db_tables), {"cat_id": cat_id}
+            )
+            rows = result.all()
+            if not rows:
+                raise HTTPException(status_code=HTTP_404_NOT_FOUND)
+            body = encode_category_detail(rows)
+        return response_cache.put(
+            cache_key, body, CATEGORY_TABLES, cache_version
+        ).to_response(request)
+
+    @router.get("/search")
+    async def search(
+        request: Request,
+        q: str | None = Query(
+            None,
+            min_length=1,
+            description=(
+                "Words to search for in the texts, e.g. 'foo bar', 'foo or bar', "
+                "'\"foo bar\"' or 'foo -bar'"
+            ),
+        ),
+        name: str | None = Query(
+            None, min_length=1, description="Beginning of the item names"
+        ),
+        category: int | None = Query(
+            None, description="Only search the texts of this category"
+        ),
+        offset: int = Query(0, ge=0, le=MAX_SEARCH_OFFSET),
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        db_session: LazySession = Depends(async_read_db_session),
+        db_tables: FacadeDict[str, Table] = Depends(tables),
+    ) -> list[dict[str, Any]]:
+        """
+        Search the items by the words of their texts (ranked by relevance)
+        and/or the beginning of their names.
+        """
+        if q is None and name is None:
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="At least one of q and name must be given",
+            )
+
+        cache_key = response_cache.key(request)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            return cached.to_response(request)
+        cache_version = response_cache.version
+
+        # One extra row is fetched to know if there is a next page
+        result = await db_session.execute(
+            search_items(db_tables, q, name, category, offset, limit + 1)
+        )
+        rows = result.all()
+
+        headers = {}
+        if len(rows) > limit:
+            next_url = request.url.include_query_params(
+                offset=offset + limit, limit=limit
+            )
+            headers["Link"] = f'<{next_url}>; rel="next"'
+
+        return response_cache.put(
+            cache_key,
+            encode_search_results(rows[:limit]),
+            SEARCH_TABLES,
+            cache_version,
+            headers=headers,
+        ).to_response(request)
+
+    @router.post("/items/bulk", dependencies=[Depends(require_admin)])
+    async def bulk_ingest(
+        request: Request,
+        response: Response,
+        db_session: LazySession = Depends(async_db_session),
+    ) -> dict[str, int]:
+        """
+        Create or update items with their texts and category links from an
+        NDJSON or CSV request body (see backend.ingest). The body is streamed
+        into the DB with COPY and merged in a single transaction, i.e. either
+        all or none of the records are ingested.
+        """
+        content_type = request.headers.get("content-type", "").partition(";")[0].strip()
+        if content_type not in FORMATS:
+            raise HTTPException(
+                status_code=HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail=f"The content type must be one of {FORMATS}",
+            )
+
+        try:
+            result = await ingest(
+                await db_session.connection(), content_type, request.stream()
+            )
+        except IngestError as err:
+            raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=str(err))
+        await db_session.commit()
+        if replica_router is not None:
+            replica_router.mark_write(response)
+
+        return asdict(result)
+
+    if slow_query_recorder is not None:
+
+        @router.get("/admin/slow-queries", dependencies=[Depends(require_admin)])
+        def slow_queries() -> list[dict[str, Any]]:
+            # Newest first, including the captured plans
+            return [asdict(record) for record in slow_query_recorder.records]
 
     return router
@@ -0,0 +1,347 @@
+"""
+Bulk ingestion of items with their texts and category links.
+
+The records are streamed from the request body into a temporary staging
+table with COPY (psycopg's async COPY or asyncpg's binary COPY, depending on
+the driver) and then merged into the tables with a few set-based statements,
+instead of inserting the rows one at a time.
+
+Each record has the fields:
+
+- id: the ID of the item (and its text)
+- name: the name of the item
+- description: the description of the item (optional)
+- txt: the text of the item
+- categories: the IDs of the categories of the text (optional). The links of
+  the text are replaced, i.e. links to other categories are removed (an
+  empty list removes all links). If the categories are omitted (or null),
+  the links of the text are left as they are.
+
+Records are given either as NDJSON (one JSON object per line) or as CSV with
+a header line naming the columns (the categories as an array literal, e.g.
+"{1,2}"). CSV is passed on to Postgres as is, i.e. it is not parsed in Python.
+"""
+import csv
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, AsyncIterable, AsyncIterator
+
+import orjson
+import psycopg
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+if TYPE_CHECKING:
+    import asyncpg
+
+NDJSON = "application/x-ndjson"
+CSV = "text/csv"
+FORMATS = (NDJSON, CSV)
+
+STAGING_TABLE = "ingest_staging"
+COLUMNS = ("id", "name", "description", "txt", "categories")
+REQUIRED_COLUMNS = ("id", "name", "txt")
+
+# The staging table only lives until the end of the transaction (the
+# categories are NULL if they are omitted, i.e. the links are kept)
+_CREATE_STAGING_TABLE = f"""
+CREATE TEMPORARY TABLE {STAGING_TABLE} (
+    id integer NOT NULL,
+    name varchar(30) NOT NULL,
+    description varchar(100),
+    txt text NOT NULL,
+    categories integer[]
+) ON COMMIT DROP
+"""
+
+# Unchanged rows are not updated (which would only leave dead tuples)
+_MERGE_ITEMS = f"""
+INSERT INTO item (id, name, description)
+SELECT id, name, description FROM {STAGING_TABLE}
+ON CONFLICT (id) DO UPDATE
+SET name = EXCLUDED.name, description = EXCLUDED.description
+WHERE (item.name, item.description)
+    IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.description)
+"""
+
+_MERGE_TEXTS = f"""
+INSERT INTO text (id, txt)
+SELECT id, txt FROM {STAGING_TABLE}
+ON CONFLICT (id) DO UPDATE
+SET txt = EXCLUDED.txt
+WHERE text.txt IS DISTINCT FROM EXCLUDED.txt
+"""
+
+_REMOVE_LINKS = f"""
+DELETE FROM category_text
+USING {STAGING_TABLE} AS staging
+WHERE category_text.text_id = staging.id
+    AND staging.categories IS NOT NULL
+    AND category_text.cat_id <> ALL (staging.categories)
+"""
+
+_ADD_LINKS = f"""
+INSERT INTO category_text (cat_id, text_id)
+SELECT DISTINCT unnest(categories), id FROM {STAGING_TABLE}
+WHERE categories IS NOT NULL
+ON CONFLICT DO NOTHING
+"""
+
+# The item IDs are given explicitly, so the sequence must be moved past them
+_ADVANCE_ITEM_SEQUENCE = """
+SELECT setval(
+    pg_get_serial_sequence('item', 'id'),
+    GREATEST((SELECT max(id) FROM item), 1)
+)
+"""
+
+
+class IngestError(Exception):
+    """
+    The records could not be ingested (i.e. the request body is invalid).
+    """
+
+
+def _is_invalid_data(err: BaseException) -> bool:
+    # Data exceptions (SQLSTATE class 22) and integrity constraint violations
+    # (class 23) are caused by the records, other errors are not
+    sqlstate = getattr(err, "sqlstate", None) or ""
+    return sqlstate[:2] in ("22", "23")
+
+
+@dataclass
+class IngestResult:
+    # Number of records in the request body
+    records: int
+    # Number of inserted or changed items and texts
+    items: int
+    texts: int
+    # Number of category links added and removed
+    links_added: int
+    links_removed: int
+
+
+async def _lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[tuple[int, bytes]]:
+    """
+    Split the chunks into (non-empty) lines (with their line numbers).
+    """
+    buffer = b""
+    number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if buffer.strip():
+        yield number + 1, buffer
+
+
+def _is_int(value: Any) -> bool:
+    # bool is a subclass of int
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _type_error(record: dict[str, Any]) -> str | None:
+    """
+    Describe the first field of the record with a value of the wrong type
+    (which the drivers could not adapt) or None if all are valid.
+    """
+    description = record.get("description")
+    categories = record.get("categories")
+    checks = (
+        ("id", "an integer", _is_int(record["id"])),
+        ("name", "a string", isinstance(record["name"], str)),
+        (
+            "description",
+            "a string or null",
+            description is None or isinstance(description, str),
+        ),
+        ("txt", "a string", isinstance(record["txt"], str)),
+        (
+            "categories",
+            "a list of integers or null",
+            categories is None
+            or (isinstance(categories, list) and all(map(_is_int, categories))),
+        ),
+    )
+    for field, expected, valid in checks:
+        if not valid:
+            return f"{field} must be {expected}"
+    return None
+
+
+def _ndjson_record(number: int, line: bytes) -> tuple:
+    try:
+        record: dict[str, Any] = orjson.loads(line)
+        if not isinstance(record, dict):
+            raise TypeError(f"Expected an object, got {type(record).__name__}")
+        type_error = _type_error(record)
+    except (orjson.JSONDecodeError, KeyError, TypeError) as err:
+        raise IngestError(f"Invalid record on line {number}: {err!r}") from err
+    if type_error is not None:
+        raise IngestError(f"Invalid record on line {number}: {type_error}")
+    return (
+        record["id"],
+        record["name"],
+        record.get("description"),
+        record["txt"],
+        record.get("categories"),
+    )
+
+
+async def _ndjson_records(chunks: AsyncIterable[bytes]) -> AsyncIterator[tuple]:
+    async for number, line in _lines(chunks):
+        yield _ndjson_record(number, line)
+
+
+async def _split_csv_header(
+    chunks: AsyncIterable[bytes],
+) -> tuple[tuple[str, ...], AsyncIterator[bytes]]:
+    """
+    Get the columns of the CSV header and the rest of the CSV.
+    """
+    iterator = aiter(chunks)
+    buffer = b""
+    while b"\n" not in buffer:
+        try:
+            buffer += await anext(iterator)
+        except StopAsyncIteration:
+            break
+    header, _, rest = buffer.partition(b"\n")
+
+    try:
+        header_line = header.decode().strip()
+    except UnicodeDecodeError as err:
+        raise IngestError(f"Invalid CSV header: {err}") from err
+    columns = tuple(column.strip() for column in next(csv.reader([header_line]), []))
+    unknown = set(columns) - set(COLUMNS)
+    missing = set(REQUIRED_COLUMNS) - set(columns)
+    if unknown or missing or len(set(columns)) != len(columns):
+        raise IngestError(
+            f"Invalid CSV header {columns} (expected columns: {COLUMNS}, "
+            f"of which {REQUIRED_COLUMNS} are required)"
+        )
+
+    async def body() -> AsyncIterator[bytes]:
+        if rest:
+            yield rest
+        async for chunk in iterator:
+            yield chunk
+
+    return columns, body()
+
+
+async def _copy_psycopg(
+    connection: psycopg.AsyncConnection,
+    content_type: str,
+    chunks: AsyncIterable[bytes],
+) -> None:
+    async with connection.cursor() as cursor:
+        if content_type == CSV:
+            columns, body = await _split_csv_header(chunks)
+            async with cursor.copy(
+                f"COPY {STAGING_TABLE} ({', '.join(columns)}) FROM STDIN (FORMAT csv)"
+            ) as copy:
+                async for chunk in body:
+                    await copy.write(chunk)
+        else:
+            async with cursor.copy(
+                f"COPY {STAGING_TABLE} ({', '.join(COLUMNS)}) FROM STDIN"
+            ) as copy:
+                async for record in _ndjson_records(chunks):
+                    await copy.write_row(record)
+
+
+async def _copy_asyncpg(
+    connection: "asyncpg.Connection",
+    content_type: str,
+    chunks: AsyncIterable[bytes],
+) -> None:
+    # Only imported if the asyncpg driver is used
+    import asyncpg
+
+    try:
+        if content_type == CSV:
+            columns, body = await _split_csv_header(chunks)
+            await connection.copy_to_table(
+                STAGING_TABLE, source=body, columns=columns, format="csv"
+            )
+        else:
+            await connection.copy_records_to_table(
+                STAGING_TABLE, records=_ndjson_records(chunks), columns=COLUMNS
+            )
+    except asyncpg.DataError as err:
+        # Raised by asyncpg when encoding a record
+        raise IngestError(f"Invalid records: {err}") from err
+    except asyncpg.PostgresError as err:
+        if _is_invalid_data(err):
+            raise IngestError(f"Invalid records: {err}") from err
+        raise
+
+
+async def ingest(
+    connection: AsyncConnection, content_type: str, chunks: AsyncIterable[bytes]
+) -> IngestResult:
+    """
+    Ingest the records (see the module docstring) in the transaction of the
+    connection. The caller must commit the transaction.
+
+    Args:
+        connection: the DB connection
+        content_type: the format of the records (NDJSON or CSV)
+        chunks: the records as a stream of bytes (e.g. the request body)
+
+    Returns:
+        The number of records ingested and rows changed.
+
+    Raises:
+        IngestError: if the records are invalid
+    """
+    if content_type not in FORMATS:
+        raise IngestError(f"Unsupported content type: {content_type}")
+
+    await connection.execute(text(_CREATE_STAGING_TABLE))
+
+    raw_connection = await connection.get_raw_connection()
+    driver_connection = raw_connection.driver_connection
+    try:
+        if connection.dialect.driver == "asyncpg":
+            await _copy_asyncpg(driver_connection, content_type, chunks)
+        else:
+            await _copy_psycopg(driver_connection, content_type, chunks)
+    except psycopg.Error as err:
+        if _is_invalid_data(err):
+            raise IngestError(f"Invalid records: {err}") from err
+        raise
+
+    try:
+        # The planner knows nothing about the size of the staging table
+        # before it is analyzed
+        await connection.execute(text(f"ANALYZE {STAGING_TABLE}"))
+        records, ids = (
+            await connection.execute(
+                text(f"SELECT count(*), count(DISTINCT id) FROM {STAGING_TABLE}")
+            )
+        ).one()
+        if ids != records:
+            raise IngestError("The IDs of the records must be unique")
+
+        items = (await connection.execute(text(_MERGE_ITEMS))).rowcount
+        await connection.execute(text(_ADVANCE_ITEM_SEQUENCE))
+        texts = (await connection.execute(text(_MERGE_TEXTS))).rowcount
+        links_removed = (await connection.execute(text(_REMOVE_LINKS))).rowcount
+        links_added = (await connection.execute(text(_ADD_LINKS))).rowcount
+    except DBAPIError as err:
+        if _is_invalid_data(err.orig):
+            raise IngestError(f"Invalid records: {err.orig}") from err
+        raise
+
+    return IngestResult(
+        records=records,
+        items=items,
+        texts=texts,
+        links_added=links_added,
+        links_removed=links_removed,
+    )
@@ -1,34 +1,238 @@
+import asyncio
 from contextlib import asynccontextmanager
 from typing import AsyncIterator
 
 import uvicorn
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Request, Response
+from fastapi.responses import ORJSONResponse
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
-from backend.auth import get_auth_dependency
+from backend.auth import TokenVerifier, get_auth_dependency, get_jwks_key_store
+from backend.cache import CacheInvalidationListener, ResponseCache
 from backend.config import get_settings
-from backend.db import get_async_engine, get_tables_dependency
+from backend.db import (
+    LazySession,
+    get_async_engine,
+    get_conninfo,
+    get_tables,
+    get_tables_dependency,
+    instrument_engine,
+)
+from backend.compression import CompressionMiddleware, Compressor
 from backend.endpoints import get_router
+from backend.metrics import (
+    CONTENT_TYPE,
+    MetricsMiddleware,
+    Registry,
+    start_metrics_server,
+)
+from backend.replicas import READ_PRIMARY_COOKIE, ReplicaRouter, parse_host
+from backend.slow_queries import RouteContextMiddleware, SlowQueryRecorder
+from backend.startup import StartupTimer
+
+
+async def shutdown(app: FastAPI, metrics_server: asyncio.Server | None) -> None:
+    """
+    Stop the components of the app (the ones which have not been started are
+    left alone, i.e. it is safe after a failed startup too).
+    """
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await app.extra["replica_router"].stop()
+    await app.extra["cache_listener"].stop()
+    await app.extra["jwks"].stop()
+    app.extra["verifier"].shutdown()
+    await app.extra["engine"].dispose()
+    if app.extra.get("slow_query_recorder") is not None:
+        await asyncio.to_thread(app.extra["slow_query_recorder"].close)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    timer: StartupTimer = app.extra["startup_timer"]
+
+    async def reflect() -> None:
+        # The tables may have been reflected before the worker was forked (see
+        # backend.server)
+        if app.extra.get("tables") is None:
+            app.extra["tables"] = await get_tables(
+                app.extra["engine"], app.extra["settings"].db_metadata_snapshot_dir
+            )
+
+    metrics_server = None
+    try:
+        # The phases wait for Keycloak and the DB respectively, i.e. they are
+        # run concurrently (and the others are cancelled if one fails)
+        async with asyncio.TaskGroup() as group:
+            group.create_task(timer.timed("jwks", app.extra["jwks"].start()))
+            group.create_task(timer.timed("reflection", reflect()))
+            group.create_task(
+                timer.timed("replicas", app.extra["replica_router"].start())
+            )
+        app.extra["cache_listener"].start()
+        # The worker processes of the multi-process server serve their metrics
+        # on a port of their own
+        if app.extra.get("metrics_port") is not None:
+            metrics_server = await start_metrics_server(
+                app.extra["metrics"],
+                app.extra["settings"].server_host,
+                app.extra["metrics_port"],
+            )
+    except BaseException:
+        # Stop the components started before the failure (e.g. the JWKS
+        # refresh task), which would otherwise keep running
+        await shutdown(app, metrics_server)
+        raise
+    timer.log()
     yield
-    await app.extra["engine"].dispose()
+    await shutdown(app, metrics_server)
 
 
 def create_app(*args, **kwargs) -> FastAPI:
+    # The startup phases (see backend.startup), the rest are timed in the
+    # lifespan
+    timer = kwargs.get("startup_timer") or StartupTimer()
+
     settings = kwargs.get("settings") or get_settings()
+    timer.lap("settings")
+
+    # The index of the worker process if run by the multi-process server (see
+    # backend.server). The workers share the listening socket, i.e. a scrape
+    # of /metrics on it would get the metrics of a random worker, so each
+    # worker serves its metrics (labelled with the worker) on its own port.
+    worker = kwargs.get("worker")
+    if worker is None:
+        metrics = Registry()
+    else:
+        metrics = Registry({"worker": str(worker)})
 
     engine = get_async_engine(settings)
+    instrument_engine(engine, metrics)
+
+    # Engines of the read replicas (with the settings of the primary)
+    replicas = []
+    for replica_host in settings.db_replica_hosts:
+        host, port = parse_host(replica_host, settings.db_port)
+        replica = get_async_engine(
+            settings.model_copy(update={"db_host": host, "db_port": port})
+        )
+        # The metrics of each replica are labelled with its host
+        instrument_engine(replica, metrics, server=f"{host}:{port}")
+        replicas.append(replica)
+    replica_router = ReplicaRouter(
+        engine,
+        replicas,
+        max_lag=settings.db_replica_max_lag,
+        check_interval=settings.db_replica_check_interval,
+        eject_interval=settings.db_replica_eject_interval,
+        read_your_writes_window=settings.db_read_your_writes_window,
+    )
+    replica_router.instrument(metrics)
+    timer.lap("engines")
+
+    slow_query_recorder = None
+    if settings.db_slow_query_threshold is not None:
+        slow_query_recorder = SlowQueryRecorder(
+            threshold=settings.db_slow_query_threshold,
+            explain_sample_rate=settings.db_slow_query_explain_sample_rate,
+            max_records=settings.db_slow_query_max_records,
+            log_file=settings.db_slow_query_log_file,
+        )
+        for recorded_engine in (engine, *replicas):
+            slow_query_recorder.attach(recorded_engine)
     async_session = async_sessionmaker(engine, expire_on_commit=False)
 
-    async def async_db_session() -> AsyncIterator[AsyncSession]:
-        async with async_session() as session:
+    # The sessions only check out a connection when the handler executes a
+    # statement and return it as soon as the DB work is done (see LazySession)
+    async def async_db_session() -> AsyncIterator[LazySession]:
+        session = LazySession(async_session)
+        try:
+            yield session
+        finally:
+            await session.release()
+
+    # Clients which have just written read from the primary, since the
+    # replicas may not have caught up with the write yet
+    def reads_from_primary(request: Request) -> bool:
+        return READ_PRIMARY_COOKIE in request.cookies
+
+    # For the streamed responses, which outlive the dependencies of the request
+    @asynccontextmanager
+    async def async_read_session(request: Request) -> AsyncIterator[AsyncSession]:
+        bind = engine if reads_from_primary(request) else replica_router.engine()
+        session = async_session(bind=bind)
+        try:
+            try:
+                # The connection is checked out before any rows are sent, so
+                # the read can still be retried on the primary
+                await session.connection()
+            except Exception as err:
+                fallback = replica_router.fallback(bind, err)
+                if fallback is None:
+                    raise
+                await session.close()
+                bind = fallback
+                session = async_session(bind=bind)
+            yield session
+        except Exception as err:
+            replica_router.report_error(bind, err)
+            raise
+        finally:
+            await session.close()
+
+    async def async_read_db_session(request: Request) -> AsyncIterator[LazySession]:
+        get_bind = None if reads_from_primary(request) else replica_router.engine
+        session = LazySession(
+            async_session, get_bind, autorelease=True, fallback=replica_router.fallback
+        )
+        try:
             yield session
-            await session.aclose()
+        except Exception as err:
+            if session.bind is not None:
+                replica_router.report_error(session.bind, err)
+            raise
+        finally:
+            await session.release()
 
-    tables = get_tables_dependency(settings)
+    tables = get_tables_dependency()
+
+    compressor = Compressor(
+        encodings=settings.compression_encodings,
+        min_size=settings.compression_min_size,
+        zstd_level=settings.compression_zstd_level,
+        brotli_quality=settings.compression_brotli_quality,
+        gzip_level=settings.compression_gzip_level,
+    )
+
+    response_cache = ResponseCache(
+        ttl=settings.response_cache_ttl,
+        max_entries=settings.response_cache_max_entries,
+        max_bytes=settings.response_cache_max_bytes,
+        # Until the replicas have replayed a change, they may return the data
+        # from before it
+        settle_time=settings.db_replica_max_lag if replicas else 0,
+        compressor=compressor,
+    )
+    cache_listener = CacheInvalidationListener(get_conninfo(settings), response_cache)
+
+    jwks = get_jwks_key_store(
+        host=settings.auth_host,
+        port=settings.auth_port,
+        realm=settings.auth_realm,
+        http_schema=settings.auth_http_schema,
+        lifespan=settings.auth_jwks_lifespan,
+        min_refetch_interval=settings.auth_jwks_min_refetch_interval,
+    )
+    # Keys fetched before the worker was forked (see backend.server)
+    jwk_set = kwargs.get("jwk_set")
+    if jwk_set is not None:
+        jwks.set_keys(jwk_set)
+
+    verifier = TokenVerifier(
+        mode=settings.auth_verification_mode,
+        max_concurrency=settings.auth_verification_concurrency,
+    )
 
     auth = get_auth_dependency(
         host=settings.auth_host,
@@ -36,24 +240,66 @@ def create_app(*args, **kwargs) -> FastAPI:
         realm=settings.auth_realm,
         http_schema=settings.auth_http_schema,
         verify_audience=False,
+        jwks=jwks,
+        claims_cache_size=settings.auth_claims_cache_size,
+        verifier=verifier,
+        issuer=settings.auth_issuer,
+        max_token_size=settings.auth_max_token_size,
+        metrics=metrics,
     )
 
-    app = FastAPI(engine=engine, lifespan=lifespan)
+    app = FastAPI(
+        settings=settings,
+        engine=engine,
+        jwks=jwks,
+        verifier=verifier,
+        cache_listener=cache_listener,
+        replica_router=replica_router,
+        slow_query_recorder=slow_query_recorder,
+        metrics=metrics,
+        startup_timer=timer,
+        metrics_port=None if worker is None else settings.server_metrics_port + worker,
+        tables=kwargs.get("db_tables"),
+        lifespan=lifespan,
+        default_response_class=ORJSONResponse,
+    )
 
     @app.get("/backend/")
     def root():
         return {"msg": "Hello (no auth required for this endpoint)"}
 
+    # Not under /backend, i.e. not exposed through the reverse proxy, but
+    # only to the Prometheus server scraping the backend directly
+    if worker is None:
+
+        @app.get("/metrics", include_in_schema=False)
+        def get_metrics():
+            return Response(metrics.render(), media_type=CONTENT_TYPE)
+
     app.include_router(
         get_router(
             auth=auth,
             async_db_session=async_db_session,
+            async_session=async_session,
+            async_read_db_session=async_read_db_session,
+            async_read_session=async_read_session,
+            replica_router=replica_router,
             tables=tables,
+            response_cache=response_cache,
+            db_json_aggregation=settings.db_json_aggregation,
+            slow_query_recorder=slow_query_recorder,
+            admin_role=settings.auth_admin_role,
         ),
         prefix="/backend",
         dependencies=[Depends(auth)]
     )
 
+    app.add_middleware(CompressionMiddleware, compressor=compressor)
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+    if slow_query_recorder is not None:
+        app.add_middleware(RouteContextMiddleware)
+
+    timer.lap("app")
     return app
 
 
@@ -0,0 +1,359 @@
+"""
+Minimal Prometheus metrics of the hot paths, i.e. the request latency per
+route, the auth timing, the DB query timing and the connection pool waits.
+
+The metrics are kept in a Registry (one per app, see create_app) and exposed
+in the Prometheus text format (version 0.0.4) on the /metrics endpoint, or
+by each worker of the multi-process server on a port of its own (see
+start_metrics_server).
+"""
+import asyncio
+import bisect
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets (in seconds). Finer than the Prometheus client defaults at
+# the low end, since most of the hot path (auth, cached reads, pool
+# checkouts) takes less than a millisecond.
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Seconds the metrics server (see start_metrics_server) waits for a request
+METRICS_SERVER_TIMEOUT = 10
+
+# The route label of requests not matching any route (the paths themselves
+# would make the number of series unbounded)
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+        + "}"
+    )
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+
+    def samples(self) -> Iterable[tuple[str, dict[str, str], float]]:
+        """
+        Get the samples of the metric as (name, labels, value) tuples.
+        """
+        raise NotImplementedError
+
+    def render(self, const_labels: dict[str, str] | None = None) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for name, labels, value in self.samples():
+            if const_labels:
+                labels = {**const_labels, **labels}
+            yield f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        """
+        :param name: the metric name
+        :param documentation: the help text of the metric
+        :param labelnames: the names of the labels of the metric
+        :param buckets: the upper bounds of the buckets (the +Inf bucket is
+            added automatically)
+        """
+        super().__init__(name, documentation)
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+
+        # The (non-cumulative) bucket counts and the sum of the observations
+        # per set of label values. The last count is the +Inf bucket.
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        series = self._series.get(labelvalues)
+        if series is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(
+                    f"Expected the label values of {self.labelnames}, "
+                    f"got {labelvalues}"
+                )
+            series = self._series[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self) -> Iterable[tuple[str, dict[str, str], float]]:
+        for labelvalues, (counts, total) in self._series.items():
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield (
+                    self.name + "_bucket",
+                    {**labels, "le": _format_value(bound)},
+                    cumulative,
+                )
+            yield self.name + "_sum", labels, total[0]
+            yield self.name + "_count", labels, cumulative
+
+
+class CallbackMetric(Metric):
+    """
+    A counter or gauge whose value is read when the metrics are collected,
+    e.g. from the stats kept by the JWKS key store or the connection pool.
+    A labelled metric has a callback per set of label values (e.g. per
+    connection pool).
+    """
+
+    def __init__(self, name: str, documentation: str, type: str):
+        super().__init__(name, documentation)
+        self.type = type
+        self.callbacks: dict[tuple[tuple[str, str], ...], Callable[[], float]] = {}
+
+    def add(self, labels: dict[str, str], callback: Callable[[], float]) -> None:
+        key = tuple(labels.items())
+        if key in self.callbacks:
+            raise ValueError(f"Metric already registered: {self.name} {labels}")
+        self.callbacks[key] = callback
+
+    def samples(self) -> Iterable[tuple[str, dict[str, str], float]]:
+        for labels, callback in self.callbacks.items():
+            yield self.name, dict(labels), callback()
+
+
+class Registry:
+    def __init__(self, const_labels: dict[str, str] | None = None):
+        """
+        :param const_labels: labels added to all samples (e.g. the worker
+            process of the multi-process server, see backend.server)
+        """
+        self.const_labels = const_labels or {}
+        self._metrics: dict[str, Metric] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._metrics
+
+    def __getitem__(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """
+        Get the histogram with the given name (which is registered if it does
+        not exist).
+        """
+        metric = self._metrics.get(name)
+        if metric is None:
+            return self.register(Histogram(name, documentation, labelnames, buckets))
+        if not isinstance(metric, Histogram) or metric.labelnames != labelnames:
+            raise ValueError(f"Metric already registered: {name}")
+        return metric
+
+    def _callback_metric(
+        self,
+        name: str,
+        documentation: str,
+        type: str,
+        callback: Callable[[], float],
+        labels: dict[str, str] | None,
+    ) -> CallbackMetric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self.register(CallbackMetric(name, documentation, type))
+        elif not isinstance(metric, CallbackMetric) or metric.type != type:
+            raise ValueError(f"Metric already registered: {name}")
+        metric.add(labels or {}, callback)
+        return metric
+
+    def counter(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], float],
+        labels: dict[str, str] | None = None,
+    ) -> CallbackMetric:
+        """
+        Register a counter read from the callback. Counters with the same name
+        can be registered with different label values.
+        """
+        return self._callback_metric(name, documentation, "counter", callback, labels)
+
+    def gauge(
+        self,
+        name: str,
+        documentation: str,
+        callback: Callable[[], float],
+        labels: dict[str, str] | None = None,
+    ) -> CallbackMetric:
+        """
+        Register a gauge read from the callback (see counter).
+        """
+        return self._callback_metric(name, documentation, "gauge", callback, labels)
+
+    def render(self) -> bytes:
+        """
+        Render all metrics in the Prometheus text format.
+        """
+        lines = [
+            line
+            for metric in self._metrics.values()
+            for line in metric.render(self.const_labels)
+        ]
+        return ("\n".join(lines) + "\n").encode()
+
+
+async def start_metrics_server(
+    metrics: Registry, host: str, port: int
+) -> asyncio.Server:
+    """
+    Serve the metrics on GET /metrics on a port of their own. This is a
+    minimal HTTP/1.1 server (one request per connection), which is all the
+    Prometheus server needs.
+
+    :param metrics: the metrics to serve
+    :param host: the host to listen on
+    :param port: the port to listen on
+    :return: the server (which must be closed by the caller)
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async with asyncio.timeout(METRICS_SERVER_TIMEOUT):
+                request_line = await reader.readline()
+                # The headers are not needed
+                while (await reader.readline()).strip():
+                    pass
+                method, _, target = request_line.decode("latin-1").partition(" ")
+                path = target.split(" ")[0].partition("?")[0]
+                if method == "GET" and path == "/metrics":
+                    status, body = "200 OK", metrics.render()
+                else:
+                    status, body = "404 Not Found", b"Not Found\n"
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status}\r\n"
+                        f"Content-Type: {CONTENT_TYPE}\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Connection: close\r\n\r\n"
+                    ).encode()
+                    + body
+                )
+                await writer.drain()
+        except (OSError, TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of the HTTP requests per method,
+    route and status code. The route is the path template of the matched
+    route (e.g. /backend/category/{cat_id}), which keeps the number of series
+    bounded. The latency includes sending the response body, i.e. the whole
+    stream for streaming responses.
+    """
+
+    def __init__(self, app: ASGIApp, metrics: Registry):
+        self.app = app
+        self.duration = metrics.histogram(
+            "http_request_duration_seconds",
+            "Latency of the HTTP requests",
+            ("method", "route", "status"),
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Unhandled exceptions are turned into 500 responses by the outermost
+        # middleware, i.e. outside this one
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router adds the matched route to the scope
+            route = scope.get("route")
+            self.duration.observe(
+                time.perf_counter() - start,
+                scope["method"],
+                route.path if route is not None else UNMATCHED_ROUTE,
+                str(status),
+            )
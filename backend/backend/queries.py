@@ -0,0 +1,298 @@
+from functools import cache
+
+from sqlalchemy import (
+    Select,
+    Table,
+    Text,
+    bindparam,
+    cast,
+    exists,
+    func,
+    literal_column,
+    null,
+    select,
+)
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.util import FacadeDict
+
+# The text search configuration of the text.txt_tsv column (must match the
+# Alembic migration creating the column)
+TEXT_SEARCH_CONFIG = "simple"
+
+
+def categories_page(
+    db_tables: FacadeDict[str, Table], after: int | None, limit: int | None
+) -> Select:
+    """
+    Get a page of categories ordered by ID (keyset pagination).
+
+    Args:
+        db_tables: the DB tables
+        after: only categories with an ID greater than this are selected
+        limit: max number of categories to select (None means no limit)
+
+    Returns:
+        The select statement.
+    """
+    category = db_tables["category"]
+    stmt = (
+        select(category)
+        .order_by(category.c.id)
+        .execution_options(query_name="categories_page")
+    )
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    if after is not None:
+        stmt = stmt.where(category.c.id > after)
+    return stmt
+
+
+@cache
+def _category_detail(
+    category: Table, category_text: Table, text: Table, item: Table
+) -> Select:
+    texts = category_text.join(text, text.c.id == category_text.c.text_id).join(
+        item, item.c.id == text.c.id
+    )
+    return (
+        select(
+            category.c.id,
+            category.c.name,
+            category.c.description,
+            item.c.id,
+            item.c.name,
+            item.c.description,
+            text.c.txt,
+        )
+        .select_from(
+            category.outerjoin(texts, category_text.c.cat_id == category.c.id)
+        )
+        .where(category.c.id == bindparam("cat_id"))
+        .order_by(item.c.id)
+        .execution_options(query_name="category_detail")
+    )
+
+
+def category_detail(db_tables: FacadeDict[str, Table]) -> Select:
+    """
+    Get a category with all its texts (and their items) in a single query,
+    i.e. one row per text or a single row with NULLs for the text columns if
+    the category has no texts. The statement is only built once per set of
+    reflected tables and takes the category ID as the "cat_id" parameter.
+
+    Args:
+        db_tables: the DB tables
+
+    Returns:
+        The select statement.
+    """
+    return _category_detail(
+        db_tables["category"],
+        db_tables["category_text"],
+        db_tables["text"],
+        db_tables["item"],
+    )
+
+
+def _json_object(*columns) -> FunctionElement:
+    """
+    Build a JSON object (in the DB) with the column names as keys.
+    """
+    args = []
+    for column in columns:
+        args.extend((literal_column(f"'{column.name}'"), column))
+    return func.json_build_object(*args)
+
+
+def categories_page_json(
+    db_tables: FacadeDict[str, Table], after: int | None, limit: int
+) -> Select:
+    """
+    Get a page of categories (see categories_page) as a JSON array built by
+    the DB. The statement selects a single row with the columns:
+
+    - body: the JSON array as text
+    - last_id: the ID of the last category in the page (None if empty)
+    - has_more: whether there are categories after the page
+
+    Args:
+        db_tables: the DB tables
+        after: only categories with an ID greater than this are selected
+        limit: max number of categories to select
+
+    Returns:
+        The select statement.
+    """
+    category = db_tables["category"]
+    page = categories_page(db_tables, after, limit).cte("page")
+    last_id = select(func.max(page.c.id)).scalar_subquery()
+
+    return select(
+        cast(
+            func.coalesce(
+                func.json_agg(
+                    aggregate_order_by(
+                        _json_object(page.c.id, page.c.name, page.c.description),
+                        page.c.id,
+                    )
+                ),
+                literal_column("'[]'::json"),
+            ),
+            Text,
+        ).label("body"),
+        func.max(page.c.id).label("last_id"),
+        exists().where(category.c.id > last_id).label("has_more"),
+    ).select_from(page).execution_options(query_name="categories_page_json")
+
+
+@cache
+def _category_detail_json(
+    category: Table, category_text: Table, text: Table, item: Table
+) -> Select:
+    texts = (
+        select(
+            func.coalesce(
+                func.json_agg(
+                    aggregate_order_by(
+                        _json_object(
+                            item.c.id, item.c.name, item.c.description, text.c.txt
+                        ),
+                        item.c.id,
+                    )
+                ),
+                literal_column("'[]'::json"),
+            )
+        )
+        .select_from(
+            category_text.join(text, text.c.id == category_text.c.text_id).join(
+                item, item.c.id == text.c.id
+            )
+        )
+        .where(category_text.c.cat_id == category.c.id)
+        .scalar_subquery()
+    )
+
+    return select(
+        cast(
+            func.json_build_object(
+                literal_column("'id'"),
+                category.c.id,
+                literal_column("'name'"),
+                category.c.name,
+                literal_column("'description'"),
+                category.c.description,
+                literal_column("'texts'"),
+                texts,
+            ),
+            Text,
+        ).label("body")
+    ).where(category.c.id == bindparam("cat_id")).execution_options(
+        query_name="category_detail_json"
+    )
+
+
+def category_detail_json(db_tables: FacadeDict[str, Table]) -> Select:
+    """
+    Get a category with all its texts (see category_detail) as a JSON object
+    built by the DB. The statement selects the JSON object as text in a
+    single row (or no rows if the category does not exist) and takes the
+    category ID as the "cat_id" parameter.
+
+    Args:
+        db_tables: the DB tables
+
+    Returns:
+        The select statement.
+    """
+    return _category_detail_json(
+        db_tables["category"],
+        db_tables["category_text"],
+        db_tables["text"],
+        db_tables["item"],
+    )
+
+
+def _escape_like(value: str) -> str:
+    """
+    Escape the LIKE wildcards (and the escape character) in the value.
+    """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def search_items(
+    db_tables: FacadeDict[str, Table],
+    query: str | None,
+    name_prefix: str | None,
+    cat_id: int | None,
+    offset: int,
+    limit: int,
+) -> Select:
+    """
+    Search the items by the words of their texts and/or the beginning of
+    their names (at least one of them must be given). Matches on the texts
+    are ranked by relevance, otherwise the items are ordered by name. The
+    statement selects the columns id, name, description, rank and headline
+    (an excerpt of the text with the matching words highlighted), where the
+    last two are NULL if there is no text query.
+
+    Args:
+        db_tables: the DB tables
+        query: the words to search for in the texts (web search syntax, e.g.
+            "foo -bar" or '"foo bar"', see websearch_to_tsquery)
+        name_prefix: the (case-insensitive) beginning of the item names
+        cat_id: only search the texts of this category
+        offset: number of results to skip
+        limit: max number of results to select
+
+    Returns:
+        The select statement.
+    """
+    item = db_tables["item"]
+    text = db_tables["text"]
+    category_text = db_tables["category_text"]
+    config = literal_column(f"'{TEXT_SEARCH_CONFIG}'::regconfig")
+
+    stmt = select(item.c.id, item.c.name, item.c.description)
+    if query is not None:
+        tsquery = func.websearch_to_tsquery(config, query)
+        rank = func.ts_rank(text.c.txt_tsv, tsquery)
+        stmt = (
+            stmt.add_columns(rank.label("rank"))
+            .join(text, text.c.id == item.c.id)
+            .where(text.c.txt_tsv.bool_op("@@")(tsquery))
+            .order_by(rank.desc(), item.c.id)
+        )
+    else:
+        stmt = stmt.order_by(item.c.name, item.c.id)
+    if name_prefix is not None:
+        # Served by the trigram index on the names (if pg_trgm is installed).
+        # Backslash is the default escape character of LIKE in Postgres.
+        stmt = stmt.where(item.c.name.ilike(f"{_escape_like(name_prefix)}%"))
+    if cat_id is not None:
+        stmt = stmt.where(
+            exists().where(
+                category_text.c.cat_id == cat_id, category_text.c.text_id == item.c.id
+            )
+        )
+    page = stmt.offset(offset).limit(limit).subquery("page")
+
+    # The order of the subquery is not kept by the outer query, i.e. the page
+    # must be ordered again
+    if query is None:
+        return (
+            select(page, null().label("rank"), null().label("headline"))
+            .order_by(page.c.name, page.c.id)
+            .execution_options(query_name="search_items")
+        )
+
+    # The headlines are only built for the page, since it is expensive
+    headline = func.ts_headline(
+        config, text.c.txt, func.websearch_to_tsquery(config, query)
+    )
+    return (
+        select(page, headline.label("headline"))
+        .join(text, text.c.id == page.c.id)
+        .order_by(page.c.rank.desc(), page.c.id)
+        .execution_options(query_name="search_items")
+    )
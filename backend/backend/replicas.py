@@ -0,0 +1,260 @@
+"""
+Routing of the read-only DB sessions to the read replicas.
+
+Read-only endpoints get their sessions from the replicas (round-robin),
+while writes (and the reads of clients which have just written, see
+READ_PRIMARY_COOKIE) go to the primary. Replicas which cannot be connected
+to or lag too far behind the primary are ejected, i.e. not used until a
+health check finds them healthy again. If all replicas are ejected, the
+reads go to the primary. A read failing because its replica cannot be
+connected to is retried on the primary (see ReplicaRouter.fallback).
+"""
+import asyncio
+import math
+import time
+from typing import Sequence
+
+from fastapi import Response
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from structlog import get_logger
+
+from backend.metrics import Registry
+
+logger = get_logger()
+
+# Set on the responses to writes, so the following reads of the client go to
+# the primary until the replicas have caught up with the write
+READ_PRIMARY_COOKIE = "read_primary"
+
+# Seconds the replica is behind the primary:
+#
+# - 0 if it is not in recovery (i.e. it has been promoted)
+# - the age of the last replayed transaction if its WAL receiver is not
+#   streaming from the primary (infinite if nothing has been replayed), since
+#   it does not get the new WAL. The status of the WAL receiver needs the
+#   pg_read_all_stats role, without which a running receiver counts as
+#   streaming.
+# - 0 if it has replayed all the WAL it has received (the last replayed
+#   transaction may be old if the primary is idle)
+# - the age of the last replayed transaction otherwise
+_REPLICATION_LAG = text(
+    """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (
+            SELECT FROM pg_stat_wal_receiver
+            WHERE status = 'streaming' OR status IS NULL
+        ) THEN COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()),
+            'Infinity'
+        )
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0
+        )
+    END
+    """
+)
+
+
+def parse_host(host: str, default_port: int) -> tuple[str, int]:
+    """
+    Split "host:port" (or just "host") into the host and the port.
+    """
+    name, _, port = host.rpartition(":")
+    if name and port.isdigit():
+        return name, int(port)
+    return host, default_port
+
+
+def is_connection_error(err: BaseException) -> bool:
+    """
+    Return True if the error means the DB server cannot be reached (as
+    opposed to e.g. an error in the statement) and False otherwise.
+    """
+    if isinstance(err, OSError):
+        return True
+    if not isinstance(err, DBAPIError):
+        return False
+    if err.connection_invalidated:
+        return True
+    # Connection exceptions (SQLSTATE class 08), the server shutting down or
+    # not accepting connections (57P01-57P03) or errors raised by the driver
+    # without a SQLSTATE (e.g. connection refused)
+    sqlstate = getattr(err.orig, "sqlstate", None)
+    if sqlstate is None:
+        return isinstance(err, (OperationalError, InterfaceError))
+    return sqlstate.startswith("08") or sqlstate in ("57P01", "57P02", "57P03")
+
+
+class ReplicaRouter:
+    """
+    Picks the engine for the read-only sessions, i.e. the next healthy
+    replica (round-robin) or the primary if there are none.
+    """
+
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: Sequence[AsyncEngine],
+        max_lag: float = 10,
+        check_interval: float = 5,
+        eject_interval: float = 30,
+        read_your_writes_window: int = 10,
+    ):
+        """
+        :param primary: the engine of the primary
+        :param replicas: the engines of the replicas
+        :param max_lag: max number of seconds a replica may lag behind the
+            primary before it is ejected
+        :param check_interval: number of seconds between the health checks
+            of the replicas
+        :param eject_interval: number of seconds a replica is ejected for
+            after a connection error (unless a health check passes before)
+        :param read_your_writes_window: number of seconds the reads of a
+            client go to the primary after it has written
+        """
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.eject_interval = eject_interval
+        self.read_your_writes_window = read_your_writes_window
+        self.ejections = 0
+
+        self._next = 0
+        # The ejected replicas (by index) and when their ejection ends
+        self._ejected_until: dict[int, float] = {}
+        self._task: asyncio.Task | None = None
+
+    @property
+    def healthy(self) -> list[AsyncEngine]:
+        now = time.monotonic()
+        return [
+            replica
+            for i, replica in enumerate(self.replicas)
+            if self._ejected_until.get(i, 0) <= now
+        ]
+
+    def engine(self) -> AsyncEngine:
+        """
+        Get the engine to use for the next read-only session.
+        """
+        healthy = self.healthy
+        if not healthy:
+            return self.primary
+        self._next = (self._next + 1) % len(healthy)
+        return healthy[self._next]
+
+    def eject(self, engine: AsyncEngine, reason: str) -> None:
+        try:
+            i = self.replicas.index(engine)
+        except ValueError:
+            # The primary is never ejected
+            return
+        if self._ejected_until.get(i, 0) <= time.monotonic():
+            self.ejections += 1
+            logger.warning(
+                "Ejected DB replica", host=engine.url.host, reason=reason
+            )
+        self._ejected_until[i] = time.monotonic() + self.eject_interval
+
+    def report_error(self, engine: AsyncEngine, err: BaseException) -> None:
+        """
+        Eject the replica if the error shows it cannot be reached.
+        """
+        if is_connection_error(err):
+            self.eject(engine, str(err))
+
+    def fallback(self, engine: AsyncEngine, err: BaseException) -> AsyncEngine | None:
+        """
+        Report the error of a read and get the engine to retry it on, i.e.
+        the primary if the replica cannot be reached (the other replicas may
+        be down too), or None if the read is not retried.
+        """
+        self.report_error(engine, err)
+        if engine is self.primary or not is_connection_error(err):
+            return None
+        logger.info("Retrying read on the DB primary", host=engine.url.host)
+        return self.primary
+
+    def mark_write(self, response: Response) -> None:
+        """
+        Let the following reads of the client go to the primary (for the
+        read-your-writes window).
+        """
+        if self.replicas and self.read_your_writes_window > 0:
+            response.set_cookie(
+                READ_PRIMARY_COOKIE,
+                "1",
+                max_age=self.read_your_writes_window,
+                httponly=True,
+                samesite="lax",
+            )
+
+    @staticmethod
+    async def _replication_lag(replica: AsyncEngine) -> float:
+        async with replica.connect() as connection:
+            return float(await connection.scalar(_REPLICATION_LAG))
+
+    async def _check(self, i: int, replica: AsyncEngine) -> None:
+        try:
+            async with asyncio.timeout(self.check_interval):
+                lag = await self._replication_lag(replica)
+        except Exception as err:
+            self.eject(replica, f"Health check failed: {err!r}")
+            return
+
+        if lag == math.inf:
+            self.eject(replica, "Not streaming from the primary")
+        elif lag > self.max_lag:
+            self.eject(replica, f"Replication lag of {lag:.1f}s")
+        elif self._ejected_until.pop(i, None) is not None:
+            logger.info("Readmitted DB replica", host=replica.url.host)
+
+    async def check(self) -> None:
+        """
+        Check the health (connectivity and replication lag) of all replicas.
+        """
+        await asyncio.gather(
+            *(self._check(i, replica) for i, replica in enumerate(self.replicas))
+        )
+
+    async def _check_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    async def start(self) -> None:
+        """
+        Check the replicas (so unhealthy ones are not used from the start)
+        and start checking them periodically in the background.
+        """
+        if self.replicas:
+            await self.check()
+            self._task = asyncio.create_task(self._check_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for replica in self.replicas:
+            await replica.dispose()
+
+    def instrument(self, metrics: Registry) -> None:
+        metrics.gauge(
+            "db_replicas_healthy",
+            "Number of read replicas currently in use",
+            lambda: len(self.healthy),
+        )
+        metrics.counter(
+            "db_replica_ejections_total",
+            "Number of times a read replica was ejected",
+            lambda: self.ejections,
+        )
@@ -0,0 +1,84 @@
+"""
+Serialization of the DB rows of the read endpoints straight to JSON bytes.
+
+The endpoints return these bytes in a plain Response, so FastAPI does not
+validate the rows against a response model or run jsonable_encoder on them.
+The rows are turned into dict literals before encoding, since orjson
+serializes dicts faster than e.g. dataclass instances can be built.
+"""
+from typing import Any, Iterable, Sequence
+
+import orjson
+
+CategoryRow = tuple[int, str, str]
+CategoryDetailRow = tuple[int, str, str, int | None, str | None, str | None, str | None]
+SearchRow = tuple[int, str, str | None, float | None, str | None]
+
+
+def encode_json(obj: Any) -> bytes:
+    return orjson.dumps(obj)
+
+
+def encode_categories(rows: Iterable[CategoryRow]) -> bytes:
+    """
+    Encode category rows as a JSON array.
+    """
+    return orjson.dumps(
+        [{"id": id_, "name": name, "description": desc} for id_, name, desc in rows]
+    )
+
+
+def encode_categories_chunk(rows: Iterable[CategoryRow], first: bool) -> bytes:
+    """
+    Encode category rows as a chunk of a streamed JSON array, i.e. without
+    the brackets and with a leading comma unless it is the first chunk.
+    """
+    items = encode_categories(rows)[1:-1]
+    if not items or first:
+        return items
+    return b"," + items
+
+
+def encode_category_detail(rows: Sequence[CategoryDetailRow]) -> bytes:
+    """
+    Encode the rows of the category detail query (see
+    backend.queries.category_detail) as a single JSON object.
+    """
+    id_, name, desc = rows[0][:3]
+    return orjson.dumps(
+        {
+            "id": id_,
+            "name": name,
+            "description": desc,
+            "texts": [
+                {
+                    "id": item_id,
+                    "name": item_name,
+                    "description": item_desc,
+                    "txt": txt,
+                }
+                for _, _, _, item_id, item_name, item_desc, txt in rows
+                # A category without texts gives a single row of NULLs
+                if item_id is not None
+            ],
+        }
+    )
+
+
+def encode_search_results(rows: Iterable[SearchRow]) -> bytes:
+    """
+    Encode the rows of the search query (see backend.queries.search_items)
+    as a JSON array.
+    """
+    return orjson.dumps(
+        [
+            {
+                "id": id_,
+                "name": name,
+                "description": desc,
+                "rank": rank,
+                "headline": headline,
+            }
+            for id_, name, desc, rank, headline in rows
+        ]
+    )
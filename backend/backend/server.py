@@ -0,0 +1,249 @@
+"""
+Pre-forking multi-process server for production.
+
+The parent process parses the settings, imports the app, fetches the JWKS
+from Keycloak, reflects the DB schema and binds the listening socket once,
+and then forks the worker processes, which inherit all of it. Each worker
+runs its own Uvicorn server (with uvloop and httptools if installed) on the
+shared socket, and the parent restarts workers which die. Each worker serves
+its metrics on a port of its own (see server_metrics_port in the settings).
+
+The DB connections of all workers must fit within max_connections of
+Postgres, so if db_connection_budget is set, each worker gets an equal share
+of it (see get_worker_settings).
+
+Run with:
+
+    python -m backend.server
+"""
+import os
+import signal
+import socket
+import time
+from importlib.util import find_spec
+from types import FrameType
+
+import uvicorn
+from jwt import PyJWKSet
+from sqlalchemy import MetaData
+from structlog import get_logger
+
+from backend.auth import get_jwks_key_store
+from backend.config import Settings, get_settings
+from backend.db import get_engine, reflect_metadata
+from backend.main import create_app
+
+logger = get_logger()
+
+# Min number of seconds between restarts of a worker, so a worker crashing
+# right away (e.g. if the DB is down) is not restarted in a tight loop
+RESTART_INTERVAL = 1
+
+
+def available_cpus() -> int:
+    """
+    Get the number of CPUs the process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on e.g. macOS
+        return os.cpu_count() or 1
+
+
+def get_worker_settings(settings: Settings, workers: int) -> Settings:
+    """
+    Get the settings of a worker process, i.e. with the pool size set to the
+    share of the connection budget (if any) of the worker. The pools of the
+    replicas are created with the same settings, i.e. the budget applies to
+    each DB server. One connection of each share is used by the cache
+    invalidation listener (on the primary only).
+
+    :param settings: the settings of the server
+    :param workers: the number of worker processes
+    :return: the settings of the worker
+    """
+    if settings.db_connection_budget is None:
+        return settings
+
+    share = settings.db_connection_budget // workers
+    if share < 2:
+        raise ValueError(
+            f"A connection budget of {settings.db_connection_budget} is too "
+            f"small for {workers} workers (at least 2 connections per worker "
+            f"are needed)"
+        )
+    return settings.model_copy(
+        update={"db_pool_size": share - 1, "db_max_overflow": 0}
+    )
+
+
+def preload_jwks(settings: Settings) -> PyJWKSet | None:
+    """
+    Fetch the JWKS from Keycloak. If Keycloak cannot be reached, the workers
+    fetch the JWKS themselves when they start.
+    """
+    jwks = get_jwks_key_store(
+        host=settings.auth_host,
+        port=settings.auth_port,
+        realm=settings.auth_realm,
+        http_schema=settings.auth_http_schema,
+    )
+    try:
+        return jwks.fetch()
+    except Exception as err:
+        logger.warning("Could not preload JWKS", uri=jwks.uri, error=str(err))
+        return None
+
+
+def preload_metadata(settings: Settings) -> MetaData | None:
+    """
+    Reflect the DB schema (or load its snapshot). The engine is disposed of
+    before the workers are forked, so they do not inherit any connections. If
+    the DB cannot be reached, the workers reflect the schema themselves when
+    they start.
+    """
+    engine = get_engine(settings)
+    try:
+        with engine.connect() as connection:
+            return reflect_metadata(connection, settings.db_metadata_snapshot_dir)
+    except Exception as err:
+        logger.warning("Could not preload DB metadata", error=str(err))
+        return None
+    finally:
+        engine.dispose()
+
+
+class Server:
+    """
+    Forks the worker processes and restarts them when they die until the
+    server is stopped with SIGTERM or SIGINT, which is passed on to the
+    workers (Uvicorn shuts them down gracefully).
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        workers: int,
+        sock: socket.socket,
+        jwk_set: PyJWKSet | None,
+        metadata: MetaData | None,
+    ):
+        """
+        :param settings: the settings of the workers
+        :param workers: the number of worker processes
+        :param sock: the listening socket shared by the workers
+        :param jwk_set: the preloaded JWKS (None if it could not be fetched)
+        :param metadata: the reflected DB schema (None if it could not be
+            reflected)
+        """
+        self.settings = settings
+        self.workers = workers
+        self.sock = sock
+        self.jwk_set = jwk_set
+        self.metadata = metadata
+        self.stopping = False
+        # Worker PIDs and their index (a restarted worker gets the index of
+        # the one it replaces, i.e. it serves its metrics on the same port)
+        # and when they were started
+        self._pids: dict[int, tuple[int, float]] = {}
+
+    def _run_worker(self, worker: int) -> None:
+        # The handlers of the parent must not be inherited (Uvicorn installs
+        # its own)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        app = create_app(
+            settings=self.settings,
+            jwk_set=self.jwk_set,
+            db_tables=None if self.metadata is None else self.metadata.tables,
+            worker=worker,
+        )
+        config = uvicorn.Config(app, loop="auto", http="auto", lifespan="on")
+        uvicorn.Server(config).run(sockets=[self.sock])
+
+    def _spawn(self, worker: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._run_worker(worker)
+            except BaseException:
+                logger.exception("Worker failed")
+                status = 1
+            finally:
+                os._exit(status)
+
+        self._pids[pid] = (worker, time.monotonic())
+        logger.info("Started worker", pid=pid, worker=worker)
+        # The server may have been stopped while forking
+        if self.stopping:
+            os.kill(pid, signal.SIGTERM)
+
+    def _stop(self, signum: int, frame: FrameType | None) -> None:
+        self.stopping = True
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for worker in range(self.workers):
+            self._spawn(worker)
+
+        while self._pids:
+            pid, status = os.wait()
+            spawned = self._pids.pop(pid, None)
+            if spawned is None or self.stopping:
+                continue
+
+            worker, started = spawned
+            logger.warning(
+                "Worker died",
+                pid=pid,
+                worker=worker,
+                exit_code=os.waitstatus_to_exitcode(status),
+            )
+            time.sleep(max(started + RESTART_INTERVAL - time.monotonic(), 0))
+            if not self.stopping:
+                self._spawn(worker)
+
+        logger.info("Server stopped")
+
+
+def main() -> None:
+    settings = get_settings()
+    workers = settings.server_workers or available_cpus()
+    worker_settings = get_worker_settings(settings, workers)
+
+    logger.info(
+        "Starting server",
+        workers=workers,
+        pool_size=worker_settings.db_pool_size,
+        max_overflow=worker_settings.db_max_overflow,
+        loop="uvloop" if find_spec("uvloop") else "asyncio",
+        http="httptools" if find_spec("httptools") else "h11",
+    )
+
+    # Bound before forking, so all workers accept connections on the socket
+    sock = uvicorn.Config(
+        None, host=settings.server_host, port=settings.server_port
+    ).bind_socket()
+    sock.set_inheritable(True)
+
+    Server(
+        worker_settings,
+        workers,
+        sock,
+        jwk_set=preload_jwks(settings),
+        metadata=preload_metadata(settings),
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
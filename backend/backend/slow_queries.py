@@ -0,0 +1,259 @@
+"""
+Opt-in slow query log. Statements taking longer than a threshold are logged
+with the SQL, the shape of the parameters (not the values), the duration and
+the route of the request, and a sample of the slow SELECTs are run again with
+EXPLAIN (ANALYZE, BUFFERS) to capture the plan Postgres picked.
+
+The records are appended to the log file by a background thread, since they
+are recorded in the DB event hooks, i.e. on the event loop.
+"""
+import json
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from sqlalchemy import Engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Receive, Scope, Send
+from structlog import get_logger
+
+logger = get_logger()
+
+# The ASGI scope of the request being handled (see RouteContextMiddleware)
+_request_scope: ContextVar[Scope | None] = ContextVar("request_scope", default=None)
+
+_SAVEPOINT = "slow_query_explain"
+
+# Statements which are safe to execute again (a WITH query may contain data
+# modifying statements)
+_READ_ONLY = re.compile(r"\s*\(*\s*(SELECT|WITH)\b", re.IGNORECASE)
+_DATA_MODIFYING = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE)\b", re.IGNORECASE)
+
+
+def current_route() -> str | None:
+    """
+    Get the method and route (path template if the request has been routed)
+    of the request being handled, e.g. "GET /backend/category/{cat_id}".
+    """
+    scope = _request_scope.get()
+    if scope is None:
+        return None
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else scope['path']}"
+
+
+class RouteContextMiddleware:
+    """
+    ASGI middleware making the request available to the slow query recorder
+    (which runs in the DB event hooks, i.e. without access to the request).
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_scope.reset(token)
+
+
+def params_shape(parameters: Any, executemany: bool = False) -> Any:
+    """
+    Get the shape of the statement parameters, i.e. the parameter names (or
+    positions) and the types of the values, which is enough to reproduce a
+    plan without logging any (possibly sensitive) values.
+    """
+    if executemany:
+        rows = list(parameters)
+        return {"rows": len(rows), "row": params_shape(rows[0]) if rows else None}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+@dataclass
+class SlowQuery:
+    # Unix time of the end of the execution
+    timestamp: float
+    # Seconds until the statement returned its (first) rows
+    duration: float
+    statement: str
+    params: Any
+    route: str | None
+    # Output of EXPLAIN (ANALYZE, BUFFERS) if captured
+    plan: str | None = None
+
+
+class SlowQueryRecorder:
+    """
+    Records the statements taking longer than the threshold. The latest
+    records are kept in a ring buffer and optionally appended to a file (one
+    JSON object per line) by a background thread. The thread is stopped with
+    close().
+
+    Capturing the plan executes the statement again, which adds to the
+    latency of the request and to the load on the DB, so it is only done for
+    a sample of the slow statements and never for other statements than
+    SELECTs (which might have side effects), for executemany or for
+    statements streamed from a server-side cursor (which is still open on
+    the connection).
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        explain_sample_rate: float = 0.1,
+        max_records: int = 100,
+        log_file: Path | None = None,
+        sample: Callable[[], float] = random.random,
+    ):
+        """
+        :param threshold: number of seconds before a statement is slow
+        :param explain_sample_rate: fraction of the slow SELECTs to capture
+            the plan of
+        :param max_records: number of records kept in memory
+        :param log_file: file to append the records to
+        :param sample: function returning a random number in [0, 1)
+        """
+        self.threshold = threshold
+        self.explain_sample_rate = explain_sample_rate
+        self.log_file = log_file
+        self.sample = sample
+
+        self._records: deque[SlowQuery] = deque(maxlen=max_records)
+        # The records to append to the log file (None stops the writer) and
+        # the thread writing them (started by the first record)
+        self._log_queue: queue.SimpleQueue[SlowQuery | None] = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+
+    @property
+    def records(self) -> list[SlowQuery]:
+        """
+        The recorded slow queries (newest first).
+        """
+        return list(reversed(self._records))
+
+    def attach(self, engine: Engine | AsyncEngine) -> None:
+        sync_engine = (
+            engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+        )
+
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def before_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany
+        ):
+            conn.info["slow_query_start"] = time.perf_counter()
+
+        @event.listens_for(sync_engine, "after_cursor_execute")
+        def after_cursor_execute(
+            conn, cursor, statement, parameters, context, executemany
+        ):
+            start = conn.info.pop("slow_query_start", None)
+            if start is None:
+                return
+            duration = time.perf_counter() - start
+            if duration >= self.threshold:
+                self._record(conn, statement, parameters, context, executemany, duration)
+
+    def _should_explain(self, statement: str, context: Any, executemany: bool) -> bool:
+        if executemany or context is None:
+            return False
+        if context.execution_options.get("stream_results", False):
+            return False
+        if not _READ_ONLY.match(statement) or _DATA_MODIFYING.search(statement):
+            return False
+        return self.sample() < self.explain_sample_rate
+
+    def _explain(self, conn, statement: str, parameters: Any) -> str | None:
+        # Use a new cursor on the connection (the rows of the slow statement
+        # have not been fetched yet) and a savepoint, so a failing EXPLAIN
+        # does not abort the transaction of the request
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(f"SAVEPOINT {_SAVEPOINT}")
+            try:
+                cursor.execute(
+                    "EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters
+                )
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {_SAVEPOINT}")
+                raise
+            cursor.execute(f"RELEASE SAVEPOINT {_SAVEPOINT}")
+            return plan
+        except Exception as err:
+            logger.warning("Could not explain slow query", error=str(err))
+            return None
+        finally:
+            cursor.close()
+
+    def _record(
+        self,
+        conn,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+        duration: float,
+    ) -> None:
+        record = SlowQuery(
+            timestamp=time.time(),
+            duration=duration,
+            statement=statement,
+            params=params_shape(parameters, executemany),
+            route=current_route(),
+        )
+        if self._should_explain(statement, context, executemany):
+            record.plan = self._explain(conn, statement, parameters)
+
+        self._records.append(record)
+        logger.warning(
+            "Slow query",
+            duration=record.duration,
+            statement=record.statement,
+            params=record.params,
+            route=record.route,
+            explained=record.plan is not None,
+        )
+        if self.log_file is not None:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_log, name="slow-query-log", daemon=True
+                )
+                self._writer.start()
+            self._log_queue.put(record)
+
+    def _write_log(self) -> None:
+        while (record := self._log_queue.get()) is not None:
+            try:
+                with open(self.log_file, "a") as fp:
+                    fp.write(json.dumps(asdict(record)) + "\n")
+            except OSError as err:
+                logger.warning(
+                    "Could not write slow query log",
+                    path=str(self.log_file),
+                    error=str(err),
+                )
+
+    def close(self) -> None:
+        """
+        Write the remaining records to the log file and stop the writer.
+        """
+        if self._writer is not None:
+            self._log_queue.put(None)
+            self._writer.join()
+            self._writer = None
@@ -0,0 +1,187 @@
+"""
+Timing of the app startup, i.e. how long it takes from starting a worker to
+serving the first request.
+
+The startup phases of every app (see create_app and the lifespan in
+backend.main) are timed with a StartupTimer and logged when the app is ready.
+For a full profile, including the import time of every module and the time
+to serve the first request, run (with the usual environment variables):
+
+    python -m backend.startup
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Awaitable, Iterator, TypeVar
+
+from structlog import get_logger
+
+logger = get_logger()
+
+T = TypeVar("T")
+
+
+class StartupTimer:
+    """
+    Records the duration of the startup phases (in seconds).
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self._last_lap = self.started
+
+    def lap(self, name: str) -> None:
+        """
+        Record the time since the previous lap (or the start) as a phase.
+        """
+        now = time.perf_counter()
+        self.phases[name] = now - self._last_lap
+        self._last_lap = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        """
+        Await the awaitable as a phase (e.g. to time concurrent phases).
+        """
+        with self.phase(name):
+            return await awaitable
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def log(self) -> None:
+        logger.info(
+            "App started",
+            total=round(self.total, 4),
+            **{name: round(seconds, 4) for name, seconds in self.phases.items()},
+        )
+
+
+def profile_imports(module: str) -> list[tuple[str, float, float]]:
+    """
+    Import the module in a new interpreter with -X importtime.
+
+    :param module: the module to import
+    :return: the imported modules with their own and cumulative import
+        times (in seconds) in import order
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    for line in process.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line.removeprefix("import time:").split("|")
+        imports.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6))
+    return imports
+
+
+async def _first_request(app, path: str) -> int:
+    # A minimal ASGI request, i.e. without an HTTP client
+    status = 0
+
+    async def receive() -> dict:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(
+        {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"localhost")],
+            "client": ("127.0.0.1", 0),
+            "server": ("localhost", 80),
+        },
+        receive,
+        send,
+    )
+    return status
+
+
+async def profile_app(path: str) -> StartupTimer:
+    """
+    Create and start the app and serve the first request.
+
+    :param path: the path of the first request
+    :return: the timer with the startup phases
+    """
+    timer = StartupTimer()
+    from backend.main import create_app
+
+    timer.lap("import")
+    app = create_app(startup_timer=timer)
+    async with app.router.lifespan_context(app):
+        with timer.phase("first_request"):
+            status = await _first_request(app, path)
+        if status != 200:
+            logger.warning("First request failed", path=path, status=status)
+    return timer
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Profile the startup of the app",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--module", default="backend.main", help="Module to profile the imports of"
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="Number of slowest modules to show"
+    )
+    parser.add_argument(
+        "--path", default="/backend/", help="Path of the first request"
+    )
+    args = parser.parse_args()
+
+    imports = profile_imports(args.module)
+    packages: dict[str, float] = defaultdict(float)
+    for name, own, _ in imports:
+        packages[name.partition(".")[0]] += own
+
+    print(f"Import of {args.module}: {imports[-1][2]:.3f}s")
+    print("\nSlowest packages (import time of all their modules):")
+    for name, seconds in sorted(packages.items(), key=lambda p: -p[1])[: args.top]:
+        print(f"  {seconds:8.4f}s  {name}")
+    print("\nSlowest modules (own import time):")
+    for name, own, cumulative in sorted(imports, key=lambda i: -i[1])[: args.top]:
+        print(f"  {own:8.4f}s  {name} (cumulative {cumulative:.4f}s)")
+
+    timer = asyncio.run(profile_app(args.path))
+    print("\nStartup phases:")
+    for name, seconds in timer.phases.items():
+        print(f"  {seconds:8.4f}s  {name}")
+    print(f"  {timer.total:8.4f}s  total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from pathlib import Path
+
+from structlog import get_logger
+
+logger = get_logger()
+
+
+def _find_bin_dir() -> Path:
+    """
+    Find the directory of the Postgres server binaries (initdb, pg_ctl), i.e.
+    the directory of the binaries in the PATH or the one given by pg_config.
+    """
+    initdb = shutil.which("initdb")
+    if initdb is not None:
+        return Path(initdb).parent
+
+    pg_config = shutil.which("pg_config")
+    if pg_config is not None:
+        bin_dir = subprocess.run(
+            [pg_config, "--bindir"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        return Path(bin_dir)
+
+    raise RuntimeError(
+        "Could not find the Postgres binaries (initdb/pg_ctl) - add them to "
+        "the PATH or use an existing DB instead"
+    )
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+class LocalPostgres:
+    """
+    A throwaway Postgres cluster in a temporary directory, for running the
+    benchmarks against. The cluster is stopped and removed on exit. Note
+    that Postgres refuses to run as root.
+
+    Usage:
+
+        with LocalPostgres() as pg:
+            ... connect to localhost:pg.port as pg.user ...
+    """
+
+    def __init__(self, user: str = "app", database: str = "app"):
+        self.user = user
+        self.database = database
+        self.port = _free_port()
+        self.bin_dir = _find_bin_dir()
+        self._tmp_dir: tempfile.TemporaryDirectory | None = None
+
+    def _run(self, name: str, *args: str) -> None:
+        subprocess.run(
+            [str(self.bin_dir / name), *args],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+    def __enter__(self) -> "LocalPostgres":
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="benchmark-pg-")
+        data_dir = os.path.join(self._tmp_dir.name, "data")
+
+        logger.info("Start local Postgres", port=self.port, data_dir=data_dir)
+        self._run(
+            "initdb",
+            "-D", data_dir,
+            "-U", self.user,
+            "--auth=trust",
+            "--encoding=UTF8",
+            "--locale=C",
+        )
+        self._run(
+            "pg_ctl",
+            "-D", data_dir,
+            "-l", os.path.join(self._tmp_dir.name, "postgres.log"),
+            "-o", (
+                f"-p {self.port} -k {self._tmp_dir.name} "
+                "-c listen_addresses=localhost -c max_connections=500 "
+                "-c fsync=off -c synchronous_commit=off"
+            ),
+            "-w",
+            "start",
+        )
+        self._run(
+            "createdb",
+            "-h", "localhost",
+            "-p", str(self.port),
+            "-U", self.user,
+            self.database,
+        )
+        return self
+
+    def __exit__(self, *exc) -> None:
+        try:
+            self._run(
+                "pg_ctl",
+                "-D", os.path.join(self._tmp_dir.name, "data"),
+                "-m", "fast",
+                "-w",
+                "stop",
+            )
+        finally:
+            self._tmp_dir.cleanup()
@@ -0,0 +1,340 @@
+"""
+In-process load and latency benchmarks of the backend.
+
+The app is created with create_app() and driven through an ASGI transport
+(i.e. no network) with tokens signed by the mock Keycloak key in
+tests/mocking/auth and a local JWKS stand-in. By default, a throwaway
+Postgres cluster is spawned locally (requires the Postgres binaries and a
+non-root user), migrated with Alembic and populated with synthetic
+data (see development.db_data).
+
+Usage (from the backend directory):
+
+    python -m benchmarks.run --concurrency 1 10 50 --scale 0.1
+
+Settings can be overridden to benchmark alternatives against each other, e.g.
+
+    python -m benchmarks.run --set db_driver=asyncpg --set response_cache_ttl=0
+
+The results can be saved with --output and later runs compared against them
+with --baseline (the exit code is 1 if a regression is found).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import httpx
+import jwt
+from alembic import command
+from alembic.config import Config
+from cryptography.hazmat.primitives import serialization
+from jwt.algorithms import RSAAlgorithm
+from pydantic import SecretStr
+from structlog import get_logger
+
+from backend.config import Settings, get_settings
+from backend.db import get_conninfo
+from backend.main import create_app
+from benchmarks.postgres import LocalPostgres
+from development.db_data import populate
+
+logger = get_logger()
+
+BACKEND_DIR = Path(__file__).parent.parent
+KEY_DIR = BACKEND_DIR / "tests" / "mocking" / "auth"
+
+REALM = "app"
+KID = "benchmark"
+
+DEFAULT_ENDPOINTS = (
+    "/backend/",
+    "/backend/require/auth",
+    "/backend/categories",
+)
+
+
+@dataclass
+class Result:
+    endpoint: str
+    concurrency: int
+    requests: int
+    errors: int
+    # Requests per second
+    throughput: float
+    # Latencies in milliseconds
+    p50: float
+    p95: float
+    p99: float
+
+
+def get_jwk_set() -> jwt.PyJWKSet:
+    """
+    Get the JWKS with the public mock Keycloak key (used instead of fetching
+    the JWKS from Keycloak).
+    """
+    with open(KEY_DIR / "jwtRS256.key.pub", "rb") as fp:
+        public_key = serialization.load_pem_public_key(fp.read())
+    jwk = RSAAlgorithm.to_jwk(public_key, as_dict=True)
+    jwk.update({"kid": KID, "alg": "RS256", "use": "sig"})
+    return jwt.PyJWKSet.from_dict({"keys": [jwk]})
+
+
+def generate_tokens(n: int) -> list[str]:
+    """
+    Generate n distinct tokens signed by the private mock Keycloak key.
+    """
+    with open(KEY_DIR / "jwtRS256.key", "rb") as fp:
+        private_key = fp.read()
+    now = int(time.time())
+    return [
+        jwt.encode(
+            {
+                "sub": f"user{i}",
+                "preferred_username": f"user{i}",
+                "iat": now,
+                "exp": now + 3600,
+                "iss": f"http://localhost:8080/auth/realms/{REALM}",
+            },
+            private_key,
+            algorithm="RS256",
+            headers={"kid": KID},
+        )
+        for i in range(n)
+    ]
+
+
+def migrate(settings: Settings) -> None:
+    # The Alembic env reads the DB settings from the environment
+    os.environ.update(
+        {
+            "DB_HOST": settings.db_host,
+            "DB_PORT": str(settings.db_port),
+            "DB_NAME": settings.db_name,
+            "DB_USER": settings.db_user,
+            "DB_PASSWORD": settings.db_password.get_secret_value(),
+        }
+    )
+    config = Config(str(BACKEND_DIR / "alembic.ini"))
+    config.set_main_option("script_location", str(BACKEND_DIR / "alembic"))
+    command.upgrade(config, "head")
+
+
+async def run_load(
+    client: httpx.AsyncClient,
+    endpoint: str,
+    tokens: list[str],
+    concurrency: int,
+    requests: int,
+) -> Result:
+    latencies: list[float] = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker() -> None:
+        nonlocal errors
+        while (i := next(counter)) < requests:
+            headers = {"Authorization": f"Bearer {tokens[i % len(tokens)]}"}
+            start = time.perf_counter()
+            response = await client.get(endpoint, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return Result(
+        endpoint=endpoint,
+        concurrency=concurrency,
+        requests=requests,
+        errors=errors,
+        throughput=requests / duration,
+        p50=quantiles[49] * 1000,
+        p95=quantiles[94] * 1000,
+        p99=quantiles[98] * 1000,
+    )
+
+
+async def benchmark(
+    settings: Settings,
+    endpoints: list[str],
+    concurrencies: list[int],
+    requests: int,
+    warmup: int,
+    tokens: list[str],
+) -> list[Result]:
+    app = create_app(settings=settings)
+    # Local JWKS stand-in, i.e. Keycloak is not needed
+    app.extra["jwks"].fetch = get_jwk_set
+
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            for endpoint in endpoints:
+                await run_load(client, endpoint, tokens, 1, warmup)
+                for concurrency in concurrencies:
+                    result = await run_load(
+                        client, endpoint, tokens, concurrency, requests
+                    )
+                    logger.info("Benchmarked", **asdict(result))
+                    results.append(result)
+    return results
+
+
+def find_regressions(
+    results: list[Result], baseline: list[dict], max_regression: float
+) -> list[str]:
+    """
+    Compare the results with a baseline. A regression is a drop in
+    throughput or a rise in p95 latency of more than max_regression percent.
+    """
+    baseline_by_key = {(b["endpoint"], b["concurrency"]): b for b in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get((result.endpoint, result.concurrency))
+        if base is None:
+            continue
+        throughput_change = (result.throughput / base["throughput"] - 1) * 100
+        p95_change = (result.p95 / base["p95"] - 1) * 100
+        if throughput_change < -max_regression or p95_change > max_regression:
+            regressions.append(
+                f"{result.endpoint} (concurrency {result.concurrency}): "
+                f"throughput {throughput_change:+.1f}%, p95 {p95_change:+.1f}%"
+            )
+    return regressions
+
+
+def print_results(results: list[Result]) -> None:
+    header = (
+        f"{'endpoint':<40} {'conc':>5} {'reqs':>7} {'errors':>6} "
+        f"{'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r.endpoint:<40} {r.concurrency:>5} {r.requests:>7} {r.errors:>6} "
+            f"{r.throughput:>9.1f} {r.p50:>8.2f} {r.p95:>8.2f} {r.p99:>8.2f}"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        dest="endpoints",
+        help=f"Endpoint to benchmark (default: {', '.join(DEFAULT_ENDPOINTS)})",
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument(
+        "--requests", type=int, default=2000, help="Requests per endpoint and concurrency"
+    )
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument(
+        "--tokens",
+        type=int,
+        default=1,
+        help="Number of distinct tokens to send (exercises the claims cache)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=0.01,
+        help="Scale factor of the synthetic data (see development.db_data)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="SETTING=VALUE",
+        help="Override a setting, e.g. db_driver=asyncpg",
+    )
+    parser.add_argument(
+        "--db-host",
+        help="Use an existing (empty or disposable!) DB instead of a local cluster",
+    )
+    parser.add_argument("--db-port", type=int, default=5432)
+    parser.add_argument("--db-name", default="app")
+    parser.add_argument("--db-user", default="app")
+    parser.add_argument("--db-password", default="secret")
+    parser.add_argument("--no-populate", action="store_true")
+    parser.add_argument("--output", type=Path, help="Save the results as JSON")
+    parser.add_argument("--baseline", type=Path, help="Compare with saved results")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=10,
+        help="Max allowed regression (in percent) compared to the baseline",
+    )
+    return parser.parse_args()
+
+
+def run(args: argparse.Namespace, db_host: str, db_port: int, db_user: str) -> int:
+    overrides = dict(setting.split("=", 1) for setting in args.set)
+    settings = get_settings(
+        db_host=db_host,
+        db_port=db_port,
+        db_name=args.db_name,
+        db_user=db_user,
+        db_password=SecretStr(args.db_password),
+        auth_host="localhost",
+        auth_port=8080,
+        auth_http_schema="http",
+        auth_realm=REALM,
+        auth_client_id=REALM,
+        **overrides,
+    )
+
+    migrate(settings)
+    if not args.no_populate:
+        populate(get_conninfo(settings), scale=args.scale, seed=args.seed)
+
+    results = asyncio.run(
+        benchmark(
+            settings,
+            args.endpoints or list(DEFAULT_ENDPOINTS),
+            args.concurrency,
+            args.requests,
+            args.warmup,
+            generate_tokens(args.tokens),
+        )
+    )
+    print_results(results)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps([asdict(r) for r in results], indent=2))
+
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = find_regressions(results, baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+def main() -> int:
+    args = parse_args()
+    if args.db_host is not None:
+        return run(args, args.db_host, args.db_port, args.db_user)
+    with LocalPostgres(user=args.db_user, database=args.db_name) as pg:
+        return run(args, "localhost", pg.port, pg.user)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from pydantic import PositiveInt, SecretStr
+from pydantic import NonNegativeFloat, PositiveInt, SecretStr
 from pydantic_settings import BaseSettings
 
 
@@ -8,6 +8,16 @@ class Settings(BaseSettings):
     db_name: str
     db_user: str
     db_password: SecretStr
+    # Amount of synthetic data (scale 1 is 10,000 categories and 1,000,000
+    # items and texts, see development.db_data)
+    data_scale: NonNegativeFloat = 0.001
+    # Seed of the synthetic data (the same seed gives the same data)
+    data_seed: int = 0
+    # Skew of the category sizes (0 means all categories have about the same
+    # number of texts)
+    data_skew: NonNegativeFloat = 1.1
+    # Number of rows per COPY
+    data_batch_size: PositiveInt = 100_000
 
 
 def get_settings(*args, **kwargs) -> Settings:
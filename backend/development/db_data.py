@@ -1,50 +1,240 @@
-from sqlalchemy import insert, create_engine, MetaData, delete
-from sqlalchemy.orm import Session
+"""
+Populate the DB with synthetic data for development and benchmarks.
+
+The amount of data is given by the scale factor (DATA_SCALE). Scale 1 is
+10,000 categories and 1,000,000 items, each with a text in one to three
+categories. The category sizes are skewed (Zipf-like, see DATA_SKEW), i.e. a
+few categories have most of the texts, and the text lengths vary from a few
+words to a few thousand (log-normal). The data only depends on the seed
+(DATA_SEED), so the same dataset can be generated again to reproduce a
+problem.
+
+The rows are loaded with COPY FROM STDIN in batches into the truncated tables
+(all existing data is deleted!).
+"""
+import random
+import time
+from itertools import accumulate
+from typing import Iterable, Iterator
+
+import psycopg
+from more_itertools import chunked
+from psycopg.conninfo import make_conninfo
 from structlog import get_logger
 
-from development.config import get_settings
+from development.config import Settings, get_settings
 
+logger = get_logger()
 
-if __name__ == "__main__":
-    logger = get_logger()
+# Number of categories and items (each with a text) at scale factor 1
+CATEGORIES_PER_SCALE = 10_000
+ITEMS_PER_SCALE = 1_000_000
 
-    logger.info("Get settings...")
-    settings = get_settings()
+# The first categories (always present, whatever the scale)
+EXAMPLE_CATEGORIES = (
+    ("Cars", "Some great cars"),
+    ("Numbers", "Our favorite numbers"),
+    ("Houses", "Some cool houses"),
+)
+
+# Max number of categories of a text
+MAX_CATEGORIES_PER_TEXT = 3
+
+# Parameters of the log-normal distribution of the number of words of a text
+# (median of about 55 words, but with a long tail)
+TEXT_WORDS_MU = 4.0
+TEXT_WORDS_SIGMA = 1.0
+TEXT_WORDS_MAX = 5000
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+    "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+    "consequat duis aute irure in reprehenderit voluptate velit esse cillum "
+    "eu fugiat nulla pariatur excepteur sint occaecat cupidatat non proident "
+    "sunt culpa qui officia deserunt mollit anim id est laborum"
+).split()
+
+
+def get_counts(scale: float) -> tuple[int, int]:
+    """
+    Get the number of categories and items at the given scale.
+    """
+    categories = max(len(EXAMPLE_CATEGORIES), round(CATEGORIES_PER_SCALE * scale))
+    items = round(ITEMS_PER_SCALE * scale)
+    return categories, items
+
+
+def _words(rng: random.Random, n: int, max_length: int | None = None) -> str:
+    words = " ".join(rng.choices(WORDS, k=n))
+    return words if max_length is None else words[:max_length].rstrip()
+
+
+def generate_categories(rng: random.Random, n: int) -> Iterator[tuple]:
+    for id_, (name, description) in enumerate(EXAMPLE_CATEGORIES, start=1):
+        yield id_, name, description
+    for id_ in range(len(EXAMPLE_CATEGORIES) + 1, n + 1):
+        name = f"{rng.choice(WORDS).title()} {id_}"
+        yield id_, name, _words(rng, rng.randint(3, 30), max_length=200)
+
+
+def generate_items(rng: random.Random, n: int) -> Iterator[tuple]:
+    for id_ in range(1, n + 1):
+        # The names must fit in 30 characters
+        words = f"{rng.choice(WORDS).title()} {rng.choice(WORDS)}"
+        name = f"{words[:20].rstrip()} {id_}"
+        # Some items have no description
+        description = (
+            _words(rng, rng.randint(2, 15), max_length=100)
+            if rng.random() < 0.9
+            else None
+        )
+        yield id_, name, description
+
+
+def generate_texts(rng: random.Random, n: int) -> Iterator[tuple]:
+    for id_ in range(1, n + 1):
+        words = int(rng.lognormvariate(TEXT_WORDS_MU, TEXT_WORDS_SIGMA))
+        yield id_, _words(rng, min(max(words, 1), TEXT_WORDS_MAX))
+
+
+def generate_category_texts(
+    rng: random.Random, texts: int, categories: int, skew: float
+) -> Iterator[tuple]:
+    """
+    Put each text in one to MAX_CATEGORIES_PER_TEXT categories. The category
+    of rank r (in a random order of the categories) is picked with a weight
+    of 1 / r^skew.
+    """
+    ranked = list(range(1, categories + 1))
+    rng.shuffle(ranked)
+    cum_weights = list(accumulate(1 / rank**skew for rank in range(1, categories + 1)))
+    max_per_text = min(MAX_CATEGORIES_PER_TEXT, categories)
 
-    logger.info("Create engine...")
-    engine = create_engine(
-        f"postgresql+psycopg://"
-        f"{settings.db_user}:{settings.db_password.get_secret_value()}"
-        f"@{settings.db_host}/{settings.db_name}"
+    for text_id in range(1, texts + 1):
+        k = rng.randint(1, max_per_text)
+        for cat_id in sorted(set(rng.choices(ranked, cum_weights=cum_weights, k=k))):
+            yield cat_id, text_id
+
+
+def copy_rows(
+    connection: psycopg.Connection,
+    table: str,
+    columns: tuple[str, ...],
+    rows: Iterable[tuple],
+    batch_size: int,
+) -> int:
+    """
+    Load the rows into the table with COPY FROM STDIN (one COPY per batch).
+    The table must have been truncated in the current transaction (the rows
+    are frozen, i.e. they do not need to be vacuumed before being visible to
+    index-only scans).
+    """
+    start = time.perf_counter()
+    count = 0
+    with connection.cursor() as cursor:
+        for batch in chunked(rows, batch_size):
+            with cursor.copy(
+                f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FREEZE)"
+            ) as copy:
+                for row in batch:
+                    copy.write_row(row)
+            count += len(batch)
+            logger.debug("Copied batch", table=table, rows=count)
+    logger.info(
+        "Copied rows", table=table, rows=count, seconds=time.perf_counter() - start
     )
+    return count
+
+
+def populate(
+    conninfo: str,
+    scale: float,
+    seed: int = 0,
+    skew: float = 1.1,
+    batch_size: int = 100_000,
+) -> None:
+    """
+    Replace all data in the DB with synthetic data.
+
+    Args:
+        conninfo: the libpq connection string of the DB
+        scale: the scale factor (see the module docstring)
+        seed: the seed of the random data
+        skew: the skew of the category sizes (0 means uniform)
+        batch_size: number of rows per COPY
+    """
+    categories, items = get_counts(scale)
+    logger.info("Populate tables", categories=categories, items=items, seed=seed)
+
+    def rng(table: str) -> random.Random:
+        # One generator per table, so each table only depends on the seed
+        return random.Random(f"{seed}-{table}")
 
-    logger.info("Reflect DB tables...")
-    metadata_obj = MetaData()
-    metadata_obj.reflect(bind=engine)
-
-    category = metadata_obj.tables["category"]
-
-    logger.info("Populate tables...")
-    with Session(engine) as session:
-        session.execute(delete(category))
-        session.execute(
-            insert(category),
-            [
-                {
-                    "name": "Cars",
-                    "description": "Some great cars"
-                },
-                {
-                    "name": "Numbers",
-                    "description": "Our favorite numbers"
-                },
-                {
-                    "name": "Houses",
-                    "description": "Some cool houses"
-                }
-            ]
+    with psycopg.connect(conninfo) as connection:
+        connection.execute(
+            "TRUNCATE category_text, text, item, category RESTART IDENTITY"
         )
+        copy_rows(
+            connection,
+            "category",
+            ("id", "name", "description"),
+            generate_categories(rng("category"), categories),
+            batch_size,
+        )
+        copy_rows(
+            connection,
+            "item",
+            ("id", "name", "description"),
+            generate_items(rng("item"), items),
+            batch_size,
+        )
+        copy_rows(
+            connection,
+            "text",
+            ("id", "txt"),
+            generate_texts(rng("text"), items),
+            batch_size,
+        )
+        copy_rows(
+            connection,
+            "category_text",
+            ("cat_id", "text_id"),
+            generate_category_texts(rng("category_text"), items, categories, skew),
+            batch_size,
+        )
+
+        # The IDs were set explicitly, so the sequences must be moved past them
+        for table, max_id in (("category", categories), ("item", items)):
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), %s, %s)",
+                (table, max(max_id, 1), max_id > 0),
+            )
 
-        session.commit()
+    with psycopg.connect(conninfo, autocommit=True) as connection:
+        connection.execute("ANALYZE category, item, text, category_text")
+
+
+def get_conninfo(settings: Settings) -> str:
+    return make_conninfo(
+        host=settings.db_host,
+        port=settings.db_port,
+        dbname=settings.db_name,
+        user=settings.db_user,
+        password=settings.db_password.get_secret_value(),
+    )
+
+
+if __name__ == "__main__":
+    logger.info("Get settings...")
+    settings = get_settings()
+
+    populate(
+        get_conninfo(settings),
+        scale=settings.data_scale,
+        seed=settings.data_seed,
+        skew=settings.data_skew,
+        batch_size=settings.data_batch_size,
+    )
 
     logger.info("Done!")
@@ -8,6 +8,8 @@ if [ "$ENVIRONMENT" = "development" ]; then
     echo "Running in development mode (hot-reload)"
     uvicorn --factory backend.main:create_app --host 0.0.0.0 --reload
 else
+    # One worker process per CPU (see SERVER_WORKERS and DB_CONNECTION_BUDGET
+    # in backend/config.py)
     echo "Running in production mode"
-    uvicorn --factory backend.main:create_app --host 0.0.0.0
+    python -m backend.server
 fi
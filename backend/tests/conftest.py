@@ -0,0 +1,56 @@
+"""
+Fixtures of the tests needing a disposable Postgres DB (it is migrated and
+its data may be replaced!). Either set TEST_DB_CONNINFO to the libpq
+connection string of such a DB or put the Postgres binaries in the PATH (a
+throwaway cluster is then spawned). Otherwise the tests are skipped.
+"""
+import os
+import shutil
+from typing import Iterator
+
+import pytest
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+from pydantic import SecretStr
+
+from backend.config import Settings, get_settings
+
+
+@pytest.fixture(scope="session")
+def conninfo() -> Iterator[str]:
+    conninfo = os.environ.get("TEST_DB_CONNINFO")
+    if conninfo is not None:
+        yield conninfo
+        return
+
+    if shutil.which("initdb") is None or os.geteuid() == 0:
+        pytest.skip("Needs TEST_DB_CONNINFO or the Postgres binaries (as non-root)")
+
+    from benchmarks.postgres import LocalPostgres
+
+    with LocalPostgres() as pg:
+        yield make_conninfo(
+            host="localhost", port=pg.port, dbname=pg.database, user=pg.user
+        )
+
+
+@pytest.fixture(scope="session")
+def db_settings(conninfo: str) -> Settings:
+    """
+    The settings of the (migrated) test DB.
+    """
+    from benchmarks.run import migrate
+
+    params = conninfo_to_dict(conninfo)
+    settings = get_settings(
+        db_host=params.get("host", "localhost"),
+        db_port=int(params.get("port", 5432)),
+        db_name=params.get("dbname", "app"),
+        db_user=params.get("user", "app"),
+        db_password=SecretStr(params.get("password", "")),
+        auth_host="localhost",
+        auth_port=8080,
+        auth_realm="app",
+        auth_client_id="app",
+    )
+    migrate(settings)
+    return settings
@@ -5,15 +5,32 @@ from datetime import datetime
 import jwt
 from cryptography.hazmat.primitives import serialization
 from fastapi.exceptions import HTTPException
+from jwt.exceptions import DecodeError
 from jwt.exceptions import ExpiredSignatureError
+from jwt.exceptions import ImmatureSignatureError
+from jwt.exceptions import InvalidAlgorithmError
 from jwt.exceptions import InvalidAudienceError
+from jwt.exceptions import InvalidIssuerError
 from jwt.exceptions import InvalidSignatureError
 from jwt.exceptions import InvalidTokenError
+from jwt.algorithms import RSAAlgorithm
+from jwt.exceptions import PyJWKClientConnectionError
+from jwt.exceptions import PyJWKClientError
 from jwt.exceptions import PyJWTError
 from starlette.status import HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_403_FORBIDDEN
 from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR
 
-from backend.auth import AuthenticationError, get_auth_dependency
+from backend.auth import (
+    AuthenticationError,
+    ClaimsCache,
+    JWKSKeyStore,
+    TokenVerifier,
+    get_auth_dependency,
+    get_role_dependency,
+    precheck_token,
+)
+from backend.config import VerificationMode
 
 
 class TestOIDC(unittest.TestCase):
@@ -90,7 +107,7 @@ class TestOIDC(unittest.TestCase):
     #     )
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_auth_decodes_token(self, mock_get_signing_key_from_jwt):
         # Mock the public signing.key used in the auth function
@@ -104,7 +121,7 @@ class TestOIDC(unittest.TestCase):
         self.assertEqual(self.parsed_token, actual_token)
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_leeway(self, mock_get_signing_key_from_jwt):
         # Mock the public signing.key used in the auth function
@@ -119,7 +136,7 @@ class TestOIDC(unittest.TestCase):
         assert self.loop.run_until_complete(self.auth(token))
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_raise_exception_for_invalid_signature(
         self,
@@ -139,7 +156,7 @@ class TestOIDC(unittest.TestCase):
             assert isinstance(err.exception.exc, InvalidSignatureError)
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_raise_exception_for_expired_token(
         self,
@@ -159,7 +176,7 @@ class TestOIDC(unittest.TestCase):
             assert isinstance(err.exception.exc, ExpiredSignatureError)
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_ensure_get_signing_from_jwt_called(
         self,
@@ -178,7 +195,7 @@ class TestOIDC(unittest.TestCase):
         mock_get_signing_key_from_jwt.assert_called_once_with(token)
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_exception_when_aud_in_token_and_audience_is_not_set(
         self, mock_get_signing_key_from_jwt
@@ -195,7 +212,7 @@ class TestOIDC(unittest.TestCase):
             assert isinstance(err.exception.exc, InvalidAudienceError)
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_token_accepted_when_aud_in_token_and_audience_is_set(
         self, mock_get_signing_key_from_jwt
@@ -218,7 +235,7 @@ class TestOIDC(unittest.TestCase):
         assert self.loop.run_until_complete(auth(token))
 
     @unittest.mock.patch(
-        "backend.auth.PyJWKClient.get_signing_key_from_jwt"
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
     )
     def test_token_accepted_when_aud_in_token_and_verify_aud_is_false(
         self, mock_get_signing_key_from_jwt
@@ -240,6 +257,421 @@ class TestOIDC(unittest.TestCase):
 
         assert self.loop.run_until_complete(auth(token))
 
+    @unittest.mock.patch(
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
+    )
+    def test_verified_token_claims_are_cached(
+        self, mock_get_signing_key_from_jwt
+    ):
+        mock_get_signing_key_from_jwt.side_effect = [self.signing]
+        token = TestOIDC.generate_token(self.parsed_token, self.private_key)
+
+        first = self.loop.run_until_complete(self.auth(token))
+        second = self.loop.run_until_complete(self.auth(token))
+
+        self.assertEqual(self.parsed_token, first)
+        self.assertEqual(self.parsed_token, second)
+        mock_get_signing_key_from_jwt.assert_called_once_with(token)
+
+    @unittest.mock.patch(
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
+    )
+    def test_claims_cache_is_cleared_when_keys_are_rotated(
+        self, mock_get_signing_key_from_jwt
+    ):
+        mock_get_signing_key_from_jwt.side_effect = [self.signing, self.signing]
+        jwks = JWKSKeyStore("http://keycloak:8080/certs")
+        auth = get_auth_dependency(
+            host="keycloak",
+            port=8080,
+            realm="mo",
+            http_schema="http",
+            jwks=jwks,
+        )
+        token = TestOIDC.generate_token(self.parsed_token, self.private_key)
+        self.loop.run_until_complete(auth(token))
+
+        jwks.set_keys(
+            jwt.PyJWKSet.from_dict(
+                {"keys": [{"kty": "oct", "kid": "new", "k": "c2VjcmV0"}]}
+            )
+        )
+        self.loop.run_until_complete(auth(token))
+
+        self.assertEqual(2, mock_get_signing_key_from_jwt.call_count)
+
+    @unittest.mock.patch(
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
+    )
+    def test_expired_token_rejected_before_key_lookup(
+        self, mock_get_signing_key_from_jwt
+    ):
+        self.parsed_token["exp"] = int(datetime.now().timestamp()) - 6
+        token = TestOIDC.generate_token(self.parsed_token, self.private_key)
+
+        with self.assertRaises(AuthenticationError) as err:
+            self.loop.run_until_complete(self.auth(token))
+
+        self.assertIsInstance(err.exception.exc, ExpiredSignatureError)
+        mock_get_signing_key_from_jwt.assert_not_called()
+
+    @unittest.mock.patch(
+        "backend.auth.JWKSKeyStore.get_signing_key_from_jwt"
+    )
+    def test_token_from_other_realm_rejected_before_key_lookup(
+        self, mock_get_signing_key_from_jwt
+    ):
+        self.parsed_token["iss"] = "http://localhost:8081/auth/realms/other"
+        token = TestOIDC.generate_token(self.parsed_token, self.private_key)
+
+        with self.assertRaises(AuthenticationError) as err:
+            self.loop.run_until_complete(self.auth(token))
+
+        self.assertIsInstance(err.exception.exc, InvalidIssuerError)
+        mock_get_signing_key_from_jwt.assert_not_called()
+
+
+class TestPrecheckToken(unittest.TestCase):
+    def setUp(self) -> None:
+        with open("tests/mocking/auth/jwtRS256.key", "rb") as fp:
+            self.private_key = fp.read()
+        self.now = 1000
+        self.payload = {
+            "exp": 1300,
+            "iss": "http://localhost:8081/auth/realms/mo",
+        }
+
+    def precheck(self, token: str, **kwargs) -> dict:
+        kwargs.setdefault("algorithms", ["RS256"])
+        kwargs.setdefault("realm", "mo")
+        return precheck_token(token, now=self.now, **kwargs)
+
+    def encode(self, algorithm: str = "RS256") -> str:
+        key = self.private_key if algorithm == "RS256" else "secret"
+        return jwt.encode(self.payload, key, algorithm=algorithm)
+
+    def test_plausible_token_passes(self):
+        header = self.precheck(self.encode())
+
+        self.assertEqual("RS256", header["alg"])
+
+    def test_reject_too_large_token(self):
+        with self.assertRaises(DecodeError):
+            self.precheck(self.encode(), max_size=100)
+
+    def test_reject_malformed_token(self):
+        with self.assertRaises(DecodeError):
+            self.precheck("not.a.token")
+
+    def test_reject_disallowed_algorithm(self):
+        with self.assertRaises(InvalidAlgorithmError):
+            self.precheck(self.encode(algorithm="HS256"))
+
+    def test_reject_expired_token(self):
+        self.payload["exp"] = 994
+
+        with self.assertRaises(ExpiredSignatureError):
+            self.precheck(self.encode())
+
+    def test_accept_expired_token_within_leeway(self):
+        self.payload["exp"] = 996
+
+        self.precheck(self.encode())
+
+    def test_reject_immature_token(self):
+        self.payload["nbf"] = 1006
+
+        with self.assertRaises(ImmatureSignatureError):
+            self.precheck(self.encode())
+
+    def test_reject_issuer_from_other_realm(self):
+        self.payload["iss"] = "http://localhost:8081/auth/realms/other"
+
+        with self.assertRaises(InvalidIssuerError):
+            self.precheck(self.encode())
+
+    def test_reject_issuer_not_configured(self):
+        with self.assertRaises(InvalidIssuerError):
+            self.precheck(
+                self.encode(), issuer="http://keycloak:8080/auth/realms/mo"
+            )
+
+    def test_accept_configured_issuer(self):
+        self.precheck(
+            self.encode(), issuer="http://localhost:8081/auth/realms/mo"
+        )
+
+
+class TestClaimsCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 1000.0
+        self.cache = ClaimsCache(maxsize=2, leeway=5, clock=lambda: self.now)
+
+    def test_get_returns_cached_claims(self):
+        self.cache.put("token", {"sub": "bruce", "exp": 1100})
+
+        self.assertEqual({"sub": "bruce", "exp": 1100}, self.cache.get("token"))
+
+    def test_get_returns_none_for_unknown_token(self):
+        self.assertIsNone(self.cache.get("token"))
+
+    def test_entry_is_kept_within_leeway(self):
+        self.cache.put("token", {"sub": "bruce", "exp": 1000})
+        self.now = 1004
+
+        self.assertIsNotNone(self.cache.get("token"))
+
+    def test_entry_is_evicted_when_token_expires(self):
+        self.cache.put("token", {"sub": "bruce", "exp": 1000})
+        self.now = 1006
+
+        self.assertIsNone(self.cache.get("token"))
+        self.assertEqual(0, len(self.cache))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put("token1", {"exp": 1100})
+        self.cache.put("token2", {"exp": 1100})
+        self.cache.get("token1")
+        self.cache.put("token3", {"exp": 1100})
+
+        self.assertIsNotNone(self.cache.get("token1"))
+        self.assertIsNone(self.cache.get("token2"))
+        self.assertIsNotNone(self.cache.get("token3"))
+
+    def test_token_without_exp_is_not_cached(self):
+        self.cache.put("token", {"sub": "bruce"})
+
+        self.assertIsNone(self.cache.get("token"))
+
+    def test_cached_claims_cannot_be_altered_by_caller(self):
+        self.cache.put("token", {"sub": "bruce", "exp": 1100})
+        self.cache.get("token")["sub"] = "hacker"
+
+        self.assertEqual("bruce", self.cache.get("token")["sub"])
+
+
+class TestTokenVerifier(unittest.TestCase):
+    def setUp(self) -> None:
+        with open("tests/mocking/auth/jwtRS256.key.pub", "rb") as fp:
+            self.public_key = serialization.load_pem_public_key(fp.read())
+        with open("tests/mocking/auth/jwtRS256.key", "rb") as fp:
+            private_key = fp.read()
+
+        self.claims = {"sub": "bruce"}
+        self.token = jwt.encode(self.claims, private_key, algorithm="RS256")
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def verify(self, verifier: TokenVerifier) -> dict:
+        try:
+            return self.loop.run_until_complete(
+                verifier.verify(self.token, self.public_key, algorithms=["RS256"])
+            )
+        finally:
+            verifier.shutdown()
+
+    def test_verify_inline(self):
+        verifier = TokenVerifier(mode=VerificationMode.INLINE)
+
+        self.assertEqual(self.claims, self.verify(verifier))
+        self.assertEqual(1, verifier.stats.completed)
+
+    def test_verify_in_thread_pool(self):
+        verifier = TokenVerifier(mode=VerificationMode.THREAD)
+
+        self.assertEqual(self.claims, self.verify(verifier))
+        self.assertEqual(1, verifier.stats.completed)
+        self.assertEqual(0, verifier.stats.in_flight)
+
+    def test_verify_in_process_pool(self):
+        verifier = TokenVerifier(mode=VerificationMode.PROCESS)
+
+        self.assertEqual(self.claims, self.verify(verifier))
+
+    def test_invalid_signature_raised_from_pool(self):
+        with open("tests/mocking/auth/hackers-jwtRS256.key", "rb") as fp:
+            self.token = jwt.encode(self.claims, fp.read(), algorithm="RS256")
+        verifier = TokenVerifier(mode=VerificationMode.THREAD)
+
+        with self.assertRaises(InvalidSignatureError):
+            self.verify(verifier)
+
+    def test_concurrency_is_capped(self):
+        verifier = TokenVerifier(mode=VerificationMode.THREAD, max_concurrency=1)
+
+        async def verify_many():
+            return await asyncio.gather(
+                *(
+                    verifier.verify(
+                        self.token, self.public_key, algorithms=["RS256"]
+                    )
+                    for _ in range(3)
+                )
+            )
+
+        try:
+            results = self.loop.run_until_complete(verify_many())
+        finally:
+            verifier.shutdown()
+
+        self.assertEqual([self.claims] * 3, results)
+        self.assertEqual(2, verifier.stats.max_queued)
+        self.assertEqual(0, verifier.stats.queued)
+
+
+class TestJWKSKeyStore(unittest.TestCase):
+    def setUp(self) -> None:
+        with open("tests/mocking/auth/jwtRS256.key.pub", "rb") as fp:
+            public_key = serialization.load_pem_public_key(fp.read())
+        with open("tests/mocking/auth/jwtRS256.key", "rb") as fp:
+            self.private_key = fp.read()
+
+        jwk = RSAAlgorithm.to_jwk(public_key, as_dict=True)
+        jwk.update({"kid": "kid1", "alg": "RS256", "use": "sig"})
+        self.jwk_set = jwt.PyJWKSet.from_dict({"keys": [jwk]})
+
+        self.jwks = JWKSKeyStore(
+            "http://keycloak:8080/auth/realms/mo/protocol/openid-connect/certs"
+        )
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.run_until_complete(self.jwks.stop())
+        self.loop.close()
+
+    def test_get_signing_key_by_kid(self):
+        self.jwks.set_keys(self.jwk_set)
+
+        key = self.loop.run_until_complete(self.jwks.get_signing_key("kid1"))
+
+        self.assertEqual("kid1", key.key_id)
+
+    def test_get_signing_key_from_jwt(self):
+        self.jwks.set_keys(self.jwk_set)
+        token = jwt.encode(
+            {"sub": "bruce"},
+            self.private_key,
+            algorithm="RS256",
+            headers={"kid": "kid1"},
+        )
+
+        key = self.loop.run_until_complete(
+            self.jwks.get_signing_key_from_jwt(token)
+        )
+
+        self.assertEqual("kid1", key.key_id)
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_raise_exception_for_unknown_kid(self, mock_fetch):
+        mock_fetch.return_value = self.jwk_set
+        self.jwks.set_keys(self.jwk_set)
+
+        with self.assertRaises(PyJWKClientError):
+            self.loop.run_until_complete(self.jwks.get_signing_key("unknown"))
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_unknown_kid_triggers_refetch(self, mock_fetch):
+        mock_fetch.return_value = self.jwk_set
+
+        key = self.loop.run_until_complete(self.jwks.get_signing_key("kid1"))
+
+        self.assertEqual("kid1", key.key_id)
+        mock_fetch.assert_called_once_with()
+        self.assertEqual(1, self.jwks.stats.unknown_kid_lookups)
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_concurrent_unknown_kids_share_one_fetch(self, mock_fetch):
+        mock_fetch.return_value = self.jwk_set
+
+        async def lookup_many():
+            return await asyncio.gather(
+                *(self.jwks.get_signing_key("kid1") for _ in range(10))
+            )
+
+        keys = self.loop.run_until_complete(lookup_many())
+
+        self.assertEqual(["kid1"] * 10, [key.key_id for key in keys])
+        mock_fetch.assert_called_once_with()
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_unknown_kid_is_negatively_cached(self, mock_fetch):
+        mock_fetch.return_value = self.jwk_set
+        self.jwks.min_refetch_interval = 0
+
+        for _ in range(3):
+            with self.assertRaises(PyJWKClientError):
+                self.loop.run_until_complete(self.jwks.get_signing_key("unknown"))
+
+        mock_fetch.assert_called_once_with()
+        self.assertEqual(2, self.jwks.stats.negative_cache_hits)
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_refetch_is_rate_limited(self, mock_fetch):
+        mock_fetch.return_value = self.jwk_set
+
+        for kid in ("random1", "random2", "random3"):
+            with self.assertRaises(PyJWKClientError):
+                self.loop.run_until_complete(self.jwks.get_signing_key(kid))
+
+        mock_fetch.assert_called_once_with()
+        self.assertEqual(2, self.jwks.stats.refetches_rate_limited)
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_start_primes_keys(self, mock_fetch):
+        mock_fetch.return_value = self.jwk_set
+
+        self.loop.run_until_complete(self.jwks.start())
+
+        mock_fetch.assert_called_once_with()
+        self.assertEqual(["kid1"], list(self.jwks.keys))
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_start_does_not_fetch_preloaded_keys(self, mock_fetch):
+        self.jwks.set_keys(self.jwk_set)
+
+        self.loop.run_until_complete(self.jwks.start())
+
+        mock_fetch.assert_not_called()
+        self.assertEqual(["kid1"], list(self.jwks.keys))
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_start_does_not_fail_when_keycloak_is_unreachable(self, mock_fetch):
+        mock_fetch.side_effect = PyJWKClientConnectionError()
+
+        self.loop.run_until_complete(self.jwks.start())
+
+        self.assertEqual({}, self.jwks.keys)
+
+    @unittest.mock.patch("backend.auth.JWKSKeyStore.fetch")
+    def test_failed_refresh_keeps_previous_keys(self, mock_fetch):
+        self.jwks.set_keys(self.jwk_set)
+        mock_fetch.side_effect = PyJWKClientConnectionError()
+
+        with self.assertRaises(PyJWKClientConnectionError):
+            self.loop.run_until_complete(self.jwks.refresh())
+
+        self.assertEqual(["kid1"], list(self.jwks.keys))
+
+
+class TestRoleDependency(unittest.TestCase):
+    def require_role(self, token):
+        async def auth():
+            return token
+
+        return asyncio.run(get_role_dependency(auth, "admin")(token))
+
+    def test_token_with_role_is_returned(self):
+        token = {"realm_access": {"roles": ["user", "admin"]}}
+        self.assertEqual(token, self.require_role(token))
+
+    def test_token_without_role_is_forbidden(self):
+        for token in ({}, {"realm_access": {"roles": ["user"]}}):
+            with self.assertRaises(HTTPException) as err:
+                self.require_role(token)
+            self.assertEqual(HTTP_403_FORBIDDEN, err.exception.status_code)
+
 
 class TestAuthError(unittest.TestCase):
     """
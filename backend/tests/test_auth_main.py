@@ -1,5 +1,6 @@
+import asyncio
 from typing import Any
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 import pytest
 from pytest import MonkeyPatch
@@ -17,6 +18,7 @@ from backend.main import create_app
 
 NO_AUTH_ENDPOINTS = (
     "/backend/",
+    "/metrics",
 )
 
 
@@ -54,7 +56,7 @@ def lookup_auth_dependency(route: APIRoute) -> bool:
     "backend.main.get_auth_dependency", return_value=mock_keycloak_auth
 )
 def test_ensure_endpoints_depend_on_auth_coroutine(
-    # mock_get_auth_dependency: MagicMock,
+    mock_get_auth_dependency: MagicMock,
     mock_settings: Settings,
 ) -> None:
     """
@@ -140,3 +142,50 @@ def test_categories(mock_settings: Settings) -> None:
 
     # Assert
     assert r.status_code == HTTP_401_UNAUTHORIZED
+
+
+def test_worker_serves_metrics_on_own_port(mock_settings: Settings) -> None:
+    # Arrange
+    app = create_app(settings=mock_settings, worker=2)
+
+    # Assert
+    paths = [route.path for route in app.routes if isinstance(route, APIRoute)]
+    assert "/metrics" not in paths
+    assert app.extra["metrics_port"] == mock_settings.server_metrics_port + 2
+    assert app.extra["metrics"].const_labels == {"worker": "2"}
+
+
+def test_failed_startup_stops_started_components(
+    mock_settings: Settings, monkeypatch: MonkeyPatch
+) -> None:
+    # Arrange
+    app = create_app(settings=mock_settings)
+    app.extra["tables"] = {}
+    jwks = app.extra["jwks"]
+    refresh_task: asyncio.Task | None = None
+
+    async def start_jwks() -> None:
+        nonlocal refresh_task
+        refresh_task = jwks._refresh_task = asyncio.create_task(asyncio.sleep(3600))
+
+    async def start_replicas() -> None:
+        # Fails after the JWKS store has been started
+        await asyncio.sleep(0.01)
+        raise RuntimeError("DB is down")
+
+    monkeypatch.setattr(jwks, "start", start_jwks)
+    monkeypatch.setattr(app.extra["replica_router"], "start", start_replicas)
+
+    async def start_app() -> None:
+        async with app.router.lifespan_context(app):
+            pass
+
+    # Act
+    with pytest.raises(ExceptionGroup) as exc_info:
+        asyncio.run(start_app())
+
+    # Assert
+    assert exc_info.group_contains(RuntimeError, match="DB is down")
+    assert refresh_task.cancelled()
+    assert jwks._refresh_task is None
+    assert app.extra["cache_listener"]._task is None
@@ -0,0 +1,106 @@
+from dataclasses import asdict
+
+import pytest
+
+from benchmarks.run import Result, find_regressions
+
+
+def result(
+    endpoint: str = "/backend/categories",
+    concurrency: int = 10,
+    throughput: float = 1000,
+    p95: float = 10,
+) -> Result:
+    return Result(
+        endpoint=endpoint,
+        concurrency=concurrency,
+        requests=1000,
+        errors=0,
+        throughput=throughput,
+        p50=5,
+        p95=p95,
+        p99=20,
+    )
+
+
+@pytest.mark.parametrize(
+    "throughput, p95",
+    [
+        (1000, 10),
+        # Faster
+        (2000, 5),
+        # Within the max regression
+        (950, 10.5),
+        (910, 10.9),
+    ],
+)
+def test_no_regression(throughput: float, p95: float) -> None:
+    baseline = [asdict(result())]
+
+    regressions = find_regressions(
+        [result(throughput=throughput, p95=p95)], baseline, 10
+    )
+
+    assert regressions == []
+
+
+@pytest.mark.parametrize(
+    "throughput, p95, expected",
+    [
+        (899, 10, "throughput -10.1%, p95 +0.0%"),
+        (1000, 11.1, "throughput +0.0%, p95 +11.0%"),
+        (500, 20, "throughput -50.0%, p95 +100.0%"),
+    ],
+)
+def test_regression(throughput: float, p95: float, expected: str) -> None:
+    baseline = [asdict(result())]
+
+    regressions = find_regressions(
+        [result(throughput=throughput, p95=p95)], baseline, 10
+    )
+
+    assert regressions == [f"/backend/categories (concurrency 10): {expected}"]
+
+
+def test_results_without_baseline_are_skipped() -> None:
+    # Arrange (the baseline was measured at another concurrency and without
+    # the new endpoint)
+    baseline = [asdict(result(concurrency=1))]
+    results = [
+        result(concurrency=10, throughput=1),
+        result(endpoint="/backend/search", concurrency=1, throughput=1),
+    ]
+
+    # Act
+    regressions = find_regressions(results, baseline, 10)
+
+    # Assert
+    assert regressions == []
+
+
+def test_baseline_without_results_is_ignored() -> None:
+    # Arrange (an endpoint which is no longer benchmarked)
+    baseline = [
+        asdict(result()),
+        asdict(result(endpoint="/backend/items", throughput=10**6)),
+    ]
+
+    # Act
+    regressions = find_regressions([result()], baseline, 10)
+
+    # Assert
+    assert regressions == []
+
+
+def test_only_regressed_results_are_reported() -> None:
+    # Arrange
+    baseline = [asdict(result(concurrency=1)), asdict(result(concurrency=10))]
+    results = [result(concurrency=1), result(concurrency=10, throughput=800)]
+
+    # Act
+    regressions = find_regressions(results, baseline, 10)
+
+    # Assert
+    assert regressions == [
+        "/backend/categories (concurrency 10): throughput -20.0%, p95 +0.0%"
+    ]
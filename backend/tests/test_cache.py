@@ -0,0 +1,210 @@
+import asyncio
+import gzip
+
+import pytest
+from fastapi import Request
+from starlette.status import HTTP_200_OK, HTTP_304_NOT_MODIFIED
+
+from backend.cache import (
+    CacheInvalidationListener,
+    ResponseCache,
+    etag_matches,
+    make_etag,
+)
+from backend.compression import Compressor
+
+
+def make_request(path: str = "/backend/categories", **headers: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": b"limit=10",
+            "headers": [
+                (name.replace("_", "-").encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+    )
+
+
+@pytest.fixture
+def clock() -> list[float]:
+    return [0.0]
+
+
+@pytest.fixture
+def cache(clock: list[float]) -> ResponseCache:
+    return ResponseCache(ttl=60, max_entries=2, max_bytes=100, clock=lambda: clock[0])
+
+
+def test_key_includes_query_params() -> None:
+    assert ResponseCache.key(make_request()) == "/backend/categories?limit=10"
+
+
+def test_get_cached_entry(cache: ResponseCache) -> None:
+    cache.put("key", b"[]", ["category"])
+
+    assert cache.get("key").body == b"[]"
+
+
+def test_entry_expires_after_ttl(cache: ResponseCache, clock: list[float]) -> None:
+    cache.put("key", b"[]", ["category"])
+    clock[0] = 61
+
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entry_is_evicted(cache: ResponseCache) -> None:
+    cache.put("key1", b"1", ["category"])
+    cache.put("key2", b"2", ["category"])
+    cache.get("key1")
+    cache.put("key3", b"3", ["category"])
+
+    assert cache.get("key1") is not None
+    assert cache.get("key2") is None
+
+
+def test_entries_are_evicted_when_max_bytes_exceeded(cache: ResponseCache) -> None:
+    cache.put("key1", b"1" * 60, ["category"])
+    cache.put("key2", b"2" * 60, ["category"])
+
+    assert cache.get("key1") is None
+    assert cache.get("key2") is not None
+
+
+def test_invalidate_by_table(cache: ResponseCache) -> None:
+    cache.put("categories", b"[]", ["category"])
+    cache.put("category", b"{}", ["category", "text"])
+
+    cache.invalidate("text")
+
+    assert cache.get("categories") is not None
+    assert cache.get("category") is None
+
+
+def test_body_is_not_cached_if_invalidated_while_querying(
+    cache: ResponseCache,
+) -> None:
+    version = cache.version
+    cache.invalidate("category")
+
+    entry = cache.put("key", b"[]", ["category"], version)
+
+    assert entry.body == b"[]"
+    assert cache.get("key") is None
+
+
+def test_invalidated_tables_are_not_cached_while_settling(clock: list[float]) -> None:
+    cache = ResponseCache(ttl=60, settle_time=10, clock=lambda: clock[0])
+    cache.invalidate("category")
+
+    cache.put("categories", b"[]", ["category"])
+    cache.put("items", b"[]", ["item"])
+    assert cache.get("categories") is None
+    assert cache.get("items") is not None
+
+    clock[0] = 11
+    cache.put("categories", b"[]", ["category"])
+    assert cache.get("categories") is not None
+
+
+def test_nothing_is_cached_when_inactive(cache: ResponseCache) -> None:
+    cache.active = False
+
+    cache.put("key", b"[]", ["category"])
+
+    assert cache.get("key") is None
+
+
+def test_etag_matches() -> None:
+    etag = make_etag(b"[]")
+
+    assert etag_matches(make_request(if_none_match=etag), etag)
+    assert etag_matches(make_request(if_none_match=f'"other", W/{etag}'), etag)
+    assert etag_matches(make_request(if_none_match="*"), etag)
+    assert not etag_matches(make_request(if_none_match='"other"'), etag)
+    assert not etag_matches(make_request(), etag)
+
+
+def test_to_response(cache: ResponseCache) -> None:
+    entry = cache.put("key", b"[]", ["category"], headers={"X-Next-Cursor": "3"})
+
+    response = entry.to_response(make_request())
+
+    assert response.status_code == HTTP_200_OK
+    assert response.body == b"[]"
+    assert response.headers["ETag"] == entry.etag
+    assert response.headers["X-Next-Cursor"] == "3"
+
+
+def test_to_response_not_modified(cache: ResponseCache) -> None:
+    entry = cache.put("key", b"[]", ["category"])
+
+    response = entry.to_response(make_request(if_none_match=entry.etag))
+
+    assert response.status_code == HTTP_304_NOT_MODIFIED
+    assert response.body == b""
+
+
+def test_listener_stops_if_cancellation_is_swallowed(cache: ResponseCache) -> None:
+    listener = CacheInvalidationListener("", cache)
+
+    async def listen_forever() -> None:
+        # Like asyncio.wait_for swallowing the cancellation
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            pass
+        await asyncio.sleep(60)
+
+    async def run() -> None:
+        listener._task = asyncio.create_task(listen_forever())
+        await asyncio.sleep(0)
+        await asyncio.wait_for(listener.stop(), timeout=5)
+
+    asyncio.run(run())
+    assert listener._task is None
+
+
+def test_compressed_body_is_cached(clock: list[float]) -> None:
+    cache = ResponseCache(
+        max_bytes=10_000,
+        compressor=Compressor(encodings=["gzip"], min_size=100),
+        clock=lambda: clock[0],
+    )
+    body = b'{"name": "Lorem ipsum"}' * 100
+    entry = cache.put("/a", body, ["category"])
+
+    response = entry.to_response(
+        make_request("/a", accept_encoding="gzip, deflate")
+    )
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == "W/" + entry.etag
+    assert gzip.decompress(response.body) == body
+    assert cache._size == len(body) + len(response.body)
+
+    # Compressed only once
+    again = cache.get("/a").to_response(make_request("/a", accept_encoding="gzip"))
+    assert again.body is response.body
+
+    # The weak ETag matches
+    not_modified = entry.to_response(
+        make_request("/a", accept_encoding="gzip", if_none_match="W/" + entry.etag)
+    )
+    assert not_modified.status_code == HTTP_304_NOT_MODIFIED
+
+    uncompressed = entry.to_response(make_request("/a"))
+    assert "Content-Encoding" not in uncompressed.headers
+    assert uncompressed.body == body
+
+
+def test_small_body_is_not_compressed() -> None:
+    cache = ResponseCache(compressor=Compressor(encodings=["gzip"], min_size=100))
+    entry = cache.put("/a", b"{}", ["category"])
+
+    response = entry.to_response(make_request("/a", accept_encoding="gzip"))
+    assert "Content-Encoding" not in response.headers
+    assert entry.variants == {}
@@ -0,0 +1,170 @@
+import gzip
+import zlib
+
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from backend.compression import (
+    CompressionMiddleware,
+    Compressor,
+    available_encodings,
+    is_compressible,
+    parse_accept_encoding,
+)
+
+BODY = b'{"id": 1, "name": "Lorem ipsum"}' * 100
+
+
+@pytest.fixture
+def compressor() -> Compressor:
+    return Compressor(encodings=["gzip"], min_size=1024)
+
+
+@pytest.fixture
+def client(compressor: Compressor) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/large")
+    def large():
+        return Response(BODY, media_type="application/json", headers={"ETag": '"1"'})
+
+    @app.get("/small")
+    def small():
+        return Response(b"{}", media_type="application/json")
+
+    @app.get("/image")
+    def image():
+        return Response(BODY, media_type="image/png")
+
+    @app.get("/encoded")
+    def encoded():
+        return Response(
+            gzip.compress(BODY),
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip"},
+        )
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse(
+            iter([b"[", BODY, b",", BODY, b"]"]), media_type="application/json"
+        )
+
+    app.add_middleware(CompressionMiddleware, compressor=compressor)
+    return TestClient(app)
+
+
+def test_parse_accept_encoding() -> None:
+    assert parse_accept_encoding("gzip, br;q=0.5, zstd;q=0, *;q=0.1") == {
+        "gzip": 1.0,
+        "br": 0.5,
+        "zstd": 0.0,
+        "*": 0.1,
+    }
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (None, None),
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip;q=0.5", "gzip"),
+        ("gzip;q=0", None),
+        ("*", "zstd"),
+        ("gzip, br, zstd", "zstd"),
+        ("gzip, br;q=0.9, zstd;q=0.8", "gzip"),
+        ("zstd;q=0, *", "br"),
+    ],
+)
+def test_negotiate(accept_encoding: str | None, expected: str | None) -> None:
+    compressor = Compressor()
+    # Pretend all content codings are available
+    compressor.encodings = ["zstd", "br", "gzip"]
+    assert compressor.negotiate(accept_encoding) == expected
+
+
+def test_unavailable_encodings_are_skipped() -> None:
+    assert Compressor().encodings == available_encodings()
+    assert "gzip" in available_encodings()
+    assert Compressor(encodings=[]).negotiate("gzip") is None
+
+
+@pytest.mark.parametrize(
+    "media_type, expected",
+    [
+        ("application/json", True),
+        ("text/plain; version=0.0.4; charset=utf-8", True),
+        ("application/problem+json", True),
+        ("image/png", False),
+        (None, False),
+    ],
+)
+def test_is_compressible(media_type: str | None, expected: bool) -> None:
+    assert is_compressible(media_type) is expected
+
+
+@pytest.mark.parametrize("encoding", ["zstd", "br", "gzip"])
+def test_stream_chunks_can_be_decompressed_as_they_arrive(encoding: str) -> None:
+    if encoding not in available_encodings():
+        pytest.skip(f"{encoding} is not available")
+    compressor = Compressor(encodings=[encoding])
+    stream = compressor.stream(encoding)
+
+    if encoding == "zstd":
+        import zstandard
+
+        decompress = zstandard.ZstdDecompressor().decompressobj().decompress
+    elif encoding == "br":
+        import brotli
+
+        decompress = brotli.Decompressor().process
+    else:
+        decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+
+    assert decompress(stream.compress(b"[")) == b"["
+    assert decompress(stream.compress(BODY)) == BODY
+    assert decompress(stream.finish(b"]")) == b"]"
+
+
+def test_large_response_is_compressed(client: TestClient) -> None:
+    response = client.get("/large", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == 'W/"1"'
+    assert int(response.headers["Content-Length"]) < len(BODY)
+    assert response.content == BODY
+
+
+def test_response_is_not_compressed_unless_accepted(client: TestClient) -> None:
+    response = client.get("/large", headers={"Accept-Encoding": "identity"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == '"1"'
+    assert response.content == BODY
+
+
+@pytest.mark.parametrize("path", ["/small", "/image"])
+def test_response_is_not_compressed(client: TestClient, path: str) -> None:
+    response = client.get(path, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_encoded_response_is_not_compressed_again(client: TestClient) -> None:
+    response = client.get("/encoded", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.content == BODY
+
+
+def test_streamed_response_is_compressed(client: TestClient) -> None:
+    response = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    assert response.content == b"[" + BODY + b"," + BODY + b"]"
@@ -0,0 +1,343 @@
+from pathlib import Path
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from pydantic import SecretStr
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, text
+
+from backend.config import Settings, get_settings
+from backend.metrics import Registry
+from backend.db import (
+    LazySession,
+    InstrumentedAsyncAdaptedQueuePool,
+    InstrumentedQueuePool,
+    get_alembic_revision,
+    get_async_engine,
+    get_connect_args,
+    get_db_url,
+    get_pool_stats,
+    instrument_engine,
+    load_metadata_snapshot,
+    reflect_metadata,
+    save_metadata_snapshot,
+)
+
+
+@pytest.fixture
+def settings() -> Settings:
+    return get_settings(
+        db_host="localhost",
+        db_port=6543,
+        db_name="app",
+        db_user="app",
+        db_password=SecretStr("s3cr@t"),
+        db_pool_size=3,
+        db_max_overflow=2,
+        auth_host="localhost",
+        auth_port=8080,
+        auth_realm="app",
+        auth_client_id="app",
+    )
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(
+            text("CREATE TABLE category (id INTEGER PRIMARY KEY, name VARCHAR(30))")
+        )
+        connection.execute(
+            text("CREATE TABLE alembic_version (version_num VARCHAR(32))")
+        )
+        connection.execute(
+            text("INSERT INTO alembic_version VALUES ('2eea22cf5de1')")
+        )
+    return engine
+
+
+def test_get_alembic_revision(engine) -> None:
+    with engine.connect() as connection:
+        assert get_alembic_revision(connection) == "2eea22cf5de1"
+
+
+def test_save_and_load_metadata_snapshot(tmp_path: Path) -> None:
+    # Arrange
+    metadata = MetaData()
+    Table("category", metadata, Column("id", Integer, primary_key=True))
+    path = tmp_path / "snapshots" / "metadata.pickle"
+
+    # Act
+    save_metadata_snapshot(metadata, path)
+    loaded = load_metadata_snapshot(path)
+
+    # Assert
+    assert list(loaded.tables) == ["category"]
+    assert list(tmp_path.joinpath("snapshots").iterdir()) == [path]
+
+
+def test_load_missing_metadata_snapshot(tmp_path: Path) -> None:
+    assert load_metadata_snapshot(tmp_path / "missing.pickle") is None
+
+
+def test_reflect_metadata_without_snapshot_dir(engine) -> None:
+    with engine.connect() as connection:
+        metadata = reflect_metadata(connection)
+
+    assert "category" in metadata.tables
+
+
+def test_reflect_metadata_saves_snapshot_keyed_by_revision(
+    engine, tmp_path: Path
+) -> None:
+    with engine.connect() as connection:
+        reflect_metadata(connection, tmp_path)
+
+    assert tmp_path.joinpath("metadata-2eea22cf5de1.pickle").exists()
+
+
+def test_reflect_metadata_uses_existing_snapshot(engine, tmp_path: Path) -> None:
+    # Arrange
+    metadata = MetaData()
+    Table("snapshot_table", metadata, Column("name", String(30)))
+    save_metadata_snapshot(metadata, tmp_path / "metadata-2eea22cf5de1.pickle")
+
+    # Act
+    with patch.object(MetaData, "reflect") as mock_reflect:
+        with engine.connect() as connection:
+            reflected = reflect_metadata(connection, tmp_path)
+
+    # Assert
+    mock_reflect.assert_not_called()
+    assert list(reflected.tables) == ["snapshot_table"]
+
+
+def test_db_url_includes_port_and_escapes_password(settings: Settings) -> None:
+    url = get_db_url(settings)
+
+    assert url.port == 6543
+    assert url.password == "s3cr@t"
+    assert "s3cr%40t@localhost:6543/app" in url.render_as_string(
+        hide_password=False
+    )
+
+
+def test_async_engine_uses_configured_pool(settings: Settings) -> None:
+    engine = get_async_engine(settings)
+
+    assert isinstance(engine.pool, InstrumentedAsyncAdaptedQueuePool)
+    assert get_pool_stats(engine).size == 3
+    assert engine.pool._max_overflow == 2
+
+
+def test_pool_stats_record_checkouts(tmp_path: Path) -> None:
+    # Arrange
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'db.sqlite'}", poolclass=InstrumentedQueuePool
+    )
+
+    # Act
+    with engine.connect():
+        stats_while_checked_out = get_pool_stats(engine)
+    stats = get_pool_stats(engine)
+
+    # Assert
+    assert stats_while_checked_out.checked_out == 1
+    assert stats.checked_out == 0
+    assert stats.checked_in == 1
+    assert stats.wait.checkouts == 1
+    assert stats.wait.wait_time_max >= 0
+
+
+def test_instrument_engine_records_query_and_pool_wait_times(
+    tmp_path: Path,
+) -> None:
+    # Arrange
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'db.sqlite'}", poolclass=InstrumentedQueuePool
+    )
+    metrics = Registry()
+    instrument_engine(engine, metrics)
+
+    # Act
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+        connection.execute(
+            text("SELECT 2").execution_options(query_name="two")
+        )
+    engine.dispose()
+    with engine.connect():
+        pass
+
+    # Assert
+    query_counts = {
+        labels["query"]: value
+        for name, labels, value in metrics["db_query_duration_seconds"].samples()
+        if name == "db_query_duration_seconds_count"
+    }
+    assert query_counts["select"] == 1
+    assert query_counts["two"] == 1
+    # The wait stats survive the pool being recreated by dispose()
+    pool_wait_samples = {
+        name: value
+        for name, labels, value in metrics["db_pool_wait_duration_seconds"].samples()
+    }
+    assert pool_wait_samples["db_pool_wait_duration_seconds_count"] == 2
+    assert b'db_pool_checked_out{server="primary"} 0' in metrics.render()
+
+
+def test_instrument_engines_of_several_servers(tmp_path: Path) -> None:
+    # Arrange
+    metrics = Registry()
+    engines = {
+        server: create_engine(
+            f"sqlite:///{tmp_path / server}.sqlite", poolclass=InstrumentedQueuePool
+        )
+        for server in ("primary", "replica:5432")
+    }
+    for server, engine in engines.items():
+        instrument_engine(engine, metrics, server=server)
+
+    # Act
+    with engines["replica:5432"].connect() as connection:
+        connection.execute(text("SELECT 1"))
+        body = metrics.render()
+
+    # Assert
+    query_counts = {
+        (labels["server"], labels["query"]): value
+        for name, labels, value in metrics["db_query_duration_seconds"].samples()
+        if name == "db_query_duration_seconds_count"
+    }
+    assert query_counts == {("replica:5432", "select"): 1}
+    assert b'db_pool_checked_out{server="primary"} 0' in body
+    assert b'db_pool_checked_out{server="replica:5432"} 1' in body
+
+
+def test_psycopg_is_default_driver(settings: Settings) -> None:
+    engine = get_async_engine(settings)
+
+    assert engine.dialect.driver == "psycopg"
+    assert get_connect_args(settings)["prepare_threshold"] == 5
+
+
+def test_asyncpg_driver(settings: Settings) -> None:
+    settings.db_driver = "asyncpg"
+    settings.db_statement_cache_size = 50
+
+    engine = get_async_engine(settings)
+
+    assert engine.dialect.driver == "asyncpg"
+    assert engine.url.query["prepared_statement_cache_size"] == "50"
+    assert get_connect_args(settings, "asyncpg")["statement_cache_size"] == 50
+
+
+@pytest.mark.parametrize("driver", ["psycopg", "asyncpg"])
+def test_pgbouncer_disables_prepared_statement_reuse(
+    settings: Settings, driver: str
+) -> None:
+    settings.db_pgbouncer = True
+
+    connect_args = get_connect_args(settings, driver)
+
+    if driver == "psycopg":
+        assert connect_args["prepare_threshold"] is None
+    else:
+        assert connect_args["statement_cache_size"] == 0
+        assert connect_args["prepared_statement_name_func"]() != (
+            connect_args["prepared_statement_name_func"]()
+        )
+        assert get_db_url(settings, driver).query[
+            "prepared_statement_cache_size"
+        ] == "0"
+
+
+def test_lazy_session_is_only_created_on_first_statement() -> None:
+    session_factory = MagicMock()
+    session = session_factory.return_value
+    session.execute = AsyncMock()
+    session.close = AsyncMock()
+    lazy_session = LazySession(session_factory)
+
+    async def request() -> None:
+        await lazy_session.release()
+        session_factory.assert_not_called()
+
+        await lazy_session.execute(text("SELECT 1"))
+        await lazy_session.execute(text("SELECT 2"))
+        session_factory.assert_called_once_with()
+        session.close.assert_not_called()
+
+        await lazy_session.release()
+        session.close.assert_awaited_once_with()
+
+    asyncio.run(request())
+
+
+def test_lazy_session_autorelease() -> None:
+    session_factory = MagicMock()
+    session = session_factory.return_value
+    session.execute = AsyncMock(return_value="result")
+    session.close = AsyncMock()
+    engine = MagicMock()
+    lazy_session = LazySession(session_factory, lambda: engine, autorelease=True)
+
+    async def request() -> None:
+        assert await lazy_session.execute(text("SELECT 1")) == "result"
+        session_factory.assert_called_once_with(bind=engine)
+        session.close.assert_awaited_once_with()
+
+        # A new session for the next statement
+        await lazy_session.execute(text("SELECT 2"))
+        assert session_factory.call_count == 2
+
+    asyncio.run(request())
+    assert lazy_session.bind is engine
+
+
+def test_lazy_session_fallback() -> None:
+    # Arrange
+    replica, primary = MagicMock(), MagicMock()
+    replica_session, primary_session = MagicMock(), MagicMock()
+    replica_session.execute = AsyncMock(side_effect=ConnectionRefusedError())
+    primary_session.execute = AsyncMock(return_value="result")
+    for session in (replica_session, primary_session):
+        session.close = AsyncMock()
+    sessions = {replica: replica_session, primary: primary_session}
+    session_factory = MagicMock(side_effect=lambda bind: sessions[bind])
+    fallback = MagicMock(return_value=primary)
+    lazy_session = LazySession(
+        session_factory, lambda: replica, autorelease=True, fallback=fallback
+    )
+
+    # Act
+    result = asyncio.run(lazy_session.execute(text("SELECT 1")))
+
+    # Assert
+    assert result == "result"
+    fallback.assert_called_once()
+    assert fallback.call_args.args[0] is replica
+    replica_session.close.assert_awaited_once_with()
+    primary_session.close.assert_awaited_once_with()
+    assert lazy_session.bind is primary
+
+
+@pytest.mark.parametrize("autorelease", [True, False])
+def test_lazy_session_error_without_fallback(autorelease: bool) -> None:
+    # Arrange (no fallback engine, or the statement may be part of a
+    # transaction)
+    session_factory = MagicMock()
+    session_factory.return_value.execute = AsyncMock(side_effect=ValueError())
+    session_factory.return_value.close = AsyncMock()
+    fallback = MagicMock(return_value=None if autorelease else MagicMock())
+    lazy_session = LazySession(
+        session_factory, MagicMock, autorelease=autorelease, fallback=fallback
+    )
+
+    # Act
+    with pytest.raises(ValueError):
+        asyncio.run(lazy_session.execute(text("SELECT 1")))
+
+    # Assert
+    session_factory.assert_called_once()
@@ -0,0 +1,49 @@
+import random
+from collections import Counter
+
+from development.db_data import (
+    EXAMPLE_CATEGORIES,
+    generate_categories,
+    generate_category_texts,
+    generate_items,
+    generate_texts,
+    get_counts,
+)
+
+
+def test_get_counts() -> None:
+    assert get_counts(1) == (10_000, 1_000_000)
+    assert get_counts(0) == (len(EXAMPLE_CATEGORIES), 0)
+
+
+def test_generated_data_only_depends_on_seed() -> None:
+    def texts(seed: int) -> list[tuple]:
+        return list(generate_texts(random.Random(seed), 100))
+
+    assert texts(1) == texts(1)
+    assert texts(1) != texts(2)
+
+
+def test_generated_rows_fit_columns() -> None:
+    rng = random.Random(0)
+    categories = list(generate_categories(rng, 1000))
+    items = list(generate_items(rng, 10_000))
+
+    assert categories[0] == (1, "Cars", "Some great cars")
+    assert [c[0] for c in categories] == list(range(1, 1001))
+    assert all(len(name) <= 30 and len(desc) <= 200 for _, name, desc in categories)
+    assert all(
+        len(name) <= 30 and (desc is None or len(desc) <= 100)
+        for _, name, desc in items
+    )
+
+
+def test_category_sizes_are_skewed() -> None:
+    # Act
+    rows = list(generate_category_texts(random.Random(0), 10_000, 100, skew=1.1))
+
+    # Assert
+    assert len(set(rows)) == len(rows)
+    assert {text_id for _, text_id in rows} == set(range(1, 10_001))
+    sizes = Counter(cat_id for cat_id, _ in rows).most_common()
+    assert sizes[0][1] > 10 * sizes[-1][1]
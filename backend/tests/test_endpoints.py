@@ -0,0 +1,195 @@
+"""
+Tests of the read endpoints against an in-memory SQLite DB (the statements
+of the endpoints tested here are plain SQL).
+"""
+from typing import Any, AsyncIterator, Iterator
+
+import orjson
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from sqlalchemy import (
+    Column,
+    Connection,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.status import HTTP_200_OK, HTTP_422_UNPROCESSABLE_ENTITY
+
+from backend.cache import ResponseCache
+from backend.endpoints import DEFAULT_PAGE_SIZE, get_router
+
+CATEGORY_IDS = list(range(1, 251))
+
+
+class SyncSession:
+    """
+    The subset of LazySession and AsyncSession used by the read endpoints, on
+    top of a sync connection.
+    """
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+
+    async def execute(self, stmt, params=None):
+        return self.connection.execute(stmt, params)
+
+    async def stream(self, stmt):
+        result = self.connection.execute(stmt)
+
+        class StreamResult:
+            async def partitions(self) -> AsyncIterator[list]:
+                for partition in result.partitions():
+                    yield partition
+
+        return StreamResult()
+
+    async def __aenter__(self) -> "SyncSession":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        pass
+
+
+@pytest.fixture
+def connection() -> Iterator[Connection]:
+    metadata = MetaData()
+    category = Table(
+        "category",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(30)),
+        Column("description", String(200)),
+    )
+    # The TestClient runs the app in another thread
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False})
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        connection.execute(
+            category.insert(),
+            [
+                {"id": id_, "name": f"Category {id_}", "description": "Lorem"}
+                for id_ in CATEGORY_IDS
+            ],
+        )
+        yield connection
+    engine.dispose()
+
+
+@pytest.fixture
+def client(connection: Connection) -> TestClient:
+    db_tables = {"category": Table("category", MetaData(), autoload_with=connection)}
+
+    async def auth() -> dict[str, Any]:
+        return {}
+
+    async def db_session() -> AsyncIterator[SyncSession]:
+        yield SyncSession(connection)
+
+    def read_session(request: Request) -> AsyncSession:
+        return SyncSession(connection)
+
+    app = FastAPI()
+    app.include_router(
+        get_router(
+            auth=auth,
+            async_db_session=db_session,
+            async_session=read_session,
+            async_read_session=read_session,
+            tables=lambda: db_tables,
+            response_cache=ResponseCache(),
+        ),
+        prefix="/backend",
+    )
+    return TestClient(app)
+
+
+def ids(body: bytes) -> list[int]:
+    return [category["id"] for category in orjson.loads(body)]
+
+
+def test_first_page_has_next_cursor(client: TestClient) -> None:
+    response = client.get("/backend/categories", params={"limit": 10})
+
+    assert response.status_code == HTTP_200_OK
+    assert ids(response.content) == CATEGORY_IDS[:10]
+    # The ID of the last category of the page
+    assert response.headers["X-Next-Cursor"] == "10"
+    assert response.links["next"]["url"] == (
+        "http://testserver/backend/categories?after=10&limit=10"
+    )
+
+
+def test_default_page_size(client: TestClient) -> None:
+    response = client.get("/backend/categories")
+
+    assert ids(response.content) == CATEGORY_IDS[:DEFAULT_PAGE_SIZE]
+    assert response.headers["X-Next-Cursor"] == str(DEFAULT_PAGE_SIZE)
+
+
+def test_after_resumes_after_cursor(client: TestClient) -> None:
+    response = client.get("/backend/categories", params={"after": 10, "limit": 5})
+
+    assert ids(response.content) == [11, 12, 13, 14, 15]
+    assert response.headers["X-Next-Cursor"] == "15"
+
+
+def test_following_next_links_returns_all_categories(client: TestClient) -> None:
+    seen = []
+    url = "/backend/categories?limit=100"
+    while url is not None:
+        response = client.get(url)
+        seen.extend(ids(response.content))
+        url = response.links.get("next", {}).get("url")
+    assert seen == CATEGORY_IDS
+
+
+@pytest.mark.parametrize("after", [240, 245])
+def test_last_page_has_no_cursor(client: TestClient, after: int) -> None:
+    # Including the last page being exactly full
+    response = client.get("/backend/categories", params={"after": after, "limit": 10})
+
+    assert ids(response.content) == CATEGORY_IDS[after:]
+    assert "X-Next-Cursor" not in response.headers
+    assert "Link" not in response.headers
+
+
+def test_page_after_last_category_is_empty(client: TestClient) -> None:
+    response = client.get("/backend/categories", params={"after": 250})
+
+    assert response.json() == []
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.parametrize(
+    "after, expected", [(None, CATEGORY_IDS), (200, CATEGORY_IDS[200:]), (250, [])]
+)
+def test_stream_returns_all_categories_after_cursor(
+    client: TestClient,
+    monkeypatch: pytest.MonkeyPatch,
+    after: int | None,
+    expected: list[int],
+) -> None:
+    # Several chunks
+    monkeypatch.setattr("backend.endpoints.STREAM_BATCH_SIZE", 30)
+    params = {"stream": True}
+    if after is not None:
+        params["after"] = after
+    response = client.get("/backend/categories", params=params)
+
+    assert response.status_code == HTTP_200_OK
+    assert response.headers["Content-Type"] == "application/json"
+    # Valid JSON across the chunks
+    assert orjson.loads(response.content) == [
+        {"id": id_, "name": f"Category {id_}", "description": "Lorem"}
+        for id_ in expected
+    ]
+
+
+def test_stream_rejects_limit(client: TestClient) -> None:
+    response = client.get("/backend/categories", params={"stream": True, "limit": 10})
+    assert response.status_code == HTTP_422_UNPROCESSABLE_ENTITY
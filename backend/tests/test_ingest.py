@@ -0,0 +1,260 @@
+import asyncio
+from typing import AsyncIterator
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.status import HTTP_422_UNPROCESSABLE_ENTITY
+
+from backend.cache import ResponseCache
+from backend.config import Settings
+from backend.db import LazySession, get_async_engine
+from backend.endpoints import get_router
+from backend.ingest import (
+    CSV,
+    NDJSON,
+    STAGING_TABLE,
+    IngestError,
+    _is_invalid_data,
+    _lines,
+    _ndjson_records,
+    _split_csv_header,
+    ingest,
+)
+
+
+async def stream(*chunks: bytes) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(iterator: AsyncIterator) -> list:
+    return [item async for item in iterator]
+
+
+def test_lines_are_split_across_chunks() -> None:
+    lines = asyncio.run(collect(_lines(stream(b"a\nb", b"c\n\n", b"d"))))
+    assert lines == [(1, b"a"), (2, b"bc"), (4, b"d")]
+
+
+def test_ndjson_records() -> None:
+    # Arrange
+    body = stream(
+        b'{"id": 1, "name": "a", "txt": "x", "categories": [1, 2]}\n',
+        b'{"id": 2, "name": "b", "description": "d", "txt": "y"}\n',
+    )
+
+    # Act
+    records = asyncio.run(collect(_ndjson_records(body)))
+
+    # Assert
+    # The omitted categories are None, i.e. the links are kept
+    assert records == [(1, "a", None, "x", [1, 2]), (2, "b", "d", "y", None)]
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        b"not json",
+        b'{"id": 1, "name": "a"}',
+        b"[1, 2]",
+        b'"a"',
+        # Values of the wrong type
+        b'{"id": "1", "name": "a", "txt": "x"}',
+        b'{"id": true, "name": "a", "txt": "x"}',
+        b'{"id": 1, "name": {"x": 1}, "txt": "x"}',
+        b'{"id": 1, "name": "a", "description": 1, "txt": "x"}',
+        b'{"id": 1, "name": "a", "txt": ["x"]}',
+        b'{"id": 1, "name": "a", "txt": "x", "categories": 1}',
+        b'{"id": 1, "name": "a", "txt": "x", "categories": [1, {"a": 2}]}',
+        b'{"id": 1, "name": "a", "txt": "x", "categories": [1.5]}',
+    ],
+)
+def test_invalid_ndjson_record(line: bytes) -> None:
+    with pytest.raises(IngestError, match="line 2"):
+        asyncio.run(collect(_ndjson_records(stream(b"\n", line))))
+
+
+def test_split_csv_header() -> None:
+    async def split() -> tuple:
+        columns, body = await _split_csv_header(
+            stream(b"id,na", b"me,txt\n1,a,", b'"x"\n')
+        )
+        return columns, b"".join(await collect(body))
+
+    assert asyncio.run(split()) == (("id", "name", "txt"), b'1,a,"x"\n')
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        b"id,name\n",
+        b"id,name,txt,other\n",
+        b"id,name,txt,id\n",
+        b"",
+        # Not UTF-8
+        b"id,name,txt,\xff\n",
+    ],
+)
+def test_invalid_csv_header(header: bytes) -> None:
+    with pytest.raises(IngestError):
+        asyncio.run(_split_csv_header(stream(header)))
+
+
+@pytest.mark.parametrize(
+    "sqlstate, invalid",
+    [("22001", True), ("23503", True), ("57014", False), (None, False)],
+)
+def test_is_invalid_data(sqlstate: str | None, invalid: bool) -> None:
+    class Error(Exception):
+        pass
+
+    err = Error()
+    err.sqlstate = sqlstate
+    assert _is_invalid_data(err) is invalid
+
+
+async def ingest_links(
+    settings: Settings, content_type: str, *bodies: bytes
+) -> list[tuple[int, int]]:
+    """
+    Ingest the bodies one after the other into the test DB and get the
+    category links of the ingested texts (all rolled back afterwards).
+    """
+    engine = get_async_engine(settings)
+    try:
+        async with engine.connect() as connection:
+            async with connection.begin() as transaction:
+                await connection.execute(
+                    text(
+                        "INSERT INTO category (id, name, description) "
+                        "VALUES (-1, 'a', ''), (-2, 'b', ''), (-3, 'c', '')"
+                    )
+                )
+                for body in bodies:
+                    await ingest(connection, content_type, stream(body))
+                    # Otherwise only dropped on commit
+                    await connection.execute(text(f"DROP TABLE {STAGING_TABLE}"))
+                links = (
+                    await connection.execute(
+                        text(
+                            "SELECT cat_id, text_id FROM category_text "
+                            "WHERE text_id < 0 ORDER BY text_id DESC, cat_id DESC"
+                        )
+                    )
+                ).all()
+                await transaction.rollback()
+    finally:
+        await engine.dispose()
+    return [tuple(link) for link in links]
+
+
+@pytest.mark.parametrize("driver", ["psycopg", "asyncpg"])
+@pytest.mark.parametrize(
+    "content_type, bodies",
+    [
+        (
+            NDJSON,
+            [
+                b'{"id": -1, "name": "a", "txt": "x", "categories": [-1, -2]}\n'
+                b'{"id": -2, "name": "b", "txt": "y", "categories": [-1]}\n'
+                b'{"id": -3, "name": "c", "txt": "z", "categories": [-3]}',
+                # Omitted, null and empty categories
+                b'{"id": -1, "name": "a", "txt": "x2"}\n'
+                b'{"id": -2, "name": "b", "txt": "y2", "categories": null}\n'
+                b'{"id": -3, "name": "c", "txt": "z2", "categories": []}',
+            ],
+        ),
+        (
+            CSV,
+            [
+                b'id,name,txt,categories\n-1,a,x,"{-1,-2}"\n-2,b,y,{-1}\n'
+                b"-3,c,z,{-3}\n",
+                # Empty (i.e. NULL) and empty array categories
+                b"id,name,txt,categories\n-1,a,x2,\n-2,b,y2,\n-3,c,z2,{}\n",
+            ],
+        ),
+        (
+            CSV,
+            [
+                b'id,name,txt,categories\n-1,a,x,"{-1,-2}"\n-2,b,y,{-1}\n'
+                b"-3,c,z,{-3}\n",
+                # Omitted categories column (and a removed link of -3)
+                b"id,name,txt\n-1,a,x2\n-2,b,y2\n",
+                b"id,name,txt,categories\n-3,c,z2,{}\n",
+            ],
+        ),
+    ],
+)
+def test_omitted_categories_keep_links(
+    db_settings: Settings, driver: str, content_type: str, bodies: list[bytes]
+) -> None:
+    settings = db_settings.model_copy(update={"db_driver": driver})
+
+    links = asyncio.run(ingest_links(settings, content_type, *bodies))
+
+    assert links == [(-1, -1), (-2, -1), (-1, -2)]
+
+
+@pytest.mark.parametrize("driver", ["psycopg", "asyncpg"])
+@pytest.mark.parametrize(
+    "invalid_record",
+    [
+        b'{"id": -2, "name": {"x": 1}, "txt": "y"}',
+        b'{"id": -2, "name": "b", "txt": "y", "categories": [1, {"a": 2}]}',
+    ],
+)
+def test_invalid_record_is_rejected_without_changes(
+    db_settings: Settings, driver: str, invalid_record: bytes
+) -> None:
+    # Arrange
+    settings = db_settings.model_copy(update={"db_driver": driver})
+    engine = get_async_engine(settings)
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def auth() -> dict:
+        return {"realm_access": {"roles": ["admin"]}}
+
+    async def db_session() -> AsyncIterator[LazySession]:
+        session = LazySession(async_session)
+        try:
+            yield session
+        finally:
+            await session.release()
+
+    app = FastAPI()
+    app.include_router(
+        get_router(
+            auth=auth,
+            async_db_session=db_session,
+            async_session=async_session,
+            tables=lambda: {},
+            response_cache=ResponseCache(),
+        ),
+        prefix="/backend",
+    )
+    # A valid record followed by one which cannot be adapted by the driver
+    body = b'{"id": -1, "name": "a", "txt": "x"}\n' + invalid_record
+
+    async def count_items() -> int:
+        async with engine.connect() as connection:
+            return await connection.scalar(
+                text("SELECT count(*) FROM item WHERE id < 0")
+            )
+
+    # Act
+    with TestClient(app) as client:
+        response = client.post(
+            "/backend/items/bulk",
+            content=body,
+            headers={"Content-Type": NDJSON},
+        )
+        items = client.portal.call(count_items)
+        client.portal.call(engine.dispose)
+
+    # Assert
+    assert response.status_code == HTTP_422_UNPROCESSABLE_ENTITY
+    assert "line 2" in response.json()["detail"]
+    assert items == 0
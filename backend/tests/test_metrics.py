@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from backend.metrics import (
+    Histogram,
+    MetricsMiddleware,
+    Registry,
+    UNMATCHED_ROUTE,
+    start_metrics_server,
+)
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+    # Arrange
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.25, 1))
+
+    # Act
+    histogram.observe(0.125, "/a")
+    histogram.observe(0.25, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(4, "/a")
+
+    # Assert
+    assert list(histogram.samples()) == [
+        ("latency_seconds_bucket", {"route": "/a", "le": "0.25"}, 2),
+        ("latency_seconds_bucket", {"route": "/a", "le": "1"}, 3),
+        ("latency_seconds_bucket", {"route": "/a", "le": "+Inf"}, 4),
+        ("latency_seconds_sum", {"route": "/a"}, 4.875),
+        ("latency_seconds_count", {"route": "/a"}, 4),
+    ]
+
+
+def test_histogram_requires_all_label_values() -> None:
+    histogram = Histogram("latency_seconds", "Latency", ("method", "route"))
+    with pytest.raises(ValueError):
+        histogram.observe(1, "GET")
+
+
+def test_registry_render() -> None:
+    # Arrange
+    metrics = Registry()
+    histogram = metrics.histogram("latency_seconds", "Latency", buckets=(1,))
+    metrics.counter("fetches_total", "Fetches", lambda: 3)
+
+    # Act
+    histogram.observe(0.5)
+    body = metrics.render()
+
+    # Assert
+    assert body == (
+        b"# HELP latency_seconds Latency\n"
+        b"# TYPE latency_seconds histogram\n"
+        b'latency_seconds_bucket{le="1"} 1\n'
+        b'latency_seconds_bucket{le="+Inf"} 1\n'
+        b"latency_seconds_sum 0.5\n"
+        b"latency_seconds_count 1\n"
+        b"# HELP fetches_total Fetches\n"
+        b"# TYPE fetches_total counter\n"
+        b"fetches_total 3\n"
+    )
+
+
+def test_registry_const_labels() -> None:
+    metrics = Registry({"worker": "2"})
+    histogram = metrics.histogram("latency_seconds", "Latency", ("route",), (1,))
+    metrics.gauge("pool_size", "Pool size", lambda: 5)
+
+    histogram.observe(0.5, "/")
+    body = metrics.render()
+
+    assert b'latency_seconds_bucket{worker="2",route="/",le="1"} 1\n' in body
+    assert b'latency_seconds_count{worker="2",route="/"} 1\n' in body
+    assert b'pool_size{worker="2"} 5\n' in body
+
+
+def test_metrics_server() -> None:
+    metrics = Registry({"worker": "0"})
+    metrics.counter("fetches_total", "Fetches", lambda: 3)
+
+    async def get(port: int, path: str) -> bytes:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def run() -> tuple[bytes, bytes]:
+        server = await start_metrics_server(metrics, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await get(port, "/metrics"), await get(port, "/other")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    found, not_found = asyncio.run(run())
+
+    assert found.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert found.endswith(b'\r\n\r\n' + metrics.render())
+    assert not_found.startswith(b"HTTP/1.1 404 Not Found\r\n")
+
+
+def test_registry_labelled_callback_metrics() -> None:
+    metrics = Registry()
+    metrics.gauge("pool_size", "Pool size", lambda: 5, {"server": "primary"})
+    metrics.gauge("pool_size", "Pool size", lambda: 3, {"server": "replica"})
+
+    assert (
+        b'pool_size{server="primary"} 5\npool_size{server="replica"} 3\n'
+        in metrics.render()
+    )
+    with pytest.raises(ValueError):
+        metrics.gauge("pool_size", "Pool size", lambda: 1, {"server": "primary"})
+    with pytest.raises(ValueError):
+        metrics.counter("pool_size", "Pool size", lambda: 1, {"server": "other"})
+
+
+def test_registry_returns_existing_histogram() -> None:
+    metrics = Registry()
+    histogram = metrics.histogram("latency_seconds", "Latency")
+    assert metrics.histogram("latency_seconds", "Latency") is histogram
+    with pytest.raises(ValueError):
+        metrics.gauge("latency_seconds", "Latency", lambda: 0)
+
+
+def test_middleware_labels_requests_by_route_template() -> None:
+    # Arrange
+    metrics = Registry()
+    app = FastAPI()
+
+    @app.get("/category/{cat_id}")
+    def category(cat_id: int):
+        return {"id": cat_id}
+
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+    client = TestClient(app)
+
+    # Act
+    client.get("/category/1")
+    client.get("/category/2")
+    client.get("/unknown")
+
+    # Assert
+    samples = {
+        (labels["method"], labels["route"], labels["status"]): value
+        for name, labels, value in metrics["http_request_duration_seconds"].samples()
+        if name == "http_request_duration_seconds_count"
+    }
+    assert samples == {
+        ("GET", "/category/{cat_id}", "200"): 2,
+        ("GET", UNMATCHED_ROUTE, "404"): 1,
+    }
@@ -0,0 +1,120 @@
+import pytest
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, String, Table, Text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+from backend.queries import (
+    categories_page,
+    categories_page_json,
+    category_detail,
+    category_detail_json,
+    search_items,
+)
+
+
+@pytest.fixture
+def db_tables():
+    metadata = MetaData()
+    Table(
+        "category",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(30)),
+        Column("description", String(200)),
+    )
+    Table(
+        "item",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String(30)),
+        Column("description", String(100)),
+    )
+    Table(
+        "text",
+        metadata,
+        Column("id", Integer, ForeignKey("item.id"), primary_key=True),
+        Column("txt", Text),
+        Column("txt_tsv", TSVECTOR),
+    )
+    Table(
+        "category_text",
+        metadata,
+        Column("cat_id", Integer, ForeignKey("category.id"), primary_key=True),
+        Column("text_id", Integer, ForeignKey("text.id"), primary_key=True),
+    )
+    return metadata.tables
+
+
+def compile_sql(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect()))
+
+
+def test_categories_page(db_tables) -> None:
+    sql = compile_sql(categories_page(db_tables, after=10, limit=100))
+
+    assert "WHERE category.id > %(id_1)s" in sql
+    assert "ORDER BY category.id" in sql
+    assert "LIMIT %(param_1)s" in sql
+
+
+def test_categories_page_without_limit(db_tables) -> None:
+    sql = compile_sql(categories_page(db_tables, after=None, limit=None))
+
+    assert "WHERE" not in sql
+    assert "LIMIT" not in sql
+
+
+def test_category_detail_is_a_single_outer_join(db_tables) -> None:
+    sql = compile_sql(category_detail(db_tables))
+
+    assert sql.count("SELECT") == 1
+    assert "category LEFT OUTER JOIN (category_text JOIN text" in sql
+    assert "WHERE category.id = %(cat_id)s" in sql
+
+
+def test_category_detail_statement_is_cached(db_tables) -> None:
+    assert category_detail(db_tables) is category_detail(db_tables)
+
+
+def test_categories_page_json_is_aggregated_by_the_db(db_tables) -> None:
+    sql = compile_sql(categories_page_json(db_tables, after=10, limit=100))
+
+    assert "WITH page AS" in sql
+    assert (
+        "json_agg(json_build_object('id', page.id, 'name', page.name, "
+        "'description', page.description) ORDER BY page.id)"
+    ) in sql
+    assert "AS has_more" in sql
+
+
+def test_category_detail_json_is_a_single_statement(db_tables) -> None:
+    sql = compile_sql(category_detail_json(db_tables))
+
+    assert sql.startswith("SELECT CAST(json_build_object('id', category.id")
+    assert "'texts', (SELECT coalesce(json_agg(" in sql
+    assert "WHERE category_text.cat_id = category.id" in sql
+    assert sql.endswith("WHERE category.id = %(cat_id)s")
+
+
+def test_search_items_ranks_text_matches(db_tables) -> None:
+    sql = compile_sql(
+        search_items(db_tables, "foo", None, cat_id=3, offset=0, limit=10)
+    )
+
+    assert "text.txt_tsv @@ websearch_to_tsquery('simple'::regconfig" in sql
+    assert "ORDER BY ts_rank(text.txt_tsv" in sql
+    assert "WHERE category_text.cat_id = %(cat_id_1)s" in sql
+    # The headlines are built for the page only
+    assert "ts_headline('simple'::regconfig, text.txt" in sql.split("FROM (")[0]
+
+
+def test_search_items_by_name_prefix(db_tables) -> None:
+    stmt = search_items(db_tables, None, "50%_", None, offset=20, limit=10)
+    sql = compile_sql(stmt)
+
+    assert "item.name ILIKE %(name_1)s" in sql
+    assert "ORDER BY item.name, item.id" in sql
+    # The outer query keeps the order of the page
+    assert sql.endswith("ORDER BY page.name, page.id")
+    assert "txt_tsv" not in sql
+    assert stmt.compile().params["name_1"] == "50\\%\\_%"
@@ -0,0 +1,110 @@
+"""
+Query plan regression tests, i.e. the read and lookup queries must use the
+indexes at a realistic data size.
+
+The tests need a disposable Postgres DB (it is migrated and all data is
+replaced!). Either set TEST_DB_CONNINFO to the libpq connection string of
+such a DB or put the Postgres binaries in the PATH (a throwaway cluster is
+then spawned, see conftest.py). Otherwise the tests are skipped.
+"""
+from typing import Any, Iterator
+
+import pytest
+from sqlalchemy import Connection, Select, Table, bindparam, select, text
+from sqlalchemy.dialects import postgresql
+
+from backend.config import Settings
+from backend.db import get_engine, reflect_metadata
+from backend.queries import categories_page, category_detail, search_items
+
+# 500 categories and 50,000 items and texts
+SCALE = 0.05
+
+
+@pytest.fixture(scope="module")
+def connection(conninfo: str, db_settings: Settings) -> Iterator[Connection]:
+    from development.db_data import populate
+
+    populate(conninfo, scale=SCALE)
+
+    engine = get_engine(db_settings)
+    with engine.connect() as connection:
+        yield connection
+    engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def db_tables(connection: Connection) -> dict[str, Table]:
+    return reflect_metadata(connection, None).tables
+
+
+def explain(connection: Connection, stmt: Select) -> dict[str, Any]:
+    sql = stmt.compile(
+        dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    return connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}").scalar()[0][
+        "Plan"
+    ]
+
+
+def scans(plan: dict[str, Any], parent: str | None = None) -> dict[str, set[str]]:
+    """
+    Get the scan node types (and the index names) of the plan per relation.
+    """
+    result: dict[str, set[str]] = {}
+    # The bitmap index scans belong to the relation of their bitmap heap scan
+    relation = plan.get("Relation Name", parent if "Index Name" in plan else None)
+    if relation is not None:
+        result.setdefault(relation, set()).add(plan["Node Type"])
+        if "Index Name" in plan:
+            result[relation].add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        for child_relation, nodes in scans(child, relation).items():
+            result.setdefault(child_relation, set()).update(nodes)
+    return result
+
+
+def test_categories_page_uses_primary_key(connection, db_tables) -> None:
+    plan = explain(connection, categories_page(db_tables, after=250, limit=101))
+    assert "category_pkey" in scans(plan)["category"]
+
+
+def test_category_detail_uses_indexes(connection, db_tables) -> None:
+    # A typical (i.e. not one of the few huge) category
+    category_text = db_tables["category_text"]
+    cat_id = connection.execute(
+        select(category_text.c.cat_id)
+        .group_by(category_text.c.cat_id)
+        .order_by(text("count(*)"))
+        .offset(250)
+        .limit(1)
+    ).scalar_one()
+
+    plan = explain(connection, category_detail(db_tables).params(cat_id=cat_id))
+
+    for relation, nodes in scans(plan).items():
+        assert "Seq Scan" not in nodes, f"{relation} is scanned sequentially"
+
+
+def test_categories_of_text_use_text_id_index(connection, db_tables) -> None:
+    category_text = db_tables["category_text"]
+    stmt = select(category_text.c.cat_id).where(
+        category_text.c.text_id == bindparam("text_id", 1000)
+    )
+    assert "ix_category_text_text_id" in scans(explain(connection, stmt))[
+        "category_text"
+    ]
+
+
+@pytest.mark.parametrize(
+    "table, index", [("item", "ix_item_name"), ("category", "ix_category_name")]
+)
+def test_lookup_by_name_uses_index(connection, db_tables, table, index) -> None:
+    table = db_tables[table]
+    stmt = select(table).where(table.c.name == bindparam("name", "Lorem 100"))
+    assert index in scans(explain(connection, stmt))[table.name]
+
+
+def test_text_search_uses_gin_index(connection, db_tables) -> None:
+    stmt = search_items(db_tables, "nonexistent", None, None, offset=0, limit=101)
+    assert "ix_text_txt_tsv" in scans(explain(connection, stmt))["text"]
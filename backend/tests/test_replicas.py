@@ -0,0 +1,207 @@
+import asyncio
+import math
+from typing import Any
+from unittest.mock import AsyncMock, patch
+
+import orjson
+import pytest
+from fastapi import Response
+from fastapi.testclient import TestClient
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from backend.config import Settings
+from backend.main import create_app
+from backend.replicas import (
+    READ_PRIMARY_COOKIE,
+    ReplicaRouter,
+    is_connection_error,
+    parse_host,
+)
+
+
+def make_engine(host: str) -> AsyncEngine:
+    # Never connected to
+    return create_async_engine(f"postgresql+psycopg://app:secret@{host}/app")
+
+
+@pytest.fixture
+def primary() -> AsyncEngine:
+    return make_engine("primary")
+
+
+@pytest.fixture
+def replicas() -> list[AsyncEngine]:
+    return [make_engine("replica1"), make_engine("replica2")]
+
+
+@pytest.fixture
+def router(primary: AsyncEngine, replicas: list[AsyncEngine]) -> ReplicaRouter:
+    return ReplicaRouter(primary, replicas)
+
+
+@pytest.mark.parametrize(
+    "host, expected",
+    [
+        ("replica", ("replica", 5432)),
+        ("replica:5433", ("replica", 5433)),
+        ("10.0.0.1:6543", ("10.0.0.1", 6543)),
+    ],
+)
+def test_parse_host(host: str, expected: tuple[str, int]) -> None:
+    assert parse_host(host, 5432) == expected
+
+
+class SQLStateError(Exception):
+    def __init__(self, sqlstate: str | None):
+        self.sqlstate = sqlstate
+
+
+@pytest.mark.parametrize(
+    "err, expected",
+    [
+        (ConnectionRefusedError(), True),
+        (OperationalError("SELECT 1", {}, SQLStateError(None)), True),
+        (OperationalError("SELECT 1", {}, SQLStateError("08006")), True),
+        (OperationalError("SELECT 1", {}, SQLStateError("57P01")), True),
+        # Statement timeout
+        (OperationalError("SELECT 1", {}, SQLStateError("57014")), False),
+        (ProgrammingError("SELECT 1", {}, SQLStateError("42601")), False),
+        (ValueError(), False),
+    ],
+)
+def test_is_connection_error(err: BaseException, expected: bool) -> None:
+    assert is_connection_error(err) is expected
+
+
+def test_round_robin(router: ReplicaRouter, replicas: list[AsyncEngine]) -> None:
+    engines = [router.engine() for _ in range(4)]
+
+    assert set(engines) == set(replicas)
+    assert engines[0] is engines[2] and engines[1] is engines[3]
+
+
+def test_ejected_replica_is_not_used(
+    router: ReplicaRouter, replicas: list[AsyncEngine]
+) -> None:
+    router.eject(replicas[0], "test")
+
+    assert {router.engine() for _ in range(4)} == {replicas[1]}
+    assert router.ejections == 1
+
+
+def test_fallback_to_primary(
+    router: ReplicaRouter, primary: AsyncEngine, replicas: list[AsyncEngine]
+) -> None:
+    for replica in replicas:
+        router.report_error(replica, ConnectionRefusedError())
+
+    assert router.engine() is primary
+
+
+def test_query_errors_do_not_eject(
+    router: ReplicaRouter, replicas: list[AsyncEngine]
+) -> None:
+    router.report_error(replicas[0], ProgrammingError("SELECT", {}, Exception()))
+
+    assert router.healthy == replicas
+
+
+def test_fallback_to_primary_on_connection_error(
+    router: ReplicaRouter, primary: AsyncEngine, replicas: list[AsyncEngine]
+) -> None:
+    assert router.fallback(replicas[0], ConnectionRefusedError()) is primary
+    assert router.healthy == [replicas[1]]
+
+
+def test_no_fallback_on_query_error_or_primary(
+    router: ReplicaRouter, primary: AsyncEngine, replicas: list[AsyncEngine]
+) -> None:
+    error = ProgrammingError("SELECT", {}, Exception())
+    assert router.fallback(replicas[0], error) is None
+    assert router.fallback(primary, ConnectionRefusedError()) is None
+    assert router.healthy == replicas
+
+
+def test_primary_without_replicas(primary: AsyncEngine) -> None:
+    router = ReplicaRouter(primary, [])
+
+    assert router.engine() is primary
+    # No need to read from the primary after writing
+    response = Response()
+    router.mark_write(response)
+    assert "set-cookie" not in response.headers
+
+
+def test_mark_write(router: ReplicaRouter) -> None:
+    response = Response()
+
+    router.mark_write(response)
+
+    cookie = response.headers["set-cookie"]
+    assert cookie.startswith(f"{READ_PRIMARY_COOKIE}=1;")
+    assert "Max-Age=10" in cookie
+
+
+def test_failed_health_check_ejects(primary: AsyncEngine) -> None:
+    # Nothing listens on the port
+    unreachable = make_engine("localhost:1")
+    router = ReplicaRouter(primary, [unreachable])
+
+    asyncio.run(router.check())
+
+    assert router.healthy == []
+    assert router.engine() is primary
+
+
+@pytest.mark.parametrize("lag", [11, math.inf])
+def test_lagging_replica_is_ejected_until_caught_up(
+    primary: AsyncEngine, replicas: list[AsyncEngine], lag: float
+) -> None:
+    router = ReplicaRouter(primary, replicas, max_lag=10)
+    lags = {replicas[0]: lag, replicas[1]: 0}
+
+    async def replication_lag(replica: AsyncEngine) -> float:
+        return lags[replica]
+
+    router._replication_lag = replication_lag
+
+    asyncio.run(router.check())
+    assert router.healthy == [replicas[1]]
+    assert router.ejections == 1
+
+    lags[replicas[0]] = 0
+    asyncio.run(router.check())
+    assert router.healthy == replicas
+
+
+async def mock_auth(token: str = "") -> dict[str, Any]:
+    return {}
+
+
+@pytest.mark.parametrize("driver", ["psycopg", "asyncpg"])
+@pytest.mark.parametrize("stream", [False, True])
+def test_read_is_retried_on_primary_if_replica_is_down(
+    db_settings: Settings, driver: str, stream: bool
+) -> None:
+    # Arrange (nothing listens on port 1)
+    settings = db_settings.model_copy(
+        update={"db_driver": driver, "db_replica_hosts": ["localhost:1"]}
+    )
+    with patch("backend.main.get_auth_dependency", return_value=mock_auth):
+        app = create_app(settings=settings)
+    app.extra["jwks"].start = AsyncMock()
+    router: ReplicaRouter = app.extra["replica_router"]
+
+    with TestClient(app) as client:
+        # The replica went down after the last health check
+        router._ejected_until.clear()
+        assert router.engine() is router.replicas[0]
+
+        # Act
+        response = client.get("/backend/categories", params={"stream": stream})
+
+        # Assert
+        assert response.status_code == 200
+        assert isinstance(orjson.loads(response.content), list)
+        assert router.healthy == []
@@ -0,0 +1,69 @@
+import json
+
+from backend.serialization import (
+    encode_categories,
+    encode_categories_chunk,
+    encode_category_detail,
+    encode_search_results,
+)
+
+ROWS = [(1, "Cars", "Some great cars"), (2, "Numbers", "Our favorite numbers")]
+
+
+def test_encode_categories() -> None:
+    assert json.loads(encode_categories(ROWS)) == [
+        {"id": 1, "name": "Cars", "description": "Some great cars"},
+        {"id": 2, "name": "Numbers", "description": "Our favorite numbers"},
+    ]
+
+
+def test_encode_no_categories() -> None:
+    assert encode_categories([]) == b"[]"
+
+
+def test_encoded_chunks_form_a_json_array() -> None:
+    body = (
+        b"["
+        + encode_categories_chunk(ROWS[:1], first=True)
+        + encode_categories_chunk(ROWS[1:], first=False)
+        + b"]"
+    )
+
+    assert json.loads(body) == json.loads(encode_categories(ROWS))
+
+
+def test_encode_category_detail() -> None:
+    rows = [
+        (1, "Cars", "Some great cars", 10, "Beetle", None, "A small car"),
+        (1, "Cars", "Some great cars", 11, "Mustang", "Fast", "A fast car"),
+    ]
+
+    assert json.loads(encode_category_detail(rows)) == {
+        "id": 1,
+        "name": "Cars",
+        "description": "Some great cars",
+        "texts": [
+            {"id": 10, "name": "Beetle", "description": None, "txt": "A small car"},
+            {"id": 11, "name": "Mustang", "description": "Fast", "txt": "A fast car"},
+        ],
+    }
+
+
+def test_encode_category_detail_without_texts() -> None:
+    rows = [(1, "Cars", "Some great cars", None, None, None, None)]
+
+    assert json.loads(encode_category_detail(rows))["texts"] == []
+
+
+def test_encode_search_results() -> None:
+    rows = [(1, "Car", None, 0.5, "<b>fast</b> car"), (2, "Cat", "Nice", None, None)]
+    assert json.loads(encode_search_results(rows)) == [
+        {
+            "id": 1,
+            "name": "Car",
+            "description": None,
+            "rank": 0.5,
+            "headline": "<b>fast</b> car",
+        },
+        {"id": 2, "name": "Cat", "description": "Nice", "rank": None, "headline": None},
+    ]
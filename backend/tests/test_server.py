@@ -0,0 +1,105 @@
+import socket
+from typing import Any
+
+import pytest
+from pydantic import SecretStr
+
+from backend.config import Settings, get_settings
+from backend.main import create_app
+from backend.server import (
+    Server,
+    available_cpus,
+    get_worker_settings,
+    preload_metadata,
+)
+
+
+@pytest.fixture
+def settings() -> Settings:
+    return get_settings(
+        db_host="localhost",
+        db_port=5432,
+        db_name="app",
+        db_user="app",
+        db_password=SecretStr("secret"),
+        auth_host="localhost",
+        auth_port=8080,
+        auth_realm="app",
+        auth_client_id="app",
+    )
+
+
+def test_available_cpus() -> None:
+    assert available_cpus() >= 1
+
+
+def test_worker_settings_without_budget(settings: Settings) -> None:
+    assert get_worker_settings(settings, workers=4) is settings
+
+
+def test_budget_is_split_between_workers(settings: Settings) -> None:
+    settings = settings.model_copy(update={"db_connection_budget": 50})
+
+    worker_settings = get_worker_settings(settings, workers=4)
+
+    # 12 connections per worker, one of which is used by the cache listener
+    assert worker_settings.db_pool_size == 11
+    assert worker_settings.db_max_overflow == 0
+    assert settings.db_pool_size == 5
+
+
+def test_budget_applies_to_replicas(settings: Settings) -> None:
+    # Arrange
+    settings = settings.model_copy(
+        update={
+            "db_connection_budget": 50,
+            "db_replica_hosts": ["replica1", "replica2:5433"],
+        }
+    )
+
+    # Act
+    app = create_app(settings=get_worker_settings(settings, workers=4))
+
+    # Assert
+    replica_router = app.extra["replica_router"]
+    engines = [replica_router.primary, *replica_router.replicas]
+    assert len(engines) == 3
+    for engine in engines:
+        assert engine.pool.size() == 11
+        assert engine.pool._max_overflow == 0
+
+
+def test_too_small_budget(settings: Settings) -> None:
+    settings = settings.model_copy(update={"db_connection_budget": 7})
+
+    with pytest.raises(ValueError, match="too small for 4 workers"):
+        get_worker_settings(settings, workers=4)
+
+
+def test_metadata_is_not_preloaded_if_db_is_down(settings: Settings) -> None:
+    # Nothing listens on port 1
+    settings = settings.model_copy(update={"db_port": 1})
+    assert preload_metadata(settings) is None
+
+
+def test_worker_reflects_metadata_if_not_preloaded(
+    settings: Settings, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # Arrange
+    app_kwargs: dict[str, Any] = {}
+
+    def create_app(**kwargs: Any) -> None:
+        app_kwargs.update(kwargs)
+
+    monkeypatch.setattr("backend.server.create_app", create_app)
+    monkeypatch.setattr("backend.server.uvicorn.Server.run", lambda self, sockets: None)
+    # The signal handlers of the test process are kept
+    monkeypatch.setattr("backend.server.signal.signal", lambda *args: None)
+
+    # Act
+    with socket.socket() as sock:
+        Server(settings, 1, sock, jwk_set=None, metadata=None)._run_worker(0)
+
+    # Assert
+    assert app_kwargs["db_tables"] is None
+    assert app_kwargs["worker"] == 0
@@ -0,0 +1,159 @@
+import json
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from backend.slow_queries import (
+    RouteContextMiddleware,
+    SlowQueryRecorder,
+    current_route,
+    params_shape,
+)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(
+            text("CREATE TABLE category (id INTEGER PRIMARY KEY, name VARCHAR(30))")
+        )
+    return engine
+
+
+def test_params_shape_does_not_include_values() -> None:
+    assert params_shape({"cat_id": 1, "name": "secret"}) == {
+        "cat_id": "int",
+        "name": "str",
+    }
+    assert params_shape((1, "secret")) == ["int", "str"]
+    assert params_shape([{"id": 1}, {"id": 2}], executemany=True) == {
+        "rows": 2,
+        "row": {"id": "int"},
+    }
+
+
+def test_records_only_statements_above_threshold(engine) -> None:
+    # Arrange
+    recorder = SlowQueryRecorder(threshold=3600)
+    recorder.attach(engine)
+
+    # Act
+    with engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+    # Assert
+    assert recorder.records == []
+
+
+def test_records_slow_statement(engine, tmp_path: Path) -> None:
+    # Arrange
+    log_file = tmp_path / "slow.jsonl"
+    recorder = SlowQueryRecorder(
+        threshold=0, explain_sample_rate=0, max_records=2, log_file=log_file
+    )
+    recorder.attach(engine)
+
+    # Act
+    with engine.connect() as connection:
+        for cat_id in range(3):
+            connection.execute(
+                text("SELECT * FROM category WHERE id = :cat_id"), {"cat_id": cat_id}
+            )
+
+    # The records are written by a background thread
+    recorder.close()
+
+    # Assert
+    records = recorder.records
+    assert len(records) == 2
+    assert records[0].statement == "SELECT * FROM category WHERE id = ?"
+    assert records[0].params == ["int"]
+    assert records[0].route is None
+    assert records[0].plan is None
+    assert len(log_file.read_text().splitlines()) == 3
+    assert json.loads(log_file.read_text().splitlines()[0])["params"] == ["int"]
+
+
+def test_failed_log_write_does_not_fail_statement(engine, tmp_path: Path) -> None:
+    # Arrange
+    recorder = SlowQueryRecorder(
+        threshold=0, explain_sample_rate=0, log_file=tmp_path / "missing" / "slow.jsonl"
+    )
+    recorder.attach(engine)
+
+    # Act
+    with engine.connect() as connection:
+        result = connection.execute(text("SELECT 1")).scalar()
+    recorder.close()
+
+    # Assert
+    assert result == 1
+    assert len(recorder.records) == 1
+
+
+def test_failed_explain_does_not_abort_transaction(engine) -> None:
+    # Arrange (SQLite does not support EXPLAIN (ANALYZE, BUFFERS))
+    recorder = SlowQueryRecorder(threshold=0, explain_sample_rate=1)
+    recorder.attach(engine)
+
+    # Act
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO category VALUES (1, 'a')"))
+        connection.execute(text("SELECT * FROM category"))
+        connection.execute(text("INSERT INTO category VALUES (2, 'b')"))
+
+    # Assert
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT count(*) FROM category")).scalar() == 2
+    assert all(record.plan is None for record in recorder.records)
+
+
+@pytest.mark.parametrize(
+    "statement, sample, explain",
+    [
+        ("SELECT * FROM category", 0.5, True),
+        ("  (SELECT * FROM category)", 0.5, True),
+        ("WITH c AS (SELECT * FROM category) SELECT * FROM c", 0.5, True),
+        ("WITH c AS (DELETE FROM category RETURNING *) SELECT * FROM c", 0.5, False),
+        ("INSERT INTO category VALUES (1, 'a')", 0.5, False),
+        ("SELECT * FROM category", 0.99, False),
+    ],
+)
+def test_should_explain(statement: str, sample: float, explain: bool) -> None:
+    class Context:
+        execution_options = {}
+
+    recorder = SlowQueryRecorder(
+        threshold=0, explain_sample_rate=0.9, sample=lambda: sample
+    )
+    assert recorder._should_explain(statement, Context(), False) is explain
+
+
+def test_should_not_explain_streamed_statement() -> None:
+    class Context:
+        execution_options = {"stream_results": True}
+
+    recorder = SlowQueryRecorder(threshold=0, explain_sample_rate=1)
+    assert not recorder._should_explain("SELECT 1", Context(), False)
+
+
+def test_current_route_is_route_template() -> None:
+    # Arrange
+    app = FastAPI()
+
+    @app.get("/category/{cat_id}")
+    async def category(cat_id: int):
+        return {"route": current_route()}
+
+    app.add_middleware(RouteContextMiddleware)
+    client = TestClient(app)
+
+    # Act
+    r = client.get("/category/1")
+
+    # Assert
+    assert r.json() == {"route": "GET /category/{cat_id}"}
@@ -0,0 +1,49 @@
+import asyncio
+
+from backend.startup import StartupTimer, profile_imports
+
+
+def test_laps_are_recorded_in_order() -> None:
+    timer = StartupTimer()
+    timer.lap("first")
+    timer.lap("second")
+
+    assert list(timer.phases) == ["first", "second"]
+    assert all(seconds >= 0 for seconds in timer.phases.values())
+    assert timer.total >= sum(timer.phases.values())
+
+
+def test_concurrent_phases_are_timed() -> None:
+    timer = StartupTimer()
+
+    async def wait(seconds: float) -> float:
+        await asyncio.sleep(seconds)
+        return seconds
+
+    async def run() -> list[float]:
+        return await asyncio.gather(
+            timer.timed("short", wait(0.01)), timer.timed("long", wait(0.05))
+        )
+
+    assert asyncio.run(run()) == [0.01, 0.05]
+    assert 0.01 <= timer.phases["short"] < timer.phases["long"]
+
+
+def test_phase_is_recorded_on_error() -> None:
+    timer = StartupTimer()
+    try:
+        with timer.phase("failing"):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+
+    assert "failing" in timer.phases
+
+
+def test_profile_imports() -> None:
+    imports = profile_imports("json")
+
+    names = [name for name, _, _ in imports]
+    assert names[-1] == "json"
+    assert "json.decoder" in names
+    assert all(0 <= own <= cumulative for _, own, cumulative in imports)
@@ -1,15 +1,27 @@
 export async function getCategories(token) {
-    console.debug("Calling fetch...");
-    const r = await fetch(window.location.origin + "/backend/categories",
-        {
-            headers: {
-                Accept: 'application/json',
-                Authorization: `Bearer ${token}`
+    // The categories endpoint is paginated, so keep fetching pages until
+    // there is no next cursor
+    let categories = [];
+    let url = window.location.origin + "/backend/categories";
+    while (url) {
+        console.debug("Calling fetch...");
+        const r = await fetch(url,
+            {
+                headers: {
+                    Accept: 'application/json',
+                    Authorization: `Bearer ${token}`
+                }
             }
-        }
-    );
-    console.debug("Fetch await done, calling json await...");
-    const json = await r.json();
-    console.debug("json await done");
-    return json
+        );
+        console.debug("Fetch await done, calling json await...");
+        const json = await r.json();
+        console.debug("json await done");
+        categories = categories.concat(json);
+
+        const nextCursor = r.headers.get("X-Next-Cursor");
+        url = nextCursor
+            ? window.location.origin + "/backend/categories?after=" + nextCursor
+            : null;
+    }
+    return categories
 }